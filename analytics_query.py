@@ -0,0 +1,312 @@
+import argparse
+import gzip
+import heapq
+import json
+import os
+import re
+import sys
+from collections import Counter
+from datetime import date, datetime
+from typing import Iterator
+from zoneinfo import ZoneInfo
+from log_files import DEFAULT_LOG_PATH, LOG_TIMEZONE_NAME, compress_log_file
+
+# Command line tool to query the analytics events of the bot logs (see log_analytics in telegram_bots/bot_logging.py)
+# Files are streamed line by line, gzip compressed rotations included, so memory does not grow with the log size
+# Every rotated day file gets a small index in DEFAULT_LOG_PATH/<bot>/.index, repeat queries only read the indexes
+# (The current "log" file is still being written to, it is always streamed and never indexed)
+#
+# Examples:
+#   python analytics_query.py summary --since 2023-08-01
+#   python analytics_query.py users --bot gplinks_bypasser_telegram_bot --daily
+#   python analytics_query.py urls --limit 20
+#   python analytics_query.py hours
+#   python analytics_query.py index      # builds the missing indexes (e.g. from a cron job)
+#   python analytics_query.py compress   # compresses the rotated files written before compression on rollover
+
+# Bump when the layout of the index changes, older indexes are then rebuilt
+INDEX_VERSION = 1
+INDEX_DIRECTORY = ".index"
+
+# Number of URLs kept in the index of a day, the top URLs over several days are computed from these
+INDEX_MAX_URLS = 1000
+
+# Rotated files are named log.<dd-mm-YYYY>, with .<n> if the day was rotated more than once and .gz once compressed
+ROTATED_LOG_FILE = re.compile(r"^log\.(\d{2}-\d{2}-\d{4})(\.\d+)?(\.gz)?$")
+
+
+# One log file of a bot, day is None for the current "log" file
+class LogFile:
+    def __init__(self, path: str, day: date | None, index_path: str | None):
+        self.path = path
+        self.day = day
+        self.index_path = index_path
+
+
+# Day of the current "log" file, the logs are written in the logging timezone
+def log_today() -> date:
+    return datetime.now(ZoneInfo(LOG_TIMEZONE_NAME)).date()
+
+
+# Returns the bot directories in the log path, or only the selected bot
+def bot_directories(log_path: str, bot: str | None) -> list[str]:
+    if bot is not None:
+        return [os.path.join(log_path, bot)]
+    return sorted(entry.path for entry in os.scandir(log_path) if entry.is_dir())
+
+
+# Lists the log files of a bot directory within [since, until], oldest first
+def list_log_files(bot_directory: str, since: date | None, until: date | None) -> list[LogFile]:
+    rotated: dict[str, LogFile] = {}
+    for entry in os.scandir(bot_directory):
+        match = ROTATED_LOG_FILE.match(entry.name)
+        if match is None:
+            continue
+        day = datetime.strptime(match.group(1), "%d-%m-%Y").date()
+        if (since is not None and day < since) or (until is not None and day > until):
+            continue
+
+        # While a file is being compressed both files exist, then the complete uncompressed one is used
+        name = entry.name[:-len(".gz")] if match.group(3) else entry.name
+        if name in rotated and match.group(3):
+            continue
+        rotated[name] = LogFile(entry.path, day, os.path.join(bot_directory, INDEX_DIRECTORY, name + ".json"))
+
+    log_files = sorted(rotated.values(), key=lambda log_file: (log_file.day, log_file.path))
+
+    today = log_today()
+    current = os.path.join(bot_directory, "log")
+    if os.path.isfile(current) and (since is None or since <= today) and (until is None or today <= until):
+        log_files.append(LogFile(current, None, None))
+    return log_files
+
+
+# Yields the analytics events of a log file one at a time
+# Lines that are not analytics events (other records, plain text logs written before the JSON Lines format) are skipped
+def read_events(path: str) -> Iterator[dict]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", errors="replace") as log_file:
+        for line in log_file:
+            # Cheap check before parsing, most of the other lines are not JSON or not events
+            if not line.startswith("{") or '"event"' not in line:
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            if event.get("event") == "message":
+                yield event
+
+
+# Counts of the analytics events of one or more log files
+# This is also the content of an index file
+class Aggregate:
+    def __init__(self):
+        self.total = 0
+        self.outcomes: Counter = Counter()
+        self.hours: Counter = Counter()
+        self.users: Counter = Counter()
+        self.usernames: dict[str, str] = {}
+        self.urls: Counter = Counter()
+
+    def add_event(self, event: dict):
+        self.total += 1
+        self.outcomes[event.get("outcome")] += 1
+
+        # The time is written as %Y-%m-%dT%H:%M:%S
+        self.hours[event.get("time", "")[11:13]] += 1
+
+        user_id = str(event.get("user_id"))
+        self.users[user_id] += 1
+        if event.get("username"):
+            self.usernames[user_id] = event["username"]
+
+        # The URLs sent by the users which were bypassed successfully
+        if event.get("outcome") == "bypassed" and event.get("text"):
+            self.urls[event["text"]] += 1
+
+    def merge(self, other: "Aggregate"):
+        self.total += other.total
+        self.outcomes.update(other.outcomes)
+        self.hours.update(other.hours)
+        self.users.update(other.users)
+        self.usernames.update(other.usernames)
+        self.urls.update(other.urls)
+
+    def to_json(self) -> dict:
+        return {"version": INDEX_VERSION, "total": self.total, "outcomes": dict(self.outcomes),
+                "hours": dict(self.hours), "users": dict(self.users), "usernames": self.usernames,
+                "urls": dict(self.urls.most_common(INDEX_MAX_URLS))}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Aggregate":
+        aggregate = cls()
+        aggregate.total = data["total"]
+        aggregate.outcomes.update(data["outcomes"])
+        aggregate.hours.update(data["hours"])
+        aggregate.users.update(data["users"])
+        aggregate.usernames.update(data["usernames"])
+        aggregate.urls.update(data["urls"])
+        return aggregate
+
+
+def aggregate_file(path: str) -> Aggregate:
+    aggregate = Aggregate()
+    for event in read_events(path):
+        aggregate.add_event(event)
+    return aggregate
+
+
+# Returns the index of a rotated log file, or None if it is missing or outdated
+def load_index(log_file: LogFile) -> Aggregate | None:
+    try:
+        with open(log_file.index_path, encoding="utf-8") as index_file:
+            data = json.load(index_file)
+    except (OSError, ValueError):
+        return None
+    if data.get("version") != INDEX_VERSION:
+        return None
+    return Aggregate.from_json(data)
+
+
+def write_index(log_file: LogFile, aggregate: Aggregate):
+    os.makedirs(os.path.dirname(log_file.index_path), exist_ok=True)
+
+    # Written to a temporary file first so that a concurrent query never reads half an index
+    temporary_path = log_file.index_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as index_file:
+        json.dump(aggregate.to_json(), index_file, ensure_ascii=False, separators=(",", ":"))
+    os.replace(temporary_path, log_file.index_path)
+
+
+# Returns the counts of a log file from its index, building the index first if needed
+# Rotated files are never written to again, so their index stays valid
+def file_aggregate(log_file: LogFile) -> Aggregate:
+    if log_file.index_path is None:
+        return aggregate_file(log_file.path)
+    aggregate = load_index(log_file)
+    if aggregate is None:
+        aggregate = aggregate_file(log_file.path)
+        write_index(log_file, aggregate)
+    return aggregate
+
+
+# Yields (bot, day, counts) for every log file matching the arguments, day is today for the current "log" file
+def daily_aggregates(args: argparse.Namespace) -> Iterator[tuple[str, date, Aggregate]]:
+    for bot_directory in bot_directories(args.log_path, args.bot):
+        for log_file in list_log_files(bot_directory, args.since, args.until):
+            yield os.path.basename(bot_directory), log_file.day or log_today(), file_aggregate(log_file)
+
+
+def total_aggregate(args: argparse.Namespace) -> Aggregate:
+    total = Aggregate()
+    for bot, day, aggregate in daily_aggregates(args):
+        total.merge(aggregate)
+    return total
+
+
+def user_label(aggregate: Aggregate, user_id: str) -> str:
+    username = aggregate.usernames.get(user_id)
+    return "%s (@%s)" % (user_id, username) if username else user_id
+
+
+def summary_command(args: argparse.Namespace):
+    total = Aggregate()
+    for bot, day, aggregate in daily_aggregates(args):
+        outcomes = " ".join("%s=%d" % (outcome, count) for outcome, count in aggregate.outcomes.most_common())
+        print("%s\t%s\t%d\t%d users\t%s" % (day.isoformat(), bot, aggregate.total, len(aggregate.users), outcomes))
+        total.merge(aggregate)
+    outcomes = " ".join("%s=%d" % (outcome, count) for outcome, count in total.outcomes.most_common())
+    print("total\t\t%d\t%d users\t%s" % (total.total, len(total.users), outcomes))
+
+
+def users_command(args: argparse.Namespace):
+    if args.daily:
+        # Requests per user per day
+        for bot, day, aggregate in daily_aggregates(args):
+            for user_id, count in heapq.nlargest(args.limit, aggregate.users.items(), key=lambda item: item[1]):
+                print("%s\t%s\t%s\t%d" % (day.isoformat(), bot, user_label(aggregate, user_id), count))
+        return
+    total = total_aggregate(args)
+    for user_id, count in total.users.most_common(args.limit):
+        print("%s\t%d" % (user_label(total, user_id), count))
+
+
+def urls_command(args: argparse.Namespace):
+    # The indexes keep the top INDEX_MAX_URLS URLs of every day, so counts of rare URLs can be too low
+    for url, count in total_aggregate(args).urls.most_common(args.limit):
+        print("%s\t%d" % (url, count))
+
+
+def hours_command(args: argparse.Namespace):
+    total = total_aggregate(args)
+    for hour in range(24):
+        print("%02d\t%d" % (hour, total.hours["%02d" % hour]))
+
+
+# Builds the missing indexes, e.g. from a daily cron job so that queries never have to stream a rotated file
+def index_command(args: argparse.Namespace):
+    for bot_directory in bot_directories(args.log_path, args.bot):
+        for log_file in list_log_files(bot_directory, args.since, args.until):
+            if log_file.index_path is None:
+                continue
+            if args.rebuild or load_index(log_file) is None:
+                write_index(log_file, aggregate_file(log_file.path))
+                print("Indexed %s" % log_file.path)
+
+
+# Compresses the rotated files which are not compressed yet
+# (Files rotated before compression on rollover, or whose compression was interrupted)
+def compress_command(args: argparse.Namespace):
+    for bot_directory in bot_directories(args.log_path, args.bot):
+        for log_file in list_log_files(bot_directory, args.since, args.until):
+            if log_file.index_path is None or log_file.path.endswith(".gz"):
+                continue
+            compress_log_file(log_file.path)
+            print("Compressed %s" % log_file.path)
+
+
+def parse_day(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description="Query the analytics events of the Telegram bot logs")
+    parser.add_argument("--log-path", default=DEFAULT_LOG_PATH, help="Log directory (default: %(default)s)")
+    parser.add_argument("--bot", help="Only query this bot (name of its log directory)")
+    parser.add_argument("--since", type=parse_day, help="First day to query (YYYY-MM-DD)")
+    parser.add_argument("--until", type=parse_day, help="Last day to query (YYYY-MM-DD)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("summary", help="Events per day and outcome").set_defaults(run=summary_command)
+
+    users = commands.add_parser("users", help="Requests per user")
+    users.add_argument("--daily", action="store_true", help="Requests per user per day")
+    users.add_argument("--limit", type=int, default=20)
+    users.set_defaults(run=users_command)
+
+    urls = commands.add_parser("urls", help="Top bypassed URLs")
+    urls.add_argument("--limit", type=int, default=20)
+    urls.set_defaults(run=urls_command)
+
+    commands.add_parser("hours", help="Events per hour of the day").set_defaults(run=hours_command)
+
+    index = commands.add_parser("index", help="Build the missing indexes of the rotated log files")
+    index.add_argument("--rebuild", action="store_true", help="Rebuild the existing indexes too")
+    index.set_defaults(run=index_command)
+
+    commands.add_parser("compress", help="Compress the uncompressed rotated log files").set_defaults(
+        run=compress_command)
+
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.log_path):
+        parser.error("Log directory %s does not exist" % args.log_path)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except BrokenPipeError:
+        # Output piped to head etc.
+        sys.stderr.close()
@@ -1,28 +1,74 @@
+import time
+
+# Start of the startup time measurement, taken before the slow imports
+STARTUP_STARTED_AT = time.perf_counter()
+
+import hmac
 import os
-from flask import Flask, Response, render_template, send_from_directory
-from typing import Type
-from constants import in_developer_mode, WEBHOOK_HOST
-from telegram_bots import TelegramBot
-from telegram_bots.echo_bot import EchoTelegramBot
-from telegram_bots.gplinks_bypasser_telegram_bot import GpLinksBypasserTelegramBot
+from flask import Flask, Response, abort, jsonify, request, send_file
+from constants import WEBHOOK_HOST, BOT_API_CONNECTION_POOL_SIZE, METRICS_TOKEN, PROFILER_TOKEN
+from static_assets import load_static_assets, not_modified
+from telegram_bots.bot_api_session import configure_shared_bot_api_session
+from telegram_bots.bot_logging import create_bot_logger
+from telegram_bots.metrics import generate_metrics
+from telegram_bots.profiler import ProfilerBusyError, profiler
+from telegram_bots.registry import TELEGRAM_BOTS
+from telegram_bots.webhook_dispatcher import WebhookDispatcher
+from telegram_bots.webhook_registration import webhook_registration, register_webhooks_in_parallel
+
+# Logs the startup time of the worker processes
+startup_logger = create_bot_logger('app')
+IMPORTS_FINISHED_AT = time.perf_counter()
 
 # The Flask App object
-app = Flask(__name__)
+# The static files are served by static_asset below instead of Flask's static route
+app = Flask(__name__, static_folder=None)
+
+# The pre-rendered landing page and the precompressed static files (see static_assets.py)
+static_assets = load_static_assets()
+
+# Receives the webhook requests of all the bots (see webhook_dispatcher.py)
+webhook_dispatcher = WebhookDispatcher()
+
+
+# Sends a file of the static build in the best encoding the client accepts, or 304 if the client has it already
+def static_asset_response(path: str) -> Response:
+    asset = static_assets.get(path)
+    if asset is None:
+        abort(404)
+    encoding, variant = asset.negotiate(request.headers.get('Accept-Encoding'))
+    if not_modified(request.headers.get('If-None-Match'), variant.etag):
+        response = Response(status=304)
+        encoding = None
+    else:
+        # send_file hands the open file to gunicorn, which sends it with sendfile() without copying it
+        response = send_file(variant.path, mimetype=asset.content_type, conditional=False, etag=False)
+        response.content_type = asset.content_type
+        # send_file names the response after the file on disk (filename=index.html.br), which the asset is not
+        response.headers.pop('Content-Disposition', None)
+    for name, value in asset.headers(encoding, variant):
+        response.headers[name] = value
+    return response
 
 
 # The root route of your website
-# Returns content of index.html after rendering with Jinja2
+# Returns content of index.html, rendered once with Jinja2 by static_assets.py
 @app.route('/')
 def index():
-    return render_template("index.html")
+    return static_asset_response('/')
 
 
 # Returns the favicon for the website
 # Used in the root index.html page
 @app.route('/favicon.ico')
 def favicon():
-    return send_from_directory(os.path.join(app.root_path, 'static'),
-                               'favicon.ico', mimetype='image/vnd.microsoft.icon')
+    return static_asset_response('/favicon.ico')
+
+
+# Returns the static files, under their content-hashed names (cached for a year) or their own names
+@app.route('/static/<path:filename>')
+def static_asset(filename: str):
+    return static_asset_response('/static/' + filename)
 
 
 # Keep Alive Route
@@ -36,21 +82,81 @@ def keep_alive():
     return Response(status=204)
 
 
+# True if the request has the header "Authorization: Bearer <token>"
+# (Compared in constant time, so the response time does not tell how much of a guess was right)
+def has_bearer_token(token: str) -> bool:
+    return hmac.compare_digest(request.headers.get('Authorization', '').encode(), ("Bearer %s" % token).encode())
+
+
+# Prometheus metrics of all the gunicorn workers (see telegram_bots/metrics.py)
+# Only served if METRICS_TOKEN is set, scrape it with the bearer token METRICS_TOKEN
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN is None:
+        abort(404)
+    if not has_bearer_token(METRICS_TOKEN):
+        abort(401)
+    body, content_type = generate_metrics()
+    return Response(body, content_type=content_type)
+
+
+# Profiles the gunicorn worker which receives the request (see telegram_bots/profiler.py)
+# Only served if PROFILER_TOKEN is set, every request needs the bearer token PROFILER_TOKEN
+#   GET    status of the worker and the files of its last profile
+#   POST   starts a profile, ?seconds=30&stacks=1&allocations=0&fraction=1
+#          fraction below 1 samples only that fraction of the updates and bypass jobs instead of all the threads
+#   DELETE stops the running profile early and writes its files
+# The files are written to PROFILES_PATH, the response tells the pid of the worker
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def admin_profile():
+    if PROFILER_TOKEN is None:
+        abort(404)
+    if not has_bearer_token(PROFILER_TOKEN):
+        abort(401)
+
+    if request.method == 'GET':
+        return jsonify(profiler.status())
+    if request.method == 'DELETE':
+        return jsonify(profiler.stop())
+    try:
+        status = profiler.start(seconds=request.args.get('seconds', 30, type=float),
+                                stacks=request.args.get('stacks', '1') != '0',
+                                allocations=request.args.get('allocations', '0') != '0',
+                                fraction=request.args.get('fraction', 1, type=float))
+    except ValueError as ex:
+        return jsonify(error=str(ex)), 400
+    except ProfilerBusyError as ex:
+        return jsonify(error=str(ex), **profiler.status()), 409
+    return jsonify(status), 202
+
+
 # 1. Registers the route for webhook in this server
 # 2. Registers the webhook for the bot on Telegram
 def initialize_telegram_bots():
-    # Add the Telegram Bots here
-    # If you are in developer mode, then only the first bot will run
-    # Only one bot is intended to be tested on developer mode
-    telegram_bots: list[Type[TelegramBot]] = [
-        GpLinksBypasserTelegramBot,
-        EchoTelegramBot
-    ]
-
-    # Loop through all the bots and initialize them
+    # The bots are listed in telegram_bots/registry.py
+    telegram_bots = TELEGRAM_BOTS
+
+    # All the bots share one pool of keep-alive connections to the Telegram Bot API
+    configure_shared_bot_api_session(pool_size=BOT_API_CONNECTION_POOL_SIZE)
+
+    # Loop through all the bots and add them to the webhook dispatcher, which then adds a single route for all of them
     for telegram_bot in telegram_bots:
-        telegram_bot.register_route(flask_app=app)
-        telegram_bot.register_webhook()
+        telegram_bot.register_route(dispatcher=webhook_dispatcher)
+    webhook_dispatcher.register_route(flask_app=app)
+    routes_registered_at = time.perf_counter()
+
+    # The webhooks are registered only by the first worker of a deployment, all the bots at the same time
+    with webhook_registration(telegram_bots) as registration_needed:
+        if registration_needed:
+            register_webhooks_in_parallel(telegram_bots)
+    webhooks_registered_at = time.perf_counter()
+
+    startup_logger.info("Worker %d started in %.0f ms (imports %.0f ms, routes %.0f ms, webhooks %.0f ms%s)",
+                        os.getpid(), (webhooks_registered_at - STARTUP_STARTED_AT) * 1000,
+                        (IMPORTS_FINISHED_AT - STARTUP_STARTED_AT) * 1000,
+                        (routes_registered_at - IMPORTS_FINISHED_AT) * 1000,
+                        (webhooks_registered_at - routes_registered_at) * 1000,
+                        "" if registration_needed else ", already registered")
 
 
 # If this is not an Azure Web App Environment, then don't run the bots
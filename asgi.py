@@ -0,0 +1,95 @@
+import asyncio
+from constants import WEBHOOK_HOST
+from static_assets import AssetVariant, load_static_assets, not_modified
+from telegram_bots.async_runtime import AsgiApp, AsgiRequest, AsgiResponse, configure_async_bot_api_session, \
+    close_async_sessions
+from telegram_bots.registry import TELEGRAM_BOTS
+from telegram_bots.webhook_registration import webhook_registration
+
+# Async alternative to app.py
+# One process serves many concurrent bypasses on a single event loop instead of one per gunicorn worker thread
+# Run it with an ASGI server, e.g.
+#   uvicorn asgi:application --host 0.0.0.0 --port 8000
+#   gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+
+# The ASGI App object
+application = AsgiApp()
+
+# The pre-rendered landing page and the precompressed static files (see static_assets.py)
+static_assets = load_static_assets()
+
+# The files are small, every variant is read once and then served from memory
+static_bodies: dict[str, bytes] = {}
+
+
+def static_body(variant: AssetVariant) -> bytes:
+    body = static_bodies.get(variant.path)
+    if body is None:
+        with open(variant.path, 'rb') as static_file:
+            body = static_bodies[variant.path] = static_file.read()
+    return body
+
+
+# Same as static_asset_response of app.py
+def static_asset_response(request: AsgiRequest, path: str) -> AsgiResponse:
+    asset = static_assets.get(path)
+    if asset is None:
+        return AsgiResponse(status=404)
+    encoding, variant = asset.negotiate(request.headers.get('accept-encoding'))
+    if not_modified(request.headers.get('if-none-match'), variant.etag):
+        return AsgiResponse(status=304, headers=asset.headers(None, variant))
+    return AsgiResponse(status=200, body=static_body(variant), content_type=asset.content_type,
+                        headers=asset.headers(encoding, variant))
+
+
+# The root route of your website
+# Returns content of index.html, rendered once with Jinja2 by static_assets.py
+async def index(request: AsgiRequest) -> AsgiResponse:
+    return static_asset_response(request, '/')
+
+
+# Returns the favicon for the website
+# Used in the root index.html page
+async def favicon(request: AsgiRequest) -> AsgiResponse:
+    return static_asset_response(request, '/favicon.ico')
+
+
+# Keep Alive Route
+# Azure turns-off the webapp after some time if it does not receive any requests for the time
+async def keep_alive(request: AsgiRequest) -> AsgiResponse:
+    # Returns 204 No Content since response is not required for keep-alive
+    return AsgiResponse(status=204)
+
+
+# Returns the static files, under their content-hashed names (cached for a year) or their own names
+async def static(request: AsgiRequest) -> AsgiResponse:
+    return static_asset_response(request, request.path)
+
+
+application.add_route('/', index)
+application.add_route('/favicon.ico', favicon)
+application.add_route('/keep-alive', keep_alive)
+application.add_prefix_route('/static/', static)
+
+# The bots are listed in telegram_bots/registry.py
+telegram_bots = TELEGRAM_BOTS
+
+
+# Registers the webhooks of all the bots concurrently once the event loop is running
+# (Only the first worker of a deployment registers them, see webhook_registration.py)
+@application.on_startup
+async def initialize_telegram_bots():
+    configure_async_bot_api_session()
+    if WEBHOOK_HOST is not None:
+        with webhook_registration(telegram_bots) as registration_needed:
+            if registration_needed:
+                await asyncio.gather(*(telegram_bot.register_async_webhook() for telegram_bot in telegram_bots))
+
+
+application.on_shutdown(close_async_sessions)
+
+# If this is not an Azure Web App Environment, then don't run the bots
+# Define the exposed hostname/IP and port in constants.py
+if WEBHOOK_HOST is not None:
+    for telegram_bot in telegram_bots:
+        telegram_bot.register_async_route(asgi_app=application)
@@ -0,0 +1,71 @@
+# Compares extract_go_link_form with the BeautifulSoup extraction it replaced, on the saved pages in fixtures/
+# Run from the repository root: python -m benchmarks.go_link_extractor_benchmark
+import argparse
+import os
+import timeit
+import tracemalloc
+from bs4 import BeautifulSoup
+from telegram_bots.go_link_extractor import extract_go_link_form
+
+# Saved go-link pages used as benchmark input
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+# The previous extraction in gplinks_bypass, kept here as the reference for results and timings
+def extract_go_link_form_with_beautifulsoup(content: bytes) -> dict:
+    soup = BeautifulSoup(content, "html.parser")
+
+    data = {}
+    go_link_form = soup.find_all(id="go-link")
+    for form_elem in go_link_form:
+        if form_elem is not None:
+            inputs = form_elem.find_all("input")
+            for input_elem in inputs:
+                data[input_elem.get('name')] = input_elem.get('value')
+    return data
+
+
+# Returns the peak memory allocated while extracting the form once
+def peak_allocated_bytes(extract, content: bytes) -> int:
+    tracemalloc.start()
+    try:
+        extract(content)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+# Returns the best time of one extraction in seconds
+def best_time_seconds(extract, content: bytes, number: int) -> float:
+    return min(timeit.repeat(lambda: extract(content), number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the go-link form extraction with BeautifulSoup")
+    parser.add_argument("--number", type=int, default=20, help="Extractions per timing run")
+    args = parser.parse_args()
+
+    print("%-36s %12s %12s %8s %12s %12s" % ("fixture", "bs4 ms", "stream ms", "speedup", "bs4 KiB", "stream KiB"))
+    for name in sorted(os.listdir(FIXTURES_PATH)):
+        if not name.startswith("go_link_page"):
+            continue
+        with open(os.path.join(FIXTURES_PATH, name), "rb") as fixture:
+            content = fixture.read()
+
+        # Both extractions have to agree before their timings mean anything
+        expected = extract_go_link_form_with_beautifulsoup(content)
+        actual = extract_go_link_form(content)
+        assert actual == expected, "%s: %r != %r" % (name, actual, expected)
+
+        reference_time = best_time_seconds(extract_go_link_form_with_beautifulsoup, content, args.number)
+        streaming_time = best_time_seconds(extract_go_link_form, content, args.number)
+        reference_peak = peak_allocated_bytes(extract_go_link_form_with_beautifulsoup, content)
+        streaming_peak = peak_allocated_bytes(extract_go_link_form, content)
+
+        print("%-36s %12.3f %12.3f %7.1fx %12.1f %12.1f" % (
+            name, reference_time * 1000, streaming_time * 1000, reference_time / streaming_time,
+            reference_peak / 1024, streaming_peak / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+# Checks extract_gplinks_urls on the messages in fixtures/link_extraction_cases.jsonl
+# Every line is a message text (or caption) with its entities and the URLs expected from it
+# Run from the repository root: python -m benchmarks.link_extraction_check
+import json
+import os
+from telebot.types import Message
+from telegram_bots.link_extraction import extract_gplinks_urls
+
+CASES_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "link_extraction_cases.jsonl")
+
+# Same as MULTI_LINK_MAX_LINKS, without importing constants.py
+MAX_LINKS = 10
+
+
+def message(case: dict) -> Message:
+    fields = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}}
+    if "caption" in case:
+        fields.update(photo=[{"file_id": "x", "file_unique_id": "x", "width": 1, "height": 1}],
+                      caption=case["caption"], caption_entities=case.get("entities", []))
+    else:
+        fields.update(text=case["text"], entities=case.get("entities", []))
+    return Message.de_json(fields)
+
+
+def main():
+    with open(CASES_PATH, encoding="utf-8") as cases:
+        cases = [json.loads(line) for line in cases if line.strip()]
+    for case in cases:
+        urls = extract_gplinks_urls(message(case), MAX_LINKS)
+        assert urls == case["urls"], "%r: %r != %r" % (case.get("text", case.get("caption")), urls, case["urls"])
+    print("%d cases passed" % len(cases))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+# Offline end-to-end load benchmark of app.py served by gunicorn
+# Starts the stand-ins of stand_ins.py for the Telegram Bot API and GPLinks, points the bots at them,
+# sends webhook updates to both bots and reports webhook latency, end-to-end reply latency, throughput and memory
+# Run from the repository root (needs gunicorn and a Linux /proc for the memory figures):
+#   python -m benchmarks.load_harness --requests 500 --concurrency 32 --workers 2 --json results.json
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from benchmarks.stand_ins import BYPASSED_URL_BASE, FakeGpLinks, FakeTelegramApi
+
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Bot tokens of the benchmark, the stand-in accepts any token
+ECHO_BOT_TOKEN = "100001:benchmark-echo"
+GPLINKS_BOT_TOKEN = "100002:benchmark-gplinks"
+
+# Chat ids of the generated updates start here, every update comes from a chat of its own
+# so that the per-chat rate limit and ordering do not hold the load back
+FIRST_CHAT_ID = 700000000
+
+# The bypasser's first reply, which is not the answer yet
+PLACEHOLDER_TEXT = "Processing... Please Wait"
+
+
+# Percentile of sorted values by the nearest-rank method
+def percentile(sorted_values: list[float], percent: float) -> float | None:
+    if not sorted_values:
+        return None
+    rank = max(int(round(percent / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def latency_summary(values: list[float]) -> dict:
+    values = sorted(values)
+    return {"count": len(values), **{"p%d_ms" % p: None if percentile(values, p) is None
+                                     else round(percentile(values, p) * 1000, 2) for p in (50, 95, 99)},
+            "max_ms": round(values[-1] * 1000, 2) if values else None}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Memory of a process from /proc, RSS now and the peak RSS (high water mark) in KiB
+def process_memory_kib(pid: int) -> dict:
+    memory = {}
+    with open("/proc/%d/status" % pid) as status:
+        for line in status:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM"):
+                memory[name] = int(value.split()[0])
+    return {"rss_kib": memory.get("VmRSS"), "peak_rss_kib": memory.get("VmHWM")}
+
+
+# The gunicorn workers are the children of the gunicorn master
+def child_pids(pid: int) -> list[int]:
+    children = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name) as stat:
+                # The parent pid is the second field after the parenthesised command name
+                if int(stat.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    children.append(int(name))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+
+# Matches the replies arriving at the Telegram stand-in with the updates that were sent
+# An update is answered when the final message of its bot arrives: the echo for the echo bot,
+# the result of the bypasser, which is an edit of the "Processing..." message or, when the send scheduler
+# coalesced the two, a reply with the result right away
+class ReplyTracker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+        # chat_id -> (final method, time the webhook request was started)
+        self._expected: dict[int, tuple[str, float]] = {}
+
+        self.latencies: list[float] = []
+        self.outcomes: dict[str, int] = {}
+        self.last_reply_at = 0.0
+
+    def expect(self, chat_id: int, final_method: str, sent_at: float):
+        with self._lock:
+            self._expected[chat_id] = (final_method, sent_at)
+
+    def on_message(self, method: str, chat_id: int, text: str, received_at: float):
+        with self._condition:
+            expected = self._expected.get(chat_id)
+            if expected is None or text == PLACEHOLDER_TEXT:
+                return
+            del self._expected[chat_id]
+            self.latencies.append(received_at - expected[1])
+            self.last_reply_at = max(self.last_reply_at, received_at)
+            outcome = "bypassed" if text.startswith(BYPASSED_URL_BASE) else \
+                "echoed" if expected[0] == "sendMessage" else text.split("\n")[0][:40]
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            self._condition.notify_all()
+
+    # Waits until every expected reply arrived, returns the number of missing replies
+    def wait(self, timeout_seconds: float) -> int:
+        deadline = time.monotonic() + timeout_seconds
+        with self._condition:
+            while self._expected and time.monotonic() < deadline:
+                self._condition.wait(deadline - time.monotonic())
+            return len(self._expected)
+
+
+# A webhook update of a private chat as Telegram sends it
+def message_update(update_id: int, chat_id: int, text: str) -> bytes:
+    user = {"id": chat_id, "is_bot": False, "first_name": "Load", "username": "load_%d" % chat_id}
+    return json.dumps({"update_id": update_id, "message": {
+        "message_id": 1, "from": user, "chat": {"id": chat_id, "first_name": "Load", "username": user["username"],
+                                                "type": "private"},
+        "date": int(time.time()), "text": text}}).encode()
+
+
+# Last lines of the output of gunicorn and the app, shown when gunicorn does not start
+def log_tail(log_path: str, lines: int = 20) -> str:
+    with open(log_path, errors="replace") as log:
+        return "".join(log.readlines()[-lines:])
+
+
+# Starts gunicorn with app:app and waits until it answers
+# The output of gunicorn and the app (e.g. the analytics records) goes to log_path
+def start_gunicorn(port: int, workers: int, threads: int, env: dict, log_path: str,
+                   timeout_seconds: float) -> subprocess.Popen:
+    with open(log_path, "ab") as log:
+        process = subprocess.Popen([sys.executable, "-m", "gunicorn", "--workers", str(workers),
+                                    "--threads", str(threads), "--bind", "127.0.0.1:%d" % port,
+                                    "--log-level", "warning", "app:app"],
+                                   cwd=REPOSITORY_PATH, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("gunicorn exited with %d:\n%s" % (process.returncode, log_tail(log_path)))
+        try:
+            if requests.get("http://127.0.0.1:%d/keep-alive" % port, timeout=1).status_code == 204:
+                # Every worker initialises the bots on import, give the others the time to finish as well
+                time.sleep(1)
+                return process
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("gunicorn did not start within %d s:\n%s" % (timeout_seconds, log_tail(log_path)))
+
+
+# Sends the updates with `concurrency` concurrent webhook requests, returns the latencies and the failed statuses
+def send_updates(port: int, updates: list[tuple[str, int, bytes, str]], tracker: ReplyTracker,
+                 concurrency: int) -> tuple[list[float], dict[int, int]]:
+    local = threading.local()
+    latencies = []
+    failures: dict[int, int] = {}
+    lock = threading.Lock()
+
+    def send(route: str, chat_id: int, body: bytes, final_method: str):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        started_at = time.perf_counter()
+        tracker.expect(chat_id, final_method, started_at)
+        status = session.post("http://127.0.0.1:%d%s" % (port, route), data=body,
+                              headers={"Content-Type": "application/json"}).status_code
+        latency = time.perf_counter() - started_at
+        with lock:
+            latencies.append(latency)
+            if status != 204:
+                failures[status] = failures.get(status, 0) + 1
+                # A rejected update gets no reply
+                tracker.on_message(final_method, chat_id, "HTTP %d" % status, time.perf_counter())
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for update in updates:
+            executor.submit(send, *update)
+    return latencies, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load benchmark of app.py under gunicorn")
+    parser.add_argument("--requests", type=int, default=500, help="Webhook updates to send")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent webhook requests")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=4, help="gunicorn threads per worker")
+    parser.add_argument("--bypass-share", type=float, default=0.5,
+                        help="Share of the updates sent to the bypasser, the rest goes to the echo bot")
+    parser.add_argument("--distinct-links", type=int, default=0,
+                        help="Number of distinct short URLs (0 = every bypass gets its own, i.e. no cache hits)")
+    parser.add_argument("--telegram-latency-ms", type=float, default=20, help="Latency of the Telegram stand-in")
+    parser.add_argument("--gplinks-latency-ms", type=float, default=50, help="Latency of the GPLinks stand-in")
+    parser.add_argument("--go-delay", type=float, default=1.0, help="GPLINKS_GO_DELAY_SECONDS of the bypasser")
+    parser.add_argument("--reply-timeout", type=float, default=120, help="Seconds to wait for the last replies")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the update mix")
+    parser.add_argument("--json", help="Also write the results to this file, e.g. to compare runs")
+    args = parser.parse_args()
+
+    tracker = ReplyTracker()
+    telegram_api = FakeTelegramApi(args.telegram_latency_ms / 1000, on_message=tracker.on_message)
+    gplinks = FakeGpLinks(args.gplinks_latency_ms / 1000)
+    telegram_api.start()
+    gplinks.start()
+
+    # Everything the app writes goes to a temporary directory which is removed afterwards
+    storage_path = tempfile.mkdtemp(prefix="load_harness_")
+    port = free_port()
+    env = dict(os.environ,
+               WEBSITE_HOSTNAME="load-harness.invalid", DEPLOYMENT_ID="load-harness",
+               ITSYOURAP_ECHO_TELEGRAM_BOT_TOKEN=ECHO_BOT_TOKEN,
+               ITSYOURAP_GPLINK_BYPASSER_TELEGRAM_BOT_TOKEN=GPLINKS_BOT_TOKEN,
+               DEVELOPER_MODE="false", DEVELOPER_TELEGRAM_CHANNEL_ID="@load_harness",
+               DEVELOPER_TELEGRAM_CHANNEL_LINK="https://t.me/load_harness",
+               TELEGRAM_API_URL=telegram_api.api_url, GPLINKS_SHORT_URL_ORIGIN=gplinks.origin,
+               GPLINKS_TRACK_URL=gplinks.track_url, GPLINKS_GO_URL=gplinks.go_url,
+               GPLINKS_GO_DELAY_SECONDS=str(args.go_delay),
+               STORAGE_PATH=storage_path, UPDATE_DEDUP_PATH=os.path.join(storage_path, "update_ids"),
+               PROMETHEUS_MULTIPROC_DIR=os.path.join(storage_path, "metrics"),
+               LOG_LEVEL="INFO")
+
+    # The update mix: (route, chat_id, body, final method)
+    rng = random.Random(args.seed)
+    updates = []
+    for index in range(args.requests):
+        chat_id = FIRST_CHAT_ID + index
+        if rng.random() < args.bypass_share:
+            link = index if args.distinct_links <= 0 else rng.randrange(args.distinct_links)
+            updates.append(("/gp-link-bypass", chat_id,
+                            message_update(index + 1, chat_id, "https://gplinks.co/load%06d" % link),
+                            "editMessageText"))
+        else:
+            updates.append(("/echo-bot", chat_id, message_update(index + 1, chat_id, "load test %d" % index),
+                            "sendMessage"))
+
+    process = None
+    try:
+        process = start_gunicorn(port, args.workers, args.threads, env,
+                                 log_path=os.path.join(storage_path, "gunicorn.log"), timeout_seconds=60)
+        worker_pids = child_pids(process.pid)
+
+        started_at = time.perf_counter()
+        webhook_latencies, failures = send_updates(port, updates, tracker, args.concurrency)
+        sent_at = time.perf_counter()
+        missing = tracker.wait(args.reply_timeout)
+        finished_at = max(tracker.last_reply_at, sent_at)
+
+        memory = {pid: process_memory_kib(pid) for pid in worker_pids if os.path.exists("/proc/%d" % pid)}
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        telegram_api.stop()
+        gplinks.stop()
+        shutil.rmtree(storage_path, ignore_errors=True)
+
+    answered = len(tracker.latencies)
+    duration = finished_at - started_at
+    results = {
+        "config": vars(args),
+        "webhook_latency": latency_summary(webhook_latencies),
+        "reply_latency": latency_summary(tracker.latencies),
+        "webhook_failures": failures,
+        "replies_missing": missing,
+        "reply_outcomes": tracker.outcomes,
+        "duration_seconds": round(duration, 3),
+        "webhooks_per_second": round(len(webhook_latencies) / (sent_at - started_at), 1),
+        "replies_per_second": round(answered / duration, 1),
+        "replies_per_second_per_worker": round(answered / duration / args.workers, 1),
+        "worker_memory_kib": memory,
+        "telegram_api_calls": telegram_api.calls,
+        "gplinks_calls": gplinks.calls,
+    }
+
+    print("%d updates, %d concurrent requests, %d workers x %d threads" % (
+        args.requests, args.concurrency, args.workers, args.threads))
+    print("%-20s %8s %10s %10s %10s %10s" % ("latency", "count", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for name in ("webhook_latency", "reply_latency"):
+        summary = results[name]
+        print("%-20s %8d %10s %10s %10s %10s" % (name, summary["count"], summary["p50_ms"], summary["p95_ms"],
+                                                 summary["p99_ms"], summary["max_ms"]))
+    print("throughput: %.1f webhooks/s, %.1f replies/s, %.1f replies/s per worker" % (
+        results["webhooks_per_second"], results["replies_per_second"], results["replies_per_second_per_worker"]))
+    print("replies: %s, missing %d, failed webhooks %s" % (tracker.outcomes, missing, failures or "none"))
+    for pid, pid_memory in memory.items():
+        print("worker %d: RSS %s KiB, peak RSS %s KiB" % (pid, pid_memory["rss_kib"], pid_memory["peak_rss_kib"]))
+
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# Local stand-ins for the Telegram Bot API and for GPLinks, used by load_harness.py
+# Both answer like the real services as far as the bots can tell, after a configurable latency
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import parse_qs, urlsplit
+
+# Saved go-link page served by the GPLinks stand-in, its ad_form_data is replaced with the alias of the short URL
+GO_LINK_PAGE_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "go_link_page.html")
+GO_LINK_PAGE_AD_FORM_DATA = b'name="ad_form_data" value="'
+
+# Where the GPLinks stand-in sends the bypassed links, e.g. https://example.com/<alias>
+BYPASSED_URL_BASE = "https://example.com/"
+
+
+# Request handler shared by both stand-ins, the server's route method answers every request
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, the bots reuse their connections
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _handle(self):
+        parts = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if body and self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(body)
+        else:
+            params = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+            params.update((key, values[-1]) for key, values in parse_qs(body.decode("utf-8")).items())
+
+        if self.server.latency_seconds > 0:
+            time.sleep(self.server.latency_seconds)
+        status, headers, content = self.server.route(parts.path, params)
+
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency_seconds: float):
+        super().__init__(("127.0.0.1", 0), StandInRequestHandler)
+        self.latency_seconds = latency_seconds
+        self._thread: threading.Thread | None = None
+
+    @property
+    def origin(self) -> str:
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    # Returns the status, the headers and the body of the response to the request
+    def route(self, path: str, params: dict) -> tuple[int, list[tuple[str, str]], bytes]:
+        raise NotImplementedError
+
+
+# Stand-in for api.telegram.org, point TELEGRAM_API_URL at api_url
+# Every sent or edited message is passed to on_message(method, chat_id, text, time.perf_counter())
+class FakeTelegramApi(StandInServer):
+    def __init__(self, latency_seconds: float, on_message: Callable[[str, int, str, float], None]):
+        super().__init__(latency_seconds)
+        self.on_message = on_message
+
+        self._lock = threading.Lock()
+        self._next_message_id = 1
+        self._webhooks: dict[str, dict] = {}
+
+        # Counters for the report
+        self.calls: dict[str, int] = {}
+
+    @property
+    def api_url(self) -> str:
+        return self.origin + "/bot{0}/{1}"
+
+    def route(self, path: str, params: dict) -> tuple[int, list[tuple[str, str]], bytes]:
+        # /bot<token>/<method>
+        _, token, method = path.split("/", 2)
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            self.on_message(method, chat_id, params.get("text", ""), time.perf_counter())
+            with self._lock:
+                message_id = int(params.get("message_id") or 0) or self._next_message_id
+                self._next_message_id += 1
+            result = {"message_id": message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        elif method == "getChatMember":
+            user_id = int(params["user_id"])
+            result = {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "User"}}
+        elif method == "getWebhookInfo":
+            webhook = self._webhooks.get(token, {})
+            result = {"url": webhook.get("url", ""), "has_custom_certificate": False, "pending_update_count": 0}
+            if webhook.get("allowed_updates"):
+                result["allowed_updates"] = webhook["allowed_updates"]
+        elif method == "setWebhook":
+            allowed_updates = params.get("allowed_updates")
+            if isinstance(allowed_updates, str):
+                allowed_updates = json.loads(allowed_updates)
+            self._webhooks[token] = {"url": params.get("url", ""), "allowed_updates": allowed_updates}
+            result = True
+        elif method == "deleteWebhook":
+            self._webhooks.pop(token, None)
+            result = True
+        elif method == "deleteMessage":
+            result = True
+        else:
+            return 404, [("Content-Type", "application/json")], json.dumps(
+                {"ok": False, "error_code": 404, "description": "Not Found: method not found"}).encode()
+        return 200, [("Content-Type", "application/json")], json.dumps({"ok": True, "result": result}).encode()
+
+
+# Stand-in for the GPLinks pages which gplinks_bypass walks through, point GPLINKS_SHORT_URL_ORIGIN at origin
+#   GET  /<alias>            redirect with the visitor id (vid)
+#   POST /track/data.php     visitor tracking
+#   GET  /<alias>/?vid=...   go-link page with the form
+#   POST /links/go           the bypassed link as JSON
+class FakeGpLinks(StandInServer):
+    def __init__(self, latency_seconds: float):
+        super().__init__(latency_seconds)
+        with open(GO_LINK_PAGE_PATH, "rb") as page:
+            self._page_head, _, tail = page.read().partition(GO_LINK_PAGE_AD_FORM_DATA)
+        self._page_tail = tail[tail.index(b'"'):]
+
+        self._lock = threading.Lock()
+        self._next_vid = 1
+
+        # Counters for the report
+        self.calls: dict[str, int] = {}
+
+    @property
+    def track_url(self) -> str:
+        return self.origin + "/track/data.php"
+
+    @property
+    def go_url(self) -> str:
+        return self.origin + "/links/go"
+
+    def _count(self, name: str):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def route(self, path: str, params: dict) -> tuple[int, list[tuple[str, str]], bytes]:
+        if path == "/track/data.php":
+            self._count("track")
+            return 200, [("Content-Type", "application/json")], b'{"status":"success"}'
+
+        if path == "/links/go":
+            self._count("go")
+            url = BYPASSED_URL_BASE + params.get("ad_form_data", "")
+            return 200, [("Content-Type", "application/json")], json.dumps(
+                {"status": "success", "message": "Go without Earn because anonymous user", "url": url}).encode()
+
+        alias = path.strip("/")
+        if "vid" in params:
+            self._count("page")
+            return 200, [("Content-Type", "text/html; charset=UTF-8")], \
+                self._page_head + GO_LINK_PAGE_AD_FORM_DATA + alias.encode() + self._page_tail
+
+        self._count("redirect")
+        with self._lock:
+            vid = self._next_vid
+            self._next_vid += 1
+        return 302, [("Location", "%s/%s?pid=1&vid=%d" % (self.origin, alias, vid))], b""
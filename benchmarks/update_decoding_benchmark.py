@@ -0,0 +1,76 @@
+# Compares the webhook update decoding of update_decoding.py with the Update.de_json decoding it replaced,
+# on the recorded update payloads in fixtures/update_corpus.jsonl (one webhook request body per line)
+# Run from the repository root: python -m benchmarks.update_decoding_benchmark
+import argparse
+import json
+import os
+import timeit
+from telebot.types import Update
+from telegram_bots import update_decoding
+from telegram_bots.update_decoding import DecodedUpdate, decode_update
+from telegram_bots.update_executor import update_chat_key
+
+# Recorded webhook request bodies used as benchmark input
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "update_corpus.jsonl")
+
+
+# The previous request path: decode the body to a str and build the whole Update in the request thread
+def decode_with_de_json(body: bytes) -> tuple:
+    update = Update.de_json(body.decode('utf-8'))
+    return update.update_id, update_chat_key(update)
+
+
+# What the request thread does now, the Update is built later by the worker which runs the handlers
+def decode_routing_fields(body: bytes) -> tuple:
+    update = decode_update(body)
+    return update.update_id, update.chat_key
+
+
+# Request thread and worker together, for updates which do reach the handlers
+def decode_and_materialize(body: bytes) -> tuple:
+    update = decode_update(body)
+    return update.update_id, update.chat_key, update.update
+
+
+# Same as decode_routing_fields with the standard library parser, as used when orjson is not installed
+def decode_routing_fields_with_json(body: bytes) -> tuple:
+    update = DecodedUpdate(json.loads(body))
+    return update.update_id, update.chat_key
+
+
+# Returns the best time of decoding the whole corpus once, in seconds
+def best_time_seconds(decode, bodies: list[bytes], number: int) -> float:
+    return min(timeit.repeat(lambda: [decode(body) for body in bodies], number=number, repeat=5)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the lazy webhook update decoding with Update.de_json")
+    parser.add_argument("--number", type=int, default=200, help="Passes over the corpus per timing run")
+    args = parser.parse_args()
+
+    with open(CORPUS_PATH, "rb") as corpus:
+        bodies = [line.rstrip(b"\n") for line in corpus if line.strip()]
+
+    # The lazy decoding has to route every update like the Update it replaces before its timings mean anything
+    for body in bodies:
+        expected = decode_with_de_json(body)
+        decoded = decode_update(body)
+        assert (decoded.update_id, decoded.chat_key) == expected, "%r != %r" % ((decoded.update_id, decoded.chat_key),
+                                                                             expected)
+        assert update_chat_key(decoded.update) == expected[1]
+
+    print("%d updates, %d bytes on average, parser: %s" % (
+        len(bodies), sum(map(len, bodies)) // len(bodies), "orjson" if update_decoding.orjson else "json"))
+    reference_time = best_time_seconds(decode_with_de_json, bodies, args.number)
+    print("%-36s %12s %8s" % ("decoding", "us/update", "speedup"))
+    for name, decode in (("Update.de_json (reference)", decode_with_de_json),
+                         ("routing fields, json", decode_routing_fields_with_json),
+                         ("routing fields", decode_routing_fields),
+                         ("routing fields + Update", decode_and_materialize)):
+        decode_time = reference_time if decode is decode_with_de_json else best_time_seconds(decode, bodies,
+                                                                                              args.number)
+        print("%-36s %12.2f %7.1fx" % (name, decode_time / len(bodies) * 1e6, reference_time / decode_time))
+
+
+if __name__ == "__main__":
+    main()
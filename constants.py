@@ -1,6 +1,8 @@
 import os
+import tempfile
 from datetime import datetime
 import pytz
+from log_files import LOG_TIMEZONE_NAME, STORAGE_PATH, DEFAULT_LOG_PATH
 
 # All os.getenv(key, defaultValue) statements will return the value of environmental variable associated with the key
 # If no environmental variable is declared with the key as name, defaultValue will be returned
@@ -8,13 +10,12 @@ import pytz
 # Go to Azure WebApp > Configuration > Application Settings and define your environmental variables
 
 # Asia/Kolkata Timezone for logging time
-TIMEZONE = pytz.timezone('Asia/Kolkata')
+TIMEZONE = pytz.timezone(LOG_TIMEZONE_NAME)
 
 
 # Developer Mode (for Server)
-def in_developer_mode() -> bool:
-    return os.getenv('DEVELOPER_MODE', 'False').lower() in ['true', '1', 't', 'y']
-
+# Read once at startup, the environment of a running server does not change
+DEVELOPER_MODE: bool = os.getenv('DEVELOPER_MODE', 'False').lower() in ['true', '1', 't', 'y']
 
 DEVELOPER_TELEGRAM_USERNAME: str = os.getenv('DEVELOPER_NAME', 'mefr')
 DEVELOPER_TELEGRAM_LINK: str = os.getenv('DEVELOPER_TELEGRAM', '@Anonyadmin')
@@ -27,10 +28,153 @@ WEBHOOK_HOST = os.getenv('WEBSITE_HOSTNAME')  # Azure Web App has it autoconfigu
 WEBHOOK_PORT = 443  # 443, 80, 8000, 8080 or 8443 (port needs to be open to the internet)
 WEBHOOK_URL_BASE = "https://%s:%s" % (WEBHOOK_HOST, WEBHOOK_PORT)  # Base URL of the Webhook
 
+# Service URL Constants
+# Only changed to point the bots at local stand-ins, e.g. by the offline load benchmark (benchmarks/load_harness.py)
+TELEGRAM_API_URL: str = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot{0}/{1}')  # {0} token, {1} method
+GPLINKS_SHORT_URL_ORIGIN: str | None = os.getenv('GPLINKS_SHORT_URL_ORIGIN')  # Fetch gplinks.co/xxx from this origin
+GPLINKS_TRACK_URL: str = os.getenv('GPLINKS_TRACK_URL', 'https://gplinks.in/track/data.php')
+GPLINKS_GO_URL: str = os.getenv('GPLINKS_GO_URL', 'https://gplinks.co/links/go')
+GPLINKS_GO_DELAY_SECONDS: float = float(os.getenv('GPLINKS_GO_DELAY_SECONDS', '1'))  # Wait before links/go
+
+# Webhook Registration Constants
+# The webhooks are registered once per deployment, by the first worker process that starts
+# Change DEPLOYMENT_ID (or delete STORAGE_PATH/webhook_registration.json) to make the next start check them again
+DEPLOYMENT_ID: str = os.getenv('DEPLOYMENT_ID', '')
+WEBHOOK_REGISTRATION_LOCK_TIMEOUT_SECONDS: int = int(os.getenv('WEBHOOK_REGISTRATION_LOCK_TIMEOUT_SECONDS', '60'))
+
+# Webhook Update Dispatch Constants
+# "queued" acknowledges the webhook immediately and runs the handlers on a background worker pool
+# "inline" runs the handlers inside the webhook request (the webhook responds only after the bot has replied)
+WEBHOOK_DISPATCH_MODE: str = os.getenv('WEBHOOK_DISPATCH_MODE', 'queued').lower()
+UPDATE_WORKER_POOL_SIZE: int = int(os.getenv('UPDATE_WORKER_POOL_SIZE', '8'))  # Threads running update handlers
+UPDATE_QUEUE_MAX_DEPTH: int = int(os.getenv('UPDATE_QUEUE_MAX_DEPTH', '256'))  # Max queued + running updates
+
+# Update Deduplication Constants
+# Telegram redelivers an update if the webhook does not answer in time, the update_ids of the last
+# UPDATE_DEDUP_CAPACITY updates of every bot are remembered so that a redelivered update is handled only once (0 = off)
+# The file is shared by the worker processes of this machine, keep it on a local disk (not on a network share)
+UPDATE_DEDUP_CAPACITY: int = int(os.getenv('UPDATE_DEDUP_CAPACITY', '4096'))
+UPDATE_DEDUP_PATH: str = os.getenv('UPDATE_DEDUP_PATH', os.path.join(tempfile.gettempdir(), "telegram_update_ids"))
+
+# Long Polling Constants (only used when running the bots with polling.py instead of webhooks)
+# Larger batches and longer timeouts drain a backlog with fewer requests, smaller ones answer single messages sooner
+POLLING_BATCH_SIZE: int = int(os.getenv('POLLING_BATCH_SIZE', '100'))  # Updates per getUpdates call (1-100)
+POLLING_CONCURRENCY: int = int(os.getenv('POLLING_CONCURRENCY', '16'))  # Threads running update handlers
+POLLING_TIMEOUT_SECONDS: int = int(os.getenv('POLLING_TIMEOUT_SECONDS', '25'))  # Long polling timeout of getUpdates
+
+# Bot API Connection Constants
+# Number of keep-alive connections to api.telegram.org shared by all the bots of a worker process
+BOT_API_CONNECTION_POOL_SIZE: int = int(os.getenv('BOT_API_CONNECTION_POOL_SIZE', '16'))
+
+# Outbound Send Constants
+# Replies are sent by SEND_WORKERS threads shared by all the bots, the handlers only queue them
+# Telegram allows a bot about 30 messages per second and about 1 message per second in a chat (short bursts are fine)
+SEND_WORKERS: int = int(os.getenv('SEND_WORKERS', '4'))
+SEND_QUEUE_MAX_DEPTH: int = int(os.getenv('SEND_QUEUE_MAX_DEPTH', '1000'))  # Beyond it the handler sends by itself
+SEND_GLOBAL_PER_SECOND: float = float(os.getenv('SEND_GLOBAL_PER_SECOND', '30'))  # Messages per bot and second
+SEND_CHAT_PER_SECOND: float = float(os.getenv('SEND_CHAT_PER_SECOND', '1'))  # Messages per chat and second
+SEND_CHAT_BURST: int = int(os.getenv('SEND_CHAT_BURST', '3'))  # Messages a chat can get at once
+SEND_MAX_RETRIES: int = int(os.getenv('SEND_MAX_RETRIES', '3'))  # Retries of a call answered with 429
+
+# Async Runtime Constants (only used when serving the bots with asgi.py)
+ASYNC_MAX_CONCURRENT_UPDATES: int = int(os.getenv('ASYNC_MAX_CONCURRENT_UPDATES', '500'))  # Running update handlers
+ASYNC_SCRAPER_CONNECTION_LIMIT: int = int(os.getenv('ASYNC_SCRAPER_CONNECTION_LIMIT', '100'))  # Scraping connections
+
 # Files and Log Storage Constants
-STORAGE_PATH = os.getenv('STORAGE_PATH', os.path.join(os.getcwd(), "files"))  # Main Storage for Program Outputs
-DEFAULT_LOG_PATH = os.path.join(STORAGE_PATH, "logs")  # Subdirectory for storing logs
+# STORAGE_PATH (main storage for program outputs) and DEFAULT_LOG_PATH (its logs subdirectory) are set in log_files.py
 DEFAULT_LOG_FILE_NAME = "log_%s.log" % datetime.now(tz=TIMEZONE).strftime("%d-%m-%Y")  # log_01-01-1970.log
+LOG_LEVEL: str = os.getenv('LOG_LEVEL', 'DEBUG').upper()  # Records below this level are dropped before formatting
+
+# Resolved Link Cache Constants
+# "memory" keeps the cache per worker process, "sqlite" shares it between workers through a file in STORAGE_PATH
+# (Use "sqlite" only if STORAGE_PATH is on a local disk, SQLite WAL mode does not work on network shares)
+LINK_CACHE_BACKEND: str = os.getenv('LINK_CACHE_BACKEND', 'memory').lower()
+LINK_CACHE_TTL_SECONDS: int = int(os.getenv('LINK_CACHE_TTL_SECONDS', str(24 * 60 * 60)))
+LINK_CACHE_MAX_ENTRIES: int = int(os.getenv('LINK_CACHE_MAX_ENTRIES', '10000'))
+
+# Channel Membership Cache Constants
+# Subscribed users are cached longer than unsubscribed users, who are expected to join the channel soon
+# The cache is per worker process and a chat_member update only reaches one worker, so the other workers notice that
+# a user left (or joined) the channel only once their entry expires, the TTLs are the bound on that staleness
+MEMBERSHIP_CACHE_POSITIVE_TTL_SECONDS: int = int(os.getenv('MEMBERSHIP_CACHE_POSITIVE_TTL_SECONDS', '60'))
+MEMBERSHIP_CACHE_NEGATIVE_TTL_SECONDS: int = int(os.getenv('MEMBERSHIP_CACHE_NEGATIVE_TTL_SECONDS', '30'))
+MEMBERSHIP_CACHE_MAX_ENTRIES: int = int(os.getenv('MEMBERSHIP_CACHE_MAX_ENTRIES', '50000'))
+
+# Bypass Scheduling Constants
+# Bypasses run on BYPASS_WORKERS threads taking turns between the chats, at most BYPASS_QUEUE_MAX_PENDING wait
+# (Users get a "busy" reply when the job queue below is full and a "slow down" reply when they exceed their rate limit)
+BYPASS_WORKERS: int = int(os.getenv('BYPASS_WORKERS', '8'))
+BYPASS_QUEUE_MAX_PENDING: int = int(os.getenv('BYPASS_QUEUE_MAX_PENDING', '100'))
+CHAT_RATE_LIMIT_PER_MINUTE: float = float(os.getenv('CHAT_RATE_LIMIT_PER_MINUTE', '6'))  # Bypasses per chat and minute
+CHAT_RATE_LIMIT_BURST: int = int(os.getenv('CHAT_RATE_LIMIT_BURST', '5'))  # Bypasses a chat can send at once
+
+# Bypass Retry Constants
+# A bypass is tried up to BYPASS_MAX_ATTEMPTS times with a jittered exponential backoff between the attempts,
+# no attempt is started once BYPASS_DEADLINE_SECONDS have passed since the first one
+# After BYPASS_BREAKER_FAILURE_THRESHOLD failed bypasses in a row, GPLinks is considered down and every bypass fails
+# fast for BYPASS_BREAKER_RESET_SECONDS, then a single bypass probes whether it is back (see retry_policy.py)
+BYPASS_MAX_ATTEMPTS: int = int(os.getenv('BYPASS_MAX_ATTEMPTS', '9'))
+BYPASS_DEADLINE_SECONDS: float = float(os.getenv('BYPASS_DEADLINE_SECONDS', '45'))
+BYPASS_BACKOFF_BASE_SECONDS: float = float(os.getenv('BYPASS_BACKOFF_BASE_SECONDS', '0.5'))
+BYPASS_BACKOFF_MAX_SECONDS: float = float(os.getenv('BYPASS_BACKOFF_MAX_SECONDS', '8'))
+BYPASS_BREAKER_FAILURE_THRESHOLD: int = int(os.getenv('BYPASS_BREAKER_FAILURE_THRESHOLD', '5'))
+BYPASS_BREAKER_RESET_SECONDS: float = float(os.getenv('BYPASS_BREAKER_RESET_SECONDS', '60'))
+
+# Multi-Link Message Constants
+# A message (or a caption) may contain up to MULTI_LINK_MAX_LINKS gplinks.co links, further links are ignored
+# MULTI_LINK_CONCURRENCY links of a message are resolved at the same time, the reply is edited as they finish
+MULTI_LINK_MAX_LINKS: int = int(os.getenv('MULTI_LINK_MAX_LINKS', '10'))
+MULTI_LINK_CONCURRENCY: int = int(os.getenv('MULTI_LINK_CONCURRENCY', '3'))
+# The links of such messages are resolved on MULTI_LINK_WORKERS threads of their own, the bypass worker of the message
+# only waits for them
+MULTI_LINK_WORKERS: int = int(os.getenv('MULTI_LINK_WORKERS', str(BYPASS_WORKERS)))
+
+# Scraper Session Pool Constants
+# Sessions used for bypassing are reused, but recycled after a number of uses, after some time or after a failure
+# Both the bypass workers and the multi-link workers take a session for every bypass, so the pool has a session for
+# each of them (BYPASS_WORKERS + MULTI_LINK_WORKERS), a smaller pool makes bypasses wait up to
+# SCRAPER_POOL_CHECKOUT_TIMEOUT_SECONDS and then answer "busy"
+SCRAPER_POOL_SIZE: int = int(os.getenv('SCRAPER_POOL_SIZE', str(BYPASS_WORKERS + MULTI_LINK_WORKERS)))
+SCRAPER_SESSION_MAX_USES: int = int(os.getenv('SCRAPER_SESSION_MAX_USES', '50'))
+SCRAPER_SESSION_MAX_AGE_SECONDS: int = int(os.getenv('SCRAPER_SESSION_MAX_AGE_SECONDS', '900'))
+SCRAPER_POOL_CHECKOUT_TIMEOUT_SECONDS: int = int(os.getenv('SCRAPER_POOL_CHECKOUT_TIMEOUT_SECONDS', '30'))
+
+# Bypass Job Queue Constants
+# Bypasses are stored in BYPASS_JOB_QUEUE_PATH until they are done, so that the bypasses interrupted by a restart
+# are run again and their "Processing..." message is edited with the result after all
+# Every worker takes up to BYPASS_JOB_BATCH_SIZE jobs at a time and keeps them leased while it works on them
+# It has to survive a recycled instance or container, so it is kept in STORAGE_PATH (Azure's persistent /home share)
+# WAL mode needs shared memory, which network shares do not provide, so the queue uses the DELETE (rollback) journal
+# by default, set BYPASS_JOB_QUEUE_JOURNAL_MODE to WAL if BYPASS_JOB_QUEUE_PATH is on a persistent local disk
+BYPASS_JOB_QUEUE_PATH: str = os.getenv('BYPASS_JOB_QUEUE_PATH', os.path.join(STORAGE_PATH, "bypass_jobs.sqlite3"))
+BYPASS_JOB_QUEUE_JOURNAL_MODE: str = os.getenv('BYPASS_JOB_QUEUE_JOURNAL_MODE', 'DELETE').upper()
+BYPASS_JOB_MAX_UNFINISHED: int = int(os.getenv('BYPASS_JOB_MAX_UNFINISHED', '500'))  # Of all the workers together
+BYPASS_JOB_BATCH_SIZE: int = int(os.getenv('BYPASS_JOB_BATCH_SIZE', '16'))
+BYPASS_JOB_LEASE_SECONDS: int = int(os.getenv('BYPASS_JOB_LEASE_SECONDS', '60'))  # Renewed while the job runs
+BYPASS_JOB_POLL_INTERVAL_SECONDS: float = float(os.getenv('BYPASS_JOB_POLL_INTERVAL_SECONDS', '1'))
+BYPASS_JOB_MAX_ATTEMPTS: int = int(os.getenv('BYPASS_JOB_MAX_ATTEMPTS', '3'))  # Then the user gets the error reply
+
+# Metrics Constants
+# /metrics reports Prometheus metrics summed over all the gunicorn workers (see telegram_bots/metrics.py)
+# Every worker writes its values to files in METRICS_PATH, which gunicorn.conf.py clears when gunicorn starts
+# (Keep it on a local disk, not on a network share)
+METRICS_PATH: str = os.getenv('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), "telegram_bots_metrics"))
+METRICS_TOKEN: str | None = os.getenv('METRICS_TOKEN')  # /metrics needs "Authorization: Bearer <token>", 404 if unset
+
+# Static Asset Constants
+# The landing page and the static files are built once into STATIC_BUILD_PATH (see static_assets.py)
+# (Keep it on a local disk, the files are sent with sendfile())
+STATIC_BUILD_PATH: str = os.getenv('STATIC_BUILD_PATH', os.path.join(tempfile.gettempdir(), "telegram_bots_static"))
+
+# Profiler Constants
+# /admin/profile profiles the worker which receives the request (see telegram_bots/profiler.py)
+# It is only served if PROFILER_TOKEN is set, and needs "Authorization: Bearer <token>"
+PROFILER_TOKEN: str | None = os.getenv('PROFILER_TOKEN')
+PROFILES_PATH: str = os.getenv('PROFILES_PATH', os.path.join(STORAGE_PATH, "profiles"))
+PROFILER_SAMPLE_INTERVAL_SECONDS: float = float(os.getenv('PROFILER_SAMPLE_INTERVAL_SECONDS', '0.01'))
+PROFILER_MAX_SECONDS: int = int(os.getenv('PROFILER_MAX_SECONDS', '300'))
+PROFILER_TRACEMALLOC_FRAMES: int = int(os.getenv('PROFILER_TRACEMALLOC_FRAMES', '16'))
+PROFILER_TOP_ALLOCATIONS: int = int(os.getenv('PROFILER_TOP_ALLOCATIONS', '30'))
 
 
 # For customising logging timezone
@@ -0,0 +1,15 @@
+# gunicorn loads this file from the working directory, also when it is started as "gunicorn app:app" (e.g. on Azure)
+# Only the hooks are set here, everything else comes from the command line
+from static_assets import build_static_assets
+from telegram_bots.metrics import clear_metrics, worker_exited
+
+
+# The metric files of the workers of an earlier run would otherwise be added to the new values
+# The static files are built once here instead of by every worker
+def on_starting(server):
+    clear_metrics()
+    build_static_assets()
+
+
+def child_exit(server, worker):
+    worker_exited(worker.pid)
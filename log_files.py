@@ -0,0 +1,24 @@
+import gzip
+import os
+import shutil
+
+# Settings and helpers of the log files which need nothing but the standard library
+# analytics_query.py uses them without importing constants.py, which needs the environment of the bots
+# (constants.py and telegram_bots/bot_logging.py take them from here)
+
+# Logging timezone, the rotated log files are named after the day in this timezone
+LOG_TIMEZONE_NAME = 'Asia/Kolkata'
+
+STORAGE_PATH = os.getenv('STORAGE_PATH', os.path.join(os.getcwd(), "files"))  # Main Storage for Program Outputs
+DEFAULT_LOG_PATH = os.path.join(STORAGE_PATH, "logs")  # Subdirectory for storing logs
+
+
+# Compresses a rotated log file to <path>.gz and removes the uncompressed file
+# The archive is written to a temporary file first, so a half written .gz is never picked up by analytics_query.py
+def compress_log_file(path: str):
+    compressed_path = path + ".gz"
+    temporary_path = compressed_path + ".tmp"
+    with open(path, "rb") as source, gzip.open(temporary_path, "wb") as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+    os.replace(temporary_path, compressed_path)
+    os.remove(path)
@@ -0,0 +1,34 @@
+import signal
+from constants import BOT_API_CONNECTION_POOL_SIZE, POLLING_CONCURRENCY
+from telegram_bots.bot_api_session import configure_shared_bot_api_session
+from telegram_bots.polling_runner import PollingRunner
+from telegram_bots.registry import TELEGRAM_BOTS
+
+# Runs the bots with getUpdates long polling instead of webhooks (alternative to app.py and asgi.py)
+# No public HTTPS endpoint is needed, so it also works on a local machine, and it drains a backlog in large batches
+# Run it with
+#   python polling.py
+# Batch size, concurrency and long polling timeout are set in constants.py (POLLING_*)
+# Note: Starting it removes the webhooks of the bots, app.py registers them again on its next start
+
+
+def main():
+    runner = PollingRunner()
+    for telegram_bot in TELEGRAM_BOTS:
+        telegram_bot.register_polling(runner=runner)
+
+    # Every bot keeps a long polling request open besides the requests sent by the handlers
+    configure_shared_bot_api_session(pool_size=max(BOT_API_CONNECTION_POOL_SIZE,
+                                                   POLLING_CONCURRENCY + len(runner.bots)))
+
+    # Finish and commit the batches being handled on Ctrl+C or when the process is asked to stop
+    # (Stopping can take up to POLLING_TIMEOUT_SECONDS since the long polling requests are not interrupted)
+    signal.signal(signal.SIGINT, lambda signum, frame: runner.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: runner.stop())
+
+    runner.start()
+    runner.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+from jinja2 import Environment, FileSystemLoader
+from constants import STATIC_BUILD_PATH
+
+# brotli is optional, without it only gzip variants are built
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Builds the static assets of the landing page once, so that serving them costs the workers next to nothing:
+# - every file in static/ is copied under a content-hashed name (css/index.min.<hash>.css), which can be cached
+#   forever since a changed file gets a new name, and also kept under its own name for old links
+# - text-like files get .gz and .br variants, compressed once with the highest levels
+# - templates/index.html is rendered once with the hashed URLs
+# The result and a manifest.json describing it are written to STATIC_BUILD_PATH
+# Run "python static_assets.py" during the deployment, gunicorn.conf.py and asgi.py also build it at startup
+# if the build of the current files is missing
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+STATIC_PATH = os.path.join(ROOT_PATH, 'static')
+TEMPLATES_PATH = os.path.join(ROOT_PATH, 'templates')
+
+# Only these are worth compressing, images like PNG or JPEG are compressed already
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml',
+                      'image/vnd.microsoft.icon', 'image/x-icon')
+
+# Hashed files never change, everything else has to be revalidated with its ETag
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "public, no-cache"
+
+# Preferred first
+ENCODINGS = ('br', 'gzip')
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+MANIFEST_NAME = "manifest.json"
+
+
+# A file of the build in one encoding
+class AssetVariant:
+    def __init__(self, path: str, etag: str, size: int):
+        self.path = path
+        self.etag = etag
+        self.size = size
+
+
+# A URL path served from the build, e.g. /static/css/index.min.<hash>.css
+class StaticAsset:
+    def __init__(self, content_type: str, cache_control: str, variants: dict[str | None, AssetVariant]):
+        self.content_type = content_type
+        self.cache_control = cache_control
+
+        # Encoding (None for the uncompressed file) -> variant
+        self.variants = variants
+
+    # The smallest variant the client accepts according to its Accept-Encoding header
+    # Returns the encoding (None for the uncompressed file) and the variant
+    def negotiate(self, accept_encoding: str | None) -> tuple[str | None, AssetVariant]:
+        if accept_encoding:
+            # Coding -> whether it is acceptable, i.e. not refused with q=0
+            # A coding named explicitly wins over "*", so "br;q=0, *" accepts everything but br
+            acceptable = {}
+            for part in accept_encoding.split(","):
+                coding, _, parameters = part.strip().partition(";")
+                acceptable[coding.strip().lower()] = quality(parameters) > 0
+            for encoding in ENCODINGS:
+                if encoding in self.variants and acceptable.get(encoding, acceptable.get("*", False)):
+                    return encoding, self.variants[encoding]
+        return None, self.variants[None]
+
+    # The headers of a response with the variant, without the Content-Length
+    def headers(self, encoding: str | None, variant: AssetVariant) -> list[tuple[str, str]]:
+        headers = [("Cache-Control", self.cache_control), ("ETag", variant.etag)]
+        if len(self.variants) > 1:
+            headers.append(("Vary", "Accept-Encoding"))
+        if encoding is not None:
+            headers.append(("Content-Encoding", encoding))
+        return headers
+
+
+# The q value of the parameters of an Accept-Encoding entry, e.g. 0.5 for "q=0.5", 1 without one
+def quality(parameters: str) -> float:
+    for parameter in parameters.split(";"):
+        name, _, value = parameter.strip().partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return float(value)
+            except ValueError:
+                return 0
+    return 1
+
+
+# True if the If-None-Match header of the request matches the ETag, i.e. the client has the file already
+def not_modified(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison, W/"x" matches "x"
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()[:16]
+
+
+# Writes the file atomically, workers building at the same time write the same content
+def write_file(path: str, content: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temporary_path, "wb") as file:
+        file.write(content)
+    os.replace(temporary_path, path)
+
+
+def compressed_variants(content: bytes, content_type: str) -> dict[str, bytes]:
+    if not content_type.startswith(COMPRESSIBLE_TYPES):
+        return {}
+    variants = {'gzip': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(content, quality=11)
+    # A variant which is not smaller than the file is not worth the Content-Encoding
+    return {encoding: compressed for encoding, compressed in variants.items() if len(compressed) < len(content)}
+
+
+# Writes the file and its compressed variants to the build, returns the manifest entry
+def build_file(build_path: str, name: str, content: bytes, content_type: str, cache_control: str) -> dict:
+    digest = content_hash(content)
+    write_file(os.path.join(build_path, name), content)
+    entry = {"content_type": content_type, "cache_control": cache_control,
+             "variants": {"identity": {"file": name, "etag": '"%s"' % digest, "size": len(content)}}}
+    for encoding, compressed in compressed_variants(content, content_type).items():
+        file_name = name + ENCODING_SUFFIXES[encoding]
+        write_file(os.path.join(build_path, file_name), compressed)
+        entry["variants"][encoding] = {"file": file_name, "etag": '"%s-%s"' % (digest, encoding),
+                                       "size": len(compressed)}
+    return entry
+
+
+# Identifies the sources of a build, a build with another key is outdated
+def source_key() -> str:
+    digest = hashlib.sha256(b"brotli" if brotli is not None else b"gzip")
+    for directory in (STATIC_PATH, TEMPLATES_PATH):
+        for folder, _, file_names in sorted(os.walk(directory)):
+            for file_name in sorted(file_names):
+                path = os.path.join(folder, file_name)
+                digest.update(os.path.relpath(path, ROOT_PATH).encode())
+                with open(path, "rb") as file:
+                    digest.update(file.read())
+    return digest.hexdigest()[:16]
+
+
+# Builds the assets into build_path/<source key>, returns the path of the manifest
+def build_static_assets(build_path: str = STATIC_BUILD_PATH) -> str:
+    key = source_key()
+    output_path = os.path.join(build_path, key)
+    manifest_path = os.path.join(output_path, MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        return manifest_path
+
+    assets = {}
+    hashed_urls = {}
+    for folder, _, file_names in sorted(os.walk(STATIC_PATH)):
+        for file_name in sorted(file_names):
+            path = os.path.join(folder, file_name)
+            name = os.path.relpath(path, STATIC_PATH).replace(os.sep, "/")
+            with open(path, "rb") as file:
+                content = file.read()
+            content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+            if name == "favicon.ico":
+                content_type = 'image/vnd.microsoft.icon'
+
+            stem, extension = os.path.splitext(name)
+            hashed_name = "%s.%s%s" % (stem, content_hash(content), extension)
+            entry = build_file(output_path, "static/" + hashed_name, content, content_type, IMMUTABLE_CACHE_CONTROL)
+            assets["/static/" + hashed_name] = entry
+            assets["/static/" + name] = dict(entry, cache_control=REVALIDATE_CACHE_CONTROL)
+            hashed_urls[name] = "/static/" + hashed_name
+    if "favicon.ico" in hashed_urls:
+        assets["/favicon.ico"] = assets["/static/favicon.ico"]
+
+    # The landing page with the hashed URLs, same as rendering it with Flask's url_for for the static endpoint
+    templates = Environment(loader=FileSystemLoader(TEMPLATES_PATH), autoescape=True)
+    templates.globals['url_for'] = lambda endpoint, filename: hashed_urls.get(filename, "/static/" + filename)
+    index_html = templates.get_template('index.html').render().encode('utf-8')
+    assets["/"] = build_file(output_path, "index.html", index_html, 'text/html; charset=utf-8',
+                             REVALIDATE_CACHE_CONTROL)
+
+    write_file(manifest_path, json.dumps({"source_key": key, "assets": assets}, indent=1).encode())
+    return manifest_path
+
+
+# Reads the build of the current sources (building it first if needed), returns URL path -> StaticAsset
+def load_static_assets(build_path: str = STATIC_BUILD_PATH) -> dict[str, StaticAsset]:
+    manifest_path = build_static_assets(build_path)
+    output_path = os.path.dirname(manifest_path)
+    with open(manifest_path, "rb") as file:
+        manifest = json.load(file)
+
+    assets = {}
+    for url_path, entry in manifest["assets"].items():
+        variants = {None if encoding == "identity" else encoding:
+                    AssetVariant(os.path.join(output_path, variant["file"]), variant["etag"], variant["size"])
+                    for encoding, variant in entry["variants"].items()}
+        assets[url_path] = StaticAsset(entry["content_type"], entry["cache_control"], variants)
+    return assets
+
+
+if __name__ == "__main__":
+    print(build_static_assets(sys.argv[1] if len(sys.argv) > 1 else STATIC_BUILD_PATH))
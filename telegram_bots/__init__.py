@@ -1,16 +1,22 @@
 from abc import ABC, abstractmethod
-from flask import Flask
+from typing import TYPE_CHECKING
+
+# The async runtime is optional, see asgi.py
+if TYPE_CHECKING:
+    from telegram_bots.async_runtime import AsgiApp
+    from telegram_bots.polling_runner import PollingRunner
+    from telegram_bots.webhook_dispatcher import WebhookDispatcher
 
 
 # Common abstract class containing method skeleton for all TelegramBots
 # Every TelegramBot should extend this class and implement the methods.
 # The methods will be called in sequential order as declared here
 class TelegramBot(ABC):
-    # Implement this to register the route for the webhook URL
+    # Implement this to add the bot to the webhook dispatcher under the path token of its webhook URL
     # Telegram will send POST request to this route of this server when your bot receives a message
     @staticmethod
     @abstractmethod
-    def register_route(flask_app: Flask):
+    def register_route(dispatcher: "WebhookDispatcher"):
         pass
 
     # Implement this to register the webhook of the bot with Telegram API
@@ -18,3 +24,20 @@ class TelegramBot(ABC):
     @abstractmethod
     def register_webhook():
         pass
+
+    # Override this to register the route for the webhook URL on the async runtime (see asgi.py)
+    # Bots which don't override it are not served by the async runtime
+    @staticmethod
+    def register_async_route(asgi_app: "AsgiApp"):
+        pass
+
+    # Override this to register the webhook of the bot with Telegram API from the async runtime
+    @staticmethod
+    async def register_async_webhook():
+        pass
+
+    # Override this to add the bot to the long-polling runner (see polling.py)
+    # Bots which don't override it are not run by the long-polling runner
+    @staticmethod
+    def register_polling(runner: "PollingRunner"):
+        pass
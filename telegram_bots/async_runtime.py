@@ -0,0 +1,240 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Hashable, TYPE_CHECKING
+from telebot.types import Update
+from constants import ASYNC_MAX_CONCURRENT_UPDATES, UPDATE_QUEUE_MAX_DEPTH, ASYNC_SCRAPER_CONNECTION_LIMIT, \
+    BOT_API_CONNECTION_POOL_SIZE, TELEGRAM_API_URL
+from telegram_bots.update_dedup import first_delivery, forget_delivery
+from telegram_bots.update_decoding import DecodedUpdate, materialize_update
+from telegram_bots.update_executor import update_chat_key
+
+# aiohttp is only imported once the async runtime starts, the Flask app does not need it
+if TYPE_CHECKING:
+    import aiohttp
+    from telebot.async_telebot import AsyncTeleBot
+
+logger = logging.getLogger(__name__)
+
+
+# The parts of an HTTP request that the routes of the async runtime need
+class AsgiRequest:
+    def __init__(self, method: str, path: str, headers: dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+class AsgiResponse:
+    def __init__(self, status: int, body: bytes = b"", content_type: str | None = None,
+                 headers: list[tuple[str, str]] | None = None):
+        self.status = status
+        self.body = body
+        self.headers = list(headers or [])
+        if content_type is not None:
+            self.headers.append(("content-type", content_type))
+
+
+# Route handlers of the async runtime are coroutine functions taking the request and returning the response
+AsgiRoute = Callable[[AsgiRequest], Awaitable[AsgiResponse]]
+
+
+# Minimal ASGI application with exact path routes, prefix routes and startup/shutdown hooks
+# Run it with any ASGI server, e.g. uvicorn asgi:application (see asgi.py)
+class AsgiApp:
+    def __init__(self):
+        self.routes: dict[tuple[str, str], AsgiRoute] = {}
+        self.prefix_routes: list[tuple[str, str, AsgiRoute]] = []
+        self.startup_hooks: list[Callable[[], Awaitable[None]]] = []
+        self.shutdown_hooks: list[Callable[[], Awaitable[None]]] = []
+
+    def add_route(self, path: str, route: AsgiRoute, methods: tuple[str, ...] = ("GET",)):
+        for method in methods:
+            self.routes[(method, path)] = route
+
+    # Routes every path starting with prefix (e.g. /static/) to route
+    def add_prefix_route(self, prefix: str, route: AsgiRoute, methods: tuple[str, ...] = ("GET",)):
+        for method in methods:
+            self.prefix_routes.append((method, prefix, route))
+
+    def on_startup(self, hook: Callable[[], Awaitable[None]]):
+        self.startup_hooks.append(hook)
+        return hook
+
+    def on_shutdown(self, hook: Callable[[], Awaitable[None]]):
+        self.shutdown_hooks.append(hook)
+        return hook
+
+    def _find_route(self, method: str, path: str) -> AsgiRoute | None:
+        # HEAD is answered like GET, the ASGI server drops the body
+        lookup_method = "GET" if method == "HEAD" else method
+        route = self.routes.get((lookup_method, path))
+        if route is not None:
+            return route
+        for route_method, prefix, route in self.prefix_routes:
+            if route_method == lookup_method and path.startswith(prefix):
+                return route
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                try:
+                    for hook in self.startup_hooks:
+                        await hook()
+                except Exception as ex:
+                    logger.exception("Async runtime startup failed")
+                    await send({"type": "lifespan.startup.failed", "message": str(ex)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                for hook in self.shutdown_hooks:
+                    try:
+                        await hook()
+                    except Exception:
+                        logger.exception("Async runtime shutdown hook failed")
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        route = self._find_route(scope["method"], scope["path"])
+        if route is None:
+            response = AsgiResponse(status=404)
+        else:
+            body = b""
+            while True:
+                event = await receive()
+                body += event.get("body", b"")
+                if not event.get("more_body", False):
+                    break
+            headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+            request = AsgiRequest(scope["method"], scope["path"], headers, body)
+            try:
+                response = await route(request)
+            except Exception:
+                logger.exception("Route %s failed", scope["path"])
+                response = AsgiResponse(status=500)
+
+        await send({"type": "http.response.start", "status": response.status,
+                    "headers": [(name.encode("latin-1"), value.encode("latin-1"))
+                                for name, value in response.headers]})
+        await send({"type": "http.response.body", "body": response.body})
+
+
+# Runs coroutines concurrently while keeping coroutines with the same key in order
+# The async counterpart of KeyedUpdateExecutor, bounded by the number of running and queued coroutines
+class AsyncKeyedDispatcher:
+    def __init__(self, max_concurrency: int, max_queue_depth: int):
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+
+        # Last task of every key, the next task of the same key waits for it
+        self._tails: dict[Hashable, asyncio.Task] = {}
+        self._depth = 0
+
+        # Created on first use since it has to belong to the running event loop
+        self._semaphore: asyncio.Semaphore | None = None
+
+        # Counters for monitoring
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    # Schedules fn(*args) after all earlier coroutines of the same key, returns False if the queue is full
+    def submit(self, key: Hashable, fn: Callable[..., Awaitable], *args) -> bool:
+        if self._depth >= self.max_queue_depth:
+            self.rejected += 1
+            return False
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        self._depth += 1
+        self.submitted += 1
+        previous = self._tails.get(key)
+        task = asyncio.get_running_loop().create_task(self._run(key, previous, fn, args))
+        self._tails[key] = task
+        return True
+
+    async def _run(self, key: Hashable, previous: asyncio.Task | None, fn: Callable[..., Awaitable], args: tuple):
+        try:
+            if previous is not None:
+                # Wait for the previous coroutine of the key whether it succeeded or not
+                await asyncio.wait([previous])
+            async with self._semaphore:
+                await fn(*args)
+        except Exception:
+            self.failed += 1
+            logger.exception("Async update handler failed")
+        finally:
+            self._depth -= 1
+            if self._tails.get(key) is asyncio.current_task():
+                del self._tails[key]
+
+
+# The dispatcher shared by all the async bots of this process
+async_update_dispatcher = AsyncKeyedDispatcher(max_concurrency=ASYNC_MAX_CONCURRENT_UPDATES,
+                                               max_queue_depth=UPDATE_QUEUE_MAX_DEPTH)
+
+
+# Runs the handlers of the async bot for the update, building the Update from the webhook's JSON first
+async def process_update_async(bot: "AsyncTeleBot", update: DecodedUpdate | Update):
+    await bot.process_new_updates([materialize_update(update)])
+
+
+# Hands the update over to the async bot's handlers without waiting for them
+# Redelivered updates are acknowledged without running the handlers again (see update_dedup.py)
+# (The shared update_id file is locked and accessed on a thread, so the event loop never waits for the file lock)
+# Returns False if the update could not be queued because the queue is full
+async def dispatch_update_async(bot: "AsyncTeleBot", bot_name: str, update: DecodedUpdate | Update) -> bool:
+    if not await asyncio.to_thread(first_delivery, bot_name, update.update_id):
+        return True
+    if not async_update_dispatcher.submit((bot_name, update_chat_key(update)), process_update_async, bot, update):
+        await asyncio.to_thread(forget_delivery, bot_name, update.update_id)
+        return False
+    return True
+
+
+# Makes all the AsyncTeleBot objects share one aiohttp connection pool of BOT_API_CONNECTION_POOL_SIZE connections
+# (pyTelegramBotAPI's asyncio_helper already shares its session between bots, only the pool size and URL are set here)
+def configure_async_bot_api_session():
+    from telebot import asyncio_helper
+    asyncio_helper.REQUEST_LIMIT = BOT_API_CONNECTION_POOL_SIZE
+    asyncio_helper.API_URL = TELEGRAM_API_URL
+
+
+# Connection pool shared by the outbound scraping requests of the async runtime
+_scraper_connector: "aiohttp.TCPConnector | None" = None
+
+
+# Returns a new aiohttp session for one resolution
+# Sessions share the keep-alive connections but every session has its own cookie jar,
+# so that the visitor state of one user never leaks into the resolution of another user
+def create_scraper_session(headers: dict[str, str] | None = None) -> "aiohttp.ClientSession":
+    import aiohttp
+
+    global _scraper_connector
+    if _scraper_connector is None or _scraper_connector.closed:
+        _scraper_connector = aiohttp.TCPConnector(limit=ASYNC_SCRAPER_CONNECTION_LIMIT)
+    return aiohttp.ClientSession(connector=_scraper_connector, connector_owner=False,
+                                 cookie_jar=aiohttp.CookieJar(), headers=headers)
+
+
+# Closes the connection pools of the async runtime, called on shutdown
+async def close_async_sessions():
+    from telebot import asyncio_helper
+
+    if _scraper_connector is not None:
+        await _scraper_connector.close()
+    if asyncio_helper.session_manager.session is not None:
+        await asyncio_helper.session_manager.session.close()
@@ -0,0 +1,40 @@
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+from constants import TELEGRAM_API_URL
+from telegram_bots.metrics import observe_bot_api_request
+
+
+# Session which records the duration of every Bot API request in the metrics (see metrics.py)
+class BotApiSession(requests.Session):
+    def request(self, method, url, *args, **kwargs):
+        started_at = time.perf_counter()
+        status = "error"
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            observe_bot_api_request(url, status, time.perf_counter() - started_at)
+
+
+# Makes all the TeleBot objects of this process send their Bot API requests through one requests.Session
+# By default pyTelegramBotAPI creates a session (and so a connection pool) for every thread,
+# which means a new TLS handshake with api.telegram.org whenever a new worker thread sends its first message
+def configure_shared_bot_api_session(pool_size: int) -> requests.Session:
+    session = BotApiSession()
+
+    # All the calls go to the same host, so a single pool of keep-alive connections is enough
+    # pool_block makes threads wait for a free connection instead of opening connections which aren't reused
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    # Never recreate the session, otherwise the pooled connections would be thrown away
+    apihelper.SESSION_TIME_TO_LIVE = None
+    apihelper.session = session
+
+    # api.telegram.org unless TELEGRAM_API_URL points to a stand-in
+    apihelper.API_URL = TELEGRAM_API_URL
+    return session
@@ -0,0 +1,135 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from telebot.types import Message
+from concurrent_log_handler import ConcurrentTimedRotatingFileHandler
+from constants import timetz, DEFAULT_LOG_PATH, LOG_LEVEL, create_directories
+from log_files import compress_log_file
+from telegram_bots.metrics import observe_stage
+
+# Changes Default Logging Timezone
+logging.Formatter.converter = timetz
+
+# Log format of the stdout logs
+STREAM_LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+
+# Formats records as compact JSON Lines for the log files
+# Analytics records (see log_analytics) are written as {"time", "level", "event", <fields>},
+# all other records as {"time", "level", "message"}
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"), "level": record.levelname}
+        analytics = getattr(record, "analytics", None)
+        if analytics is not None:
+            entry["event"] = record.msg
+            entry.update(analytics)
+        else:
+            entry["message"] = record.getMessage()
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+# Formats records for stdout, analytics fields are appended to the event name
+class StreamFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        analytics = getattr(record, "analytics", None)
+        if analytics is not None:
+            text += " " + json.dumps(analytics, ensure_ascii=False, separators=(",", ":"), default=str)
+        return text
+
+
+# QueueHandler which hands the record over as it is
+# The default QueueHandler formats the message in the calling thread, here the listener thread does all the formatting
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# Rotator of the file handler, renames the current log file and compresses it on a background thread
+# (The rotation runs while every worker process waits on the log file lock, so it must not do the compression itself)
+def rotate_and_compress(source: str, dest: str):
+    # The handler only checks for an uncompressed file of the same day, do not overwrite an earlier compressed one
+    rotated_path, counter = dest, 0
+    while os.path.exists(rotated_path) or os.path.exists(rotated_path + ".gz"):
+        counter += 1
+        rotated_path = "%s.%d" % (dest, counter)
+    os.rename(source, rotated_path)
+
+    def compress():
+        try:
+            compress_log_file(rotated_path)
+        except OSError as ex:
+            # The uncompressed file is kept, analytics_query.py compress can be used to compress it later
+            print("Could not compress %s: %s" % (rotated_path, ex), file=sys.stderr)
+    threading.Thread(target=compress, name="log-compressor", daemon=False).start()
+
+
+# Creates the logger of a bot
+# Request threads only put records on a queue, a background listener thread writes them to
+# the daily rotated file DEFAULT_LOG_PATH/<name>/log (JSON Lines) and to stdout
+# (ConcurrentTimedRotatingFileHandler since several gunicorn workers write to the same file)
+def create_bot_logger(name: str) -> logging.Logger:
+    # File logging, rotates file every day at midnight
+    file_handler = ConcurrentTimedRotatingFileHandler(
+        os.path.join(create_directories(os.path.join(DEFAULT_LOG_PATH, name)), "log"),
+        when='midnight', interval=1
+    )
+
+    # File Suffix for every rotation of log file
+    file_handler.suffix = "%d-%m-%Y"
+    file_handler.rotator = rotate_and_compress
+    file_handler.setFormatter(JsonLinesFormatter())
+
+    # Logging handler to print logs to stdout
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(StreamFormatter(STREAM_LOG_FORMAT))
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+
+    # Write the records which are still queued before the process exits
+    atexit.register(listener.stop)
+
+    # The listener thread does not survive a fork (e.g. gunicorn --preload), start a new one in the child
+    def restart_listener():
+        listener._thread = None
+        listener.start()
+    os.register_at_fork(after_in_child=restart_listener)
+
+    logger = logging.getLogger(name)
+    logger.addHandler(DeferredQueueHandler(records))
+
+    # Sets Log Level, records below it are dropped before anything is formatted
+    # (See https://docs.python.org/3/howto/logging.html#when-to-use-logging)
+    logger.setLevel(LOG_LEVEL)
+    return logger
+
+
+# Logs an analytics event about the message with only the fields needed for analytics
+# Nothing is collected if INFO records are filtered out by the log level
+def log_analytics(logger: logging.Logger, outcome: str, message: Message, **fields):
+    log_analytics_fields(logger, outcome, message.chat.id, message.chat.username, message.message_id, message.text,
+                         **fields)
+
+
+# Same as log_analytics when only the fields of the message are left (e.g. in a queued job)
+def log_analytics_fields(logger: logging.Logger, outcome: str, user_id: int, username: str | None, message_id: int,
+                         text: str | None, **fields):
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    analytics = {"outcome": outcome, "user_id": user_id, "username": username, "message_id": message_id,
+                 "text": text}
+    analytics.update(fields)
+    started_at = time.perf_counter()
+    logger.info("message", extra={"analytics": analytics})
+    observe_stage(logger.name, "logging", time.perf_counter() - started_at)
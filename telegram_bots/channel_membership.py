@@ -0,0 +1,147 @@
+import threading
+import time
+from typing import TYPE_CHECKING
+from telebot import TeleBot
+from telebot.types import ChatMemberUpdated
+from telebot.apihelper import ApiTelegramException
+from constants import DEVELOPER_TELEGRAM_CHANNEL_ID, MEMBERSHIP_CACHE_POSITIVE_TTL_SECONDS, \
+    MEMBERSHIP_CACHE_NEGATIVE_TTL_SECONDS, MEMBERSHIP_CACHE_MAX_ENTRIES
+
+# AsyncTeleBot needs aiohttp, which is only installed for the async runtime
+if TYPE_CHECKING:
+    from telebot.async_telebot import AsyncTeleBot
+
+# Statuses of a user which count as subscribed to the Developer's Telegram Channel
+SUBSCRIBED_STATUSES = ["creator", "administrator", "member"]
+
+
+# Cache of the channel membership of users
+# Subscribed users are remembered longer than unsubscribed users
+# since an unsubscribed user is expected to join the channel soon after being asked to
+# Every worker process has its own cache, an entry may be stale for up to its TTL in the workers which did not
+# receive the chat_member update (see the MEMBERSHIP_CACHE_* constants)
+class ChannelMembershipCache:
+    def __init__(self, positive_ttl_seconds: float, negative_ttl_seconds: float, max_entries: int):
+        self.positive_ttl_seconds = positive_ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._entries: dict[int, tuple[float, bool]] = {}
+
+        # Counters for monitoring
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+                "size": len(self._entries)}
+
+    # Returns the cached membership of the user or None if it is unknown or expired
+    def get(self, user_id: int) -> bool | None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, user_id: int, subscribed: bool):
+        ttl = self.positive_ttl_seconds if subscribed else self.negative_ttl_seconds
+        with self._lock:
+            # Re-insert so that the dict stays ordered from the oldest to the newest entry
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = (time.monotonic() + ttl, subscribed)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+
+# The cache shared by all the bots of this process
+membership_cache = ChannelMembershipCache(positive_ttl_seconds=MEMBERSHIP_CACHE_POSITIVE_TTL_SECONDS,
+                                          negative_ttl_seconds=MEMBERSHIP_CACHE_NEGATIVE_TTL_SECONDS,
+                                          max_entries=MEMBERSHIP_CACHE_MAX_ENTRIES)
+
+
+# Check if Developer's Telegram Channel is defined in constants.py
+# If yes, then check if user is subscribed to the channel and return True or False
+def user_is_subscribed_to_telegram_channel(bot: TeleBot, user_id: int) -> bool:
+    if DEVELOPER_TELEGRAM_CHANNEL_ID is None:
+        # Since Developer's Telegram Channel ID isn't defined in constants.py,
+        # Do not check anything and return True
+        return True
+
+    subscribed = membership_cache.get(user_id)
+    if subscribed is not None:
+        return subscribed
+
+    try:
+        # Check if user is already subscribed to the Developer's Telegram Channel
+        # For this to work, you need to add this bot as an Admin of the Channel
+        chat_member = bot.get_chat_member(chat_id=DEVELOPER_TELEGRAM_CHANNEL_ID, user_id=user_id)
+        subscribed = chat_member.status in SUBSCRIBED_STATUSES
+    except ApiTelegramException:
+        # User has never subscribed to the Developer's Telegram Channel
+        subscribed = False
+
+    membership_cache.put(user_id, subscribed)
+    return subscribed
+
+
+# Same as user_is_subscribed_to_telegram_channel for the AsyncTeleBot of the async runtime
+async def user_is_subscribed_to_telegram_channel_async(bot: "AsyncTeleBot", user_id: int) -> bool:
+    if DEVELOPER_TELEGRAM_CHANNEL_ID is None:
+        return True
+
+    subscribed = membership_cache.get(user_id)
+    if subscribed is not None:
+        return subscribed
+
+    try:
+        chat_member = await bot.get_chat_member(chat_id=DEVELOPER_TELEGRAM_CHANNEL_ID, user_id=user_id)
+        subscribed = chat_member.status in SUBSCRIBED_STATUSES
+    except ApiTelegramException:
+        subscribed = False
+
+    membership_cache.put(user_id, subscribed)
+    return subscribed
+
+
+# Returns True if the chat is the Developer's Telegram Channel
+def is_developer_telegram_channel(chat) -> bool:
+    if DEVELOPER_TELEGRAM_CHANNEL_ID is None:
+        return False
+    return str(chat.id) == DEVELOPER_TELEGRAM_CHANNEL_ID or \
+        (chat.username is not None and "@%s" % chat.username.lower() == DEVELOPER_TELEGRAM_CHANNEL_ID.lower())
+
+
+# Telegram sends a chat_member update when a user joins or leaves the Developer's Telegram Channel
+# Update the cached membership right away so that a user who just joined can use the bot immediately
+# (Only the worker which receives the update learns about it, the others once their entry expires)
+def channel_member_updated(chat_member_updated: ChatMemberUpdated):
+    user_id = chat_member_updated.new_chat_member.user.id
+    membership_cache.invalidate(user_id)
+    membership_cache.put(user_id, chat_member_updated.new_chat_member.status in SUBSCRIBED_STATUSES)
+
+
+async def channel_member_updated_async(chat_member_updated: ChatMemberUpdated):
+    channel_member_updated(chat_member_updated)
+
+
+# Registers the chat_member handler on the bot
+# The bot needs to be an Admin of the Channel and the webhook needs to allow chat_member updates
+def register_channel_membership_handler(bot: TeleBot):
+    bot.register_chat_member_handler(channel_member_updated,
+                                     func=lambda update: is_developer_telegram_channel(update.chat))
+
+
+# Registers the chat_member handler on the AsyncTeleBot of the async runtime
+def register_channel_membership_handler_async(bot: "AsyncTeleBot"):
+    bot.register_chat_member_handler(channel_member_updated_async,
+                                     func=lambda update: is_developer_telegram_channel(update.chat))
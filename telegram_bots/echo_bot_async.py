@@ -0,0 +1,80 @@
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Message
+from telegram_bots.async_runtime import AsgiApp, AsgiRequest, AsgiResponse, dispatch_update_async
+from telegram_bots.bot_logging import log_analytics
+from telegram_bots.webhook_registration import ensure_webhook_async
+from telegram_bots.update_decoding import decode_update
+from telegram_bots.channel_membership import register_channel_membership_handler_async
+from telegram_bots.message_gates import build_message_chain_async
+from telegram_bots.echo_bot import logger, WEB_ROUTE, WEBHOOK_URL, BOT_TOKEN, welcome_text
+
+# The AsyncTeleBot object of the pyTelegramBotAPI library
+# Same bot as in echo_bot.py, used when the bots are served by the async runtime (see asgi.py)
+async_bot: AsyncTeleBot | None = None
+if BOT_TOKEN is not None:
+    async_bot = AsyncTeleBot(BOT_TOKEN)
+
+    # Keep the shared channel membership cache up to date when users join or leave the channel
+    register_channel_membership_handler_async(async_bot)
+
+
+def register_async_route(asgi_app: AsgiApp):
+    logger.debug("Adding Async Route %s", WEB_ROUTE)
+
+    # Add the URL route to the ASGI app and associate trigger coroutine on request
+    asgi_app.add_route(WEB_ROUTE, echo_bot_process_webhook_trigger_async, methods=("POST",))
+
+
+async def register_async_webhook():
+    logger.debug("Registering Webhook at %s", WEBHOOK_URL)
+
+    # Only registers the webhook if Telegram doesn't already have it
+    await ensure_webhook_async(async_bot, WEBHOOK_URL, logger)
+
+
+async def echo_bot_process_webhook_trigger_async(request: AsgiRequest) -> AsgiResponse:
+    if request.headers.get('content-type') == 'application/json':
+        # Parse the JSON POST data, the Telebot Update is built when the handlers run
+        try:
+            update = decode_update(request.body)
+        except ValueError:
+            return AsgiResponse(status=400)
+
+        # Schedule the handlers on the event loop and acknowledge the update right away
+        if not await dispatch_update_async(async_bot, WEB_ROUTE, update):
+            # Too many updates are pending, 503 makes Telegram redeliver the update later
+            logger.warning("Update queue is full, rejecting update %s", update.update_id)
+            return AsgiResponse(status=503)
+
+        # Message accepted, now return 204 No Content
+        return AsgiResponse(status=204)
+    else:
+        # Telegram did not trigger the Webhook, return 403 Forbidden
+        return AsgiResponse(status=403)
+
+
+# Handle /start and /help messages sent to the Telegram bot
+async def send_welcome_async(message: Message):
+    # Send the message as a reply to the sender's message
+    await async_bot.send_message(message.chat.id, text=welcome_text(message), reply_to_message_id=message.message_id,
+                                 parse_mode='Markdown', disable_web_page_preview=True)
+
+    # Log the incoming message for analytics purposes
+    log_analytics(logger, "start", message)
+
+
+# Handle any incoming message sent to the Telegram bot which got through the gates (see message_gates.py)
+async def echo_all_async(message: Message):
+    # Echo the sender's message as a reply to their message (The purpose of this bot)
+    await async_bot.send_message(message.chat.id, text=message.text, reply_to_message_id=message.message_id,
+                                 disable_web_page_preview=True)
+
+    # Log the incoming message for analytics purposes
+    log_analytics(logger, "echoed", message)
+
+
+# Register the handlers, the gates are put in front of echo_all_async once here
+if async_bot is not None:
+    async_bot.register_message_handler(send_welcome_async, commands=['start', 'help'])
+    async_bot.register_message_handler(build_message_chain_async(async_bot, logger, echo_all_async),
+                                       func=lambda msg: True)
@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable, Hashable
+from telegram_bots.metrics import count_chat_rate_limited, count_scheduler_rejection, observe_scheduler_wait, \
+    set_scheduler_pending
+from telegram_bots.profiler import profiler
+
+logger = logging.getLogger(__name__)
+
+
+# Token bucket rate limit of every chat
+# A chat can send burst requests at once, then one more every 60 / per_minute seconds
+# name labels the metrics of the limiter
+class ChatRateLimiter:
+    def __init__(self, per_minute: float, burst: int, max_entries: int = 50000, name: str = "default"):
+        self.name = name
+        self.rate_per_second = per_minute / 60
+        self.burst = burst
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+
+        # chat -> (tokens, time of the last update), ordered from the least to the most recently seen chat
+        self._buckets: OrderedDict[Hashable, tuple[float, float]] = OrderedDict()
+
+        # Counters for monitoring
+        self.allowed = 0
+        self.limited = 0
+
+    # Takes a token of the chat, returns False if the chat has no token left
+    def allow(self, chat: Hashable) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(chat, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate_per_second)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+                self.allowed += 1
+            else:
+                self.limited += 1
+            self._buckets[chat] = (tokens, now)
+
+            # A forgotten chat starts again with a full bucket, which is what it would have by now anyway
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        if not allowed:
+            count_chat_rate_limited(self.name)
+        return allowed
+
+    def stats(self) -> dict:
+        return {"allowed": self.allowed, "limited": self.limited, "chats": len(self._buckets)}
+
+
+# A job waiting in the FairScheduler
+class ScheduledJob:
+    def __init__(self, fn: Callable, args: tuple):
+        self.fn = fn
+        self.args = args
+        self.submitted_at = time.monotonic()
+
+
+# Runs jobs on a fixed number of worker threads, taking turns between the keys (chats)
+# Every key has its own FIFO queue and the workers take the next job from the key after the one served last,
+# so a chat with fifty pending jobs gets one job done per round like every other chat instead of blocking them
+# At most max_pending jobs wait at a time, submit returns False beyond that so the caller can answer right away
+# name labels the metrics of the scheduler (pending jobs, their wait for a worker and the rejected jobs)
+class FairScheduler:
+    def __init__(self, workers: int, max_pending: int, thread_name_prefix: str = "fair-worker", name: str = "default"):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self.thread_name_prefix = thread_name_prefix
+
+        self._condition = threading.Condition()
+
+        # Keys with waiting jobs in round-robin order
+        self._queues: OrderedDict[Hashable, deque[ScheduledJob]] = OrderedDict()
+        self._pending = 0
+        self._running = 0
+
+        # Started on first use so that the threads are started inside the gunicorn worker and not before the fork
+        self._threads: list[threading.Thread] = []
+
+        # Counters for monitoring
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    # Number of jobs waiting for a worker
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "pending": self._pending, "running": self._running,
+                "chats_waiting": len(self._queues), "submitted": self.submitted, "rejected": self.rejected,
+                "completed": self.completed, "failed": self.failed,
+                "wait_seconds_total": round(self.wait_seconds_total, 3),
+                "wait_seconds_max": round(self.wait_seconds_max, 3)}
+
+    # Queues fn(*args) behind the earlier jobs of the key, returns False if max_pending jobs are already waiting
+    def submit(self, key: Hashable, fn: Callable, *args) -> bool:
+        with self._condition:
+            if self._pending >= self.max_pending:
+                self.rejected += 1
+                count_scheduler_rejection(self.name)
+                return False
+            if not self._threads:
+                self._start_workers()
+
+            queue = self._queues.get(key)
+            if queue is None:
+                # A new key joins the round at the end
+                queue = self._queues[key] = deque()
+            queue.append(ScheduledJob(fn, args))
+            self._pending += 1
+            self.submitted += 1
+            set_scheduler_pending(self.name, self._pending)
+            self._condition.notify()
+            return True
+
+    def _start_workers(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name="%s-%d" % (self.thread_name_prefix, index), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_job(self) -> ScheduledJob:
+        with self._condition:
+            while not self._queues:
+                self._condition.wait()
+
+            # Serve the first key of the round, then move it to the end if it has more jobs waiting
+            key, queue = self._queues.popitem(last=False)
+            job = queue.popleft()
+            if queue:
+                self._queues[key] = queue
+
+            waited = time.monotonic() - job.submitted_at
+            self._pending -= 1
+            self._running += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+            set_scheduler_pending(self.name, self._pending)
+        observe_scheduler_wait(self.name, waited)
+        return job
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            failed = False
+            try:
+                with profiler.section():
+                    job.fn(*job.args)
+            except Exception:
+                failed = True
+                logger.exception("Scheduled job failed")
+            with self._condition:
+                self._running -= 1
+                self.completed += 1
+                if failed:
+                    self.failed += 1
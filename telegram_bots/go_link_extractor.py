@@ -0,0 +1,77 @@
+import codecs
+from html.parser import HTMLParser
+
+# The id of the element holding the inputs which are posted to https://gplinks.co/links/go
+GO_LINK_ELEMENT_ID = "go-link"
+
+
+# HTMLParser which collects the name/value pairs of the <input> elements inside the element with id="go-link"
+# Unlike BeautifulSoup it builds no tree, everything outside the go-link element is skipped
+class GoLinkFormParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.data: dict[str | None, str | None] = {}
+
+        # Tag of the go-link element and how deep we are inside elements with the same tag
+        self._form_tag: str | None = None
+        self._form_depth = 0
+
+        # Set once the go-link element is closed, nothing after it needs to be parsed
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        self._start(tag, attrs, self_closing=False)
+
+    def handle_startendtag(self, tag, attrs):
+        self._start(tag, attrs, self_closing=True)
+
+    def _start(self, tag, attrs, self_closing: bool):
+        if self.done:
+            return
+
+        # Valueless attributes (e.g. <input disabled>) have the value '' like in BeautifulSoup
+        attributes = {name: "" if value is None else value for name, value in attrs}
+
+        if self._form_tag is None:
+            if attributes.get("id") == GO_LINK_ELEMENT_ID and not self_closing:
+                self._form_tag = tag
+                self._form_depth = 1
+            return
+
+        if tag == "input":
+            self.data[attributes.get("name")] = attributes.get("value")
+        elif tag == self._form_tag and not self_closing:
+            self._form_depth += 1
+
+    def handle_endtag(self, tag):
+        if self.done or tag != self._form_tag:
+            return
+        self._form_depth -= 1
+        if self._form_depth == 0:
+            self.done = True
+
+
+# Returns the name/value pairs of the inputs of the go-link form in the HTML page
+# Gives the same result as collecting the inputs of soup.find_all(id="go-link") with BeautifulSoup,
+# but parsing starts right before the go-link element and stops as soon as it is closed
+# (If a malformed page has more than one go-link element, only the first one is read)
+def extract_go_link_form(content: bytes, encoding: str = "utf-8", chunk_size: int = 8192) -> dict:
+    # Jump straight to the tag containing the id, everything before it is irrelevant
+    position = content.find(GO_LINK_ELEMENT_ID.encode("ascii"))
+    if position == -1:
+        return {}
+    start = content.rfind(b"<", 0, position)
+    if start == -1:
+        start = 0
+
+    parser = GoLinkFormParser()
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    for offset in range(start, len(content), chunk_size):
+        parser.feed(decoder.decode(content[offset:offset + chunk_size]))
+        if parser.done:
+            return parser.data
+
+    # The go-link element was never closed, read whatever is left like BeautifulSoup would
+    parser.feed(decoder.decode(b"", final=True))
+    parser.close()
+    return parser.data
@@ -1,54 +1,49 @@
+import logging
 import os
-import sys
 import time
 from abc import ABC
-import cloudscraper
-import validators
-from bs4 import BeautifulSoup
-from flask import Flask, request, abort, Response
+from urllib.parse import urlsplit
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable
 from telebot import TeleBot
-from telebot.types import Message, Update
-from telebot.apihelper import ApiTelegramException
-from constants import WEBHOOK_URL_BASE, in_developer_mode, DEVELOPER_TELEGRAM_USERNAME, DEVELOPER_TELEGRAM_LINK, \
-    DEVELOPER_TELEGRAM_CHANNEL_ID, DEVELOPER_TELEGRAM_CHANNEL_LINK, DEVELOPER_TELEGRAM_CHANNEL_LINK_ESCAPED, \
-    timetz, DEFAULT_LOG_PATH, create_directories
+from telebot.types import Message
+from constants import WEBHOOK_URL_BASE, DEVELOPER_MODE, STORAGE_PATH, LINK_CACHE_BACKEND, LINK_CACHE_TTL_SECONDS, \
+    LINK_CACHE_MAX_ENTRIES, SCRAPER_POOL_SIZE, SCRAPER_SESSION_MAX_USES, SCRAPER_SESSION_MAX_AGE_SECONDS, \
+    SCRAPER_POOL_CHECKOUT_TIMEOUT_SECONDS, BYPASS_WORKERS, BYPASS_QUEUE_MAX_PENDING, CHAT_RATE_LIMIT_PER_MINUTE, \
+    CHAT_RATE_LIMIT_BURST, GPLINKS_SHORT_URL_ORIGIN, GPLINKS_TRACK_URL, GPLINKS_GO_URL, GPLINKS_GO_DELAY_SECONDS, \
+    BYPASS_JOB_QUEUE_PATH, BYPASS_JOB_QUEUE_JOURNAL_MODE, BYPASS_JOB_MAX_UNFINISHED, BYPASS_JOB_BATCH_SIZE, \
+    BYPASS_JOB_LEASE_SECONDS, BYPASS_JOB_POLL_INTERVAL_SECONDS, BYPASS_JOB_MAX_ATTEMPTS, BYPASS_MAX_ATTEMPTS, \
+    BYPASS_DEADLINE_SECONDS, BYPASS_BACKOFF_BASE_SECONDS, BYPASS_BACKOFF_MAX_SECONDS, \
+    BYPASS_BREAKER_FAILURE_THRESHOLD, BYPASS_BREAKER_RESET_SECONDS, MULTI_LINK_MAX_LINKS, MULTI_LINK_CONCURRENCY, \
+    MULTI_LINK_WORKERS
 from telegram_bots import TelegramBot
-import logging.handlers
-from concurrent_log_handler import ConcurrentTimedRotatingFileHandler
-
-# Changes Default Logging Timezone
-logging.Formatter.converter = timetz
+from telegram_bots.async_runtime import AsgiApp
+from telegram_bots.link_cache import create_link_cache, normalize_short_url
+from telegram_bots.link_extraction import extract_gplinks_urls
+from telegram_bots.scraper_pool import ScraperPoolExhaustedError, ScraperSessionPool
+from telegram_bots.fair_scheduler import ChatRateLimiter, FairScheduler
+from telegram_bots.job_queue import JobQueueConsumer, QueuedJob, SQLiteJobQueue
+from telegram_bots.send_scheduler import send_scheduler
+from telegram_bots.retry_policy import CircuitBreaker, CircuitOpenError, DeadlineExceededError, backoff_seconds, \
+    remaining_seconds
+from telegram_bots.go_link_extractor import extract_go_link_form
+from telegram_bots.channel_membership import register_channel_membership_handler
+from telegram_bots.bot_logging import create_bot_logger, log_analytics, log_analytics_fields
+from telegram_bots.message_gates import DEVELOPER_MODE_TEXT, build_message_chain
+from telegram_bots.webhook_dispatcher import WebhookDispatcher
+from telegram_bots.polling_runner import PollingRunner
+from telegram_bots.webhook_registration import ensure_webhook
+from telegram_bots.metrics import observe_bypass_attempt, observe_bypass_attempts
 
 # Creates a logger object which helps in logging requests from users for analytics stuff
-logger = logging.getLogger('gplinks_bypasser_telegram_bot')
-
-# File logging, rotates file every day at midnight
-# (Use ConcurrentTimedRotatingFileHandler since it is a Flask app)
-handler = ConcurrentTimedRotatingFileHandler(
-    os.path.join(create_directories(os.path.join(DEFAULT_LOG_PATH, "gplinks_bypasser_telegram_bot")), "log"),
-    when='midnight', interval=1
-)
-
-# File Suffix for every rotation of log file
-handler.suffix = "%d-%m-%Y"
-
-# File Logging Handler Log Format
-handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
-
-# Add the file logging handler to the logger
-logger.addHandler(handler)
-
-# Add logging handler to print logs to stdout
-# (You can remove this line if you don't require this)
-logger.addHandler(logging.StreamHandler(sys.stdout))
-
-# Sets Log Level
-# (See https://docs.python.org/3/howto/logging.html#when-to-use-logging)
-logger.setLevel(logging.DEBUG)
+# (Records are written by a background thread, see bot_logging.py)
+logger = create_bot_logger('gplinks_bypasser_telegram_bot')
 
 # The route at which Flask will listen to.
 # Whenever a message is received by the Telegram Bot, Telegram sends a POST request to this route
-WEB_ROUTE = "/%s" % "gp-link-bypass"
+# (The webhook dispatcher selects the bot by the path token, see webhook_dispatcher.py)
+PATH_TOKEN = "gp-link-bypass"
+WEB_ROUTE = "/%s" % PATH_TOKEN
 
 # The Webhook URL - Full URL to the route where Telegram will send POST request
 WEBHOOK_URL = WEBHOOK_URL_BASE + WEB_ROUTE
@@ -61,9 +56,52 @@ BOT_TOKEN = os.environ.get('ITSYOURAP_GPLINK_BYPASSER_TELEGRAM_BOT_TOKEN')
 
 # The TeleBot object of the pyTelegramBotAPI library
 # This handles everything regarding the bot functions
+# (threaded=False since the handlers already run on the shared update executor, see update_executor.py)
 bot: TeleBot | None = None
 if BOT_TOKEN is not None:
-    bot = TeleBot(BOT_TOKEN)
+    bot = TeleBot(BOT_TOKEN, threaded=False)
+
+    # Keep the shared channel membership cache up to date when users join or leave the channel
+    register_channel_membership_handler(bot)
+
+# Cache of already bypassed URLs, many users send the same gplinks.co URL at around the same time
+link_cache = create_link_cache(backend=LINK_CACHE_BACKEND, ttl_seconds=LINK_CACHE_TTL_SECONDS,
+                               max_entries=LINK_CACHE_MAX_ENTRIES, storage_path=STORAGE_PATH)
+
+
+# cloudscraper (and its dependencies) take a long time to import, it is only imported when the first session is created
+def create_cloudscraper_session():
+    import cloudscraper
+    return cloudscraper.create_scraper(allow_brotli=False)
+
+
+# Pool of cloudscraper sessions reused by gplinks_bypass
+# Since only cloudscraper can bypass Cloudflare bot detection
+scraper_pool = ScraperSessionPool(create_session=create_cloudscraper_session,
+                                  max_size=SCRAPER_POOL_SIZE, max_uses=SCRAPER_SESSION_MAX_USES,
+                                  max_age_seconds=SCRAPER_SESSION_MAX_AGE_SECONDS,
+                                  checkout_timeout_seconds=SCRAPER_POOL_CHECKOUT_TIMEOUT_SECONDS)
+
+# Bypasses run on their own workers, taking turns between the chats (see fair_scheduler.py)
+# so that a user who sends many links at once does not make everybody else wait
+bypass_scheduler = FairScheduler(workers=BYPASS_WORKERS, max_pending=BYPASS_QUEUE_MAX_PENDING,
+                                 thread_name_prefix="bypass-worker", name="bypass")
+
+# Resolves the links of the messages with several links, MULTI_LINK_CONCURRENCY of every message at a time
+# (The bypass worker of such a message waits for them without a session, every link needs a session of the
+# scraper pool, which is sized for both executors, see constants.py)
+link_resolver = ThreadPoolExecutor(max_workers=MULTI_LINK_WORKERS, thread_name_prefix="link-resolver")
+
+# Fails the bypasses fast while GPLinks is down, shared with the async runtime (see retry_policy.py)
+gplinks_breaker = CircuitBreaker("gplinks", failure_threshold=BYPASS_BREAKER_FAILURE_THRESHOLD,
+                                 reset_seconds=BYPASS_BREAKER_RESET_SECONDS)
+
+# Limits the number of bypasses a chat can start per minute
+chat_rate_limiter = ChatRateLimiter(per_minute=CHAT_RATE_LIMIT_PER_MINUTE, burst=CHAT_RATE_LIMIT_BURST, name="bypass")
+
+# Bypasses wait in a queue on disk until they are done (see job_queue.py), so a restart does not lose them
+# (The file is only created once the bot runs)
+bypass_job_queue = SQLiteJobQueue(BYPASS_JOB_QUEUE_PATH, journal_mode=BYPASS_JOB_QUEUE_JOURNAL_MODE)
 
 
 # GpLinksBypasserTelegramBot class which extends the TelegramBot class
@@ -71,212 +109,361 @@ if BOT_TOKEN is not None:
 # Abstract since we do not create objects of this class, instead call the static methods
 class GpLinksBypasserTelegramBot(TelegramBot, ABC):
     @staticmethod
-    def register_route(flask_app: Flask):
+    def register_route(dispatcher: WebhookDispatcher):
         if bot is not None:
             logger.debug("Adding Route %s", WEB_ROUTE)
 
-            # Add the URL route rule to the Flask Server and associate trigger function on request
-            flask_app.add_url_rule(WEB_ROUTE, methods=['POST'], view_func=gp_link_bypass_process_webhook_trigger)
+            # Let the webhook dispatcher pass the updates sent to WEB_ROUTE to this bot
+            dispatcher.add_bot(PATH_TOKEN, bot, logger)
+
+            # Run the queued bypasses, including the ones left over by the previous run
+            bypass_job_consumer.start()
 
     @staticmethod
     def register_webhook():
         if bot is not None:
             logger.debug("Registering Webhook at %s", WEBHOOK_URL)
 
-            # Register Webhook at Telegram for the Telegram Bot
-            set_webhook(WEBHOOK_URL)
-
-
-def set_webhook(url):
-    # Remove any existing webhook
-    bot.remove_webhook()
-
-    # Wait some time before assigning the new webhook
-    time.sleep(0.1)
+            # Register Webhook at Telegram for the Telegram Bot (unless it is already registered)
+            ensure_webhook(bot, WEBHOOK_URL, logger)
 
-    # Assign the new webhook to url
-    bot.set_webhook(url=url)
+    @staticmethod
+    def register_async_route(asgi_app: AsgiApp):
+        if bot is not None:
+            # The async handlers live in their own module since they need aiohttp
+            from telegram_bots.gplinks_bypasser_telegram_bot_async import register_async_route
+            register_async_route(asgi_app)
 
+    @staticmethod
+    async def register_async_webhook():
+        if bot is not None:
+            from telegram_bots.gplinks_bypasser_telegram_bot_async import register_async_webhook
+            await register_async_webhook()
 
-def gp_link_bypass_process_webhook_trigger():
-    if request.headers.get('Content-Type') == 'application/json':
-        # Get the Webhook POST data
-        json_string = request.get_data().decode('utf-8')
+    @staticmethod
+    def register_polling(runner: PollingRunner):
+        if bot is not None:
+            logger.debug("Adding Bot to the polling runner")
+            runner.add_bot(PATH_TOKEN, bot, logger)
+            bypass_job_consumer.start()
 
-        # De-serialize the JSON POST data to Telebot Message
-        update = Update.de_json(json_string)
 
-        # Handle the new message
-        bot.process_new_updates([update])
+# Reply message to /start and /help
+def welcome_text(message: Message) -> str:
+    text = f"😃 **Hi [{message.chat.first_name}](https://t.me/{message.chat.username}),**\n\n" \
+              "👌 I can bypass gplinks.co URLs in few seconds\n\n" \
+              "😋 Just send me an URL in https://gplinks.co/xxx format\n\n" \
+              "🧑🏻‍💻 Created by [@Anonyadmin](https://t.me/Anonyadmin)\n" \
+              "🔎 GitHub: [Click Here](nun)\n" \
+              "🎁 Donate: UPI - `nun`"
 
-        # Message handled successfully, now return 204 No Content
-        return Response(status=204)
-    else:
-        # Telegram did not trigger the Webhook, abort with 403 Forbidden
-        abort(403)
+    # If this server is marked as Development Server then only reply to developer (owner)
+    if DEVELOPER_MODE:
+        text = text + "\n\n" + DEVELOPER_MODE_TEXT
+    return text
 
 
 # Handle /start and /help messages sent to the Telegram bot
-@bot.message_handler(commands=['start', 'help'])
 def send_welcome(message: Message):
     # Reply message to /start and /help
-    text = f"😃 **Hi [{message.chat.first_name}](https://t.me/{message.chat.username}),**\n\n" \
-           "👌 I can bypass gplinks.co URLs in few seconds\n\n" \
-           "😋 Just send me an URL in https://gplinks.co/xxx format\n\n" \
-           "🧑🏻‍💻 Created by [@Anonyadmin](https://t.me/Anonyadmin)\n" \
-           "🔎 GitHub: [Click Here](nun)\n" \
-           "🎁 Donate: UPI - `nun`"
-
-    # If this server is marked as Development Server then only reply to developer (owner)
-    if in_developer_mode():
-        text = text + f"\n\n" \
-                      "⚙️ Currently I am in Developer Mode\n" \
-                      f"🫡 I will only respond to [@{DEVELOPER_TELEGRAM_USERNAME}]({DEVELOPER_TELEGRAM_LINK})"
+    text = welcome_text(message)
 
     # Send the message as a reply to the sender's message
-    bot.send_message(message.chat.id, text=text, reply_to_message_id=message.message_id, parse_mode='Markdown',
-                     disable_web_page_preview=True)
+    send_scheduler.reply_to(bot, message.chat.id, message.message_id, text, parse_mode='Markdown',
+                            disable_web_page_preview=True)
 
     # Log the incoming message for analytics purposes
-    logger.info("Received /start through %s", message.json)
-
-
-# Check if Developer's Telegram Channel is defined in constants.py
-# If yes, then check if user is subscribed to the channel and return True or False
-def user_is_subscribed_to_telegram_channel(user_id: int) -> bool:
-    if DEVELOPER_TELEGRAM_CHANNEL_ID is not None:
-        try:
-            # Check if user is already subscribed to the Developer's Telegram Channel
-            # For this to work, you need to add this bot as an Admin of the Channel
-            chat_member = bot.get_chat_member(chat_id=DEVELOPER_TELEGRAM_CHANNEL_ID, user_id=user_id)
-            if chat_member.status in ["creator", "administrator", "member"]:
-                # User is already subscribed to the Developer's Telegram Channel
-                return True
-            else:
-                # User is not subscribed to the Developer's Telegram Channel
-                return False
-
-        except ApiTelegramException:
-            # User has never subscribed to the Developer's Telegram Channel
-            return False
-    else:
-        # Since Developer's Telegram Channel ID isn't defined in constants.py,
-        # Do not check anything and return True
-        return True
+    log_analytics(logger, "start", message)
 
 
-# Handle any incoming message sent to the Telegram bot
-@bot.message_handler(func=lambda msg: True)
+# Handle any incoming message sent to the Telegram bot which got through the gates (see message_gates.py)
+# The message (or the caption of a forwarded post) may contain several gplinks.co links, they are all bypassed
 def echo_all(message: Message):
-    # If this server is marked as Development Server then only reply to developer (owner)
-    if in_developer_mode():
-        # Message Sender isn't developer (owner)
-        if message.chat.username != DEVELOPER_TELEGRAM_USERNAME:
-            # Inform that bot only replies to developer (owner) as a reply to the sender's message
-            text = "⚙️ Currently I am in Developer Mode\n" \
-                   f"🫡 I will only respond to [@{DEVELOPER_TELEGRAM_USERNAME}]({DEVELOPER_TELEGRAM_LINK})"
-            bot.send_message(message.chat.id, text=text, reply_to_message_id=message.message_id,
-                             disable_web_page_preview=True)
-
-            # Log request made by sender other than developer for analytics purposes
-            logger.info("Received Message From Non-Dev %s", str({'message': message.json}))
-            return
-
-    # If user is not subscribed to the channel, ask them to subscribe for the bot to work for them
-    # If the user is already subscribed to the channel, then do the actual purpose of the bot
-    if not user_is_subscribed_to_telegram_channel(user_id=message.chat.id):
-        # User is not subscribed to the Developer's Telegram Channel
-        # Ask them to subscribe
-        text = f"**Join [this channel]({DEVELOPER_TELEGRAM_CHANNEL_LINK}) to use this bot**\n\n" \
-               f"{DEVELOPER_TELEGRAM_CHANNEL_LINK_ESCAPED}"
-        bot.send_message(chat_id=message.chat.id, text=text, reply_to_message_id=message.message_id,
-                         disable_web_page_preview=True, parse_mode='Markdown')
-
-        # Log the incoming message for analytics purposes
-        logger.info("Received Message from unsubscribed user %s", str({'message': message.json}))
+    # Messages without a gplinks.co URL are answered right away, they neither count against the rate limit
+    # nor wait for a bypass worker
+    urls = extract_gplinks_urls(message, max_links=MULTI_LINK_MAX_LINKS)
+    if not urls:
+        error = gplinks_url_error(message.text or message.caption or "") or INVALID_URL_TEXT
+        send_scheduler.reply_to(bot, message.chat.id, message.message_id, error)
+        log_analytics(logger, bypass_outcome(error), message, result=error)
+        return
+
+    # Every chat can only start a limited number of bypasses per minute
+    if not chat_rate_limiter.allow(message.chat.id):
+        send_scheduler.reply_to(bot, message.chat.id, message.message_id, RATE_LIMITED_TEXT)
+        log_analytics(logger, "rate_limited", message)
+        return
+
+    # Queue the bypass, the update worker is free again as soon as it is queued
+    # The job stays in the queue until the reply with the result is sent, even if the app is restarted meanwhile
+    # It is added leased by this worker, another worker only takes it over if this one dies
+    # The text of the job is the list of the URLs, one per line
+    job = bypass_job_consumer.add(message.chat.id, message.chat.username, message.message_id, "\n".join(urls),
+                                  max_unfinished=BYPASS_JOB_MAX_UNFINISHED)
+    if job is None:
+        # Too many bypasses are waiting, tell the user right away instead of letting the request time out
+        send_scheduler.reply_to(bot, message.chat.id, message.message_id, BUSY_TEXT)
+        log_analytics(logger, "busy", message)
         return
 
     # Inform the sender that bot is online and has received their message
-    processing_msg = bot.reply_to(message, "Processing... Please Wait")
+    # The reply waits in the send scheduler, its message_id is saved with the job once it is sent
+    job.placeholder = send_scheduler.reply_to(bot, message.chat.id, message.message_id, PROCESSING_TEXT)
+    job.placeholder.future.add_done_callback(lambda _: save_placeholder(job))
+    bypass_job_consumer.schedule(job)
+
+
+# Saves the message_id of the 'Processing...' reply, so that a worker which takes the job over can edit it
+def save_placeholder(job: QueuedJob):
+    if job.placeholder.future.exception() is None:
+        bypass_job_queue.set_placeholder(job.job_id, job.placeholder.future.result().message_id)
+
+
+# Replaces the 'Processing...' reply of the job with text, returns the Future of the Bot API call
+def reply_to_job(job: QueuedJob, text: str) -> Future:
+    if job.placeholder is not None:
+        # If the placeholder was not sent yet, it is sent with the text instead (see SendScheduler.replace_text)
+        return send_scheduler.replace_text(job.placeholder, text).future
+    if job.placeholder_message_id is not None:
+        # A job taken over from another worker
+        return send_scheduler.submit(bot, job.chat_id, "edit_message_text", text=text,
+                                     message_id=job.placeholder_message_id).future
+    # The worker died before the placeholder was sent
+    return send_scheduler.reply_to(bot, job.chat_id, job.message_id, text).future
+
+
+# The reply to a message with several links, every link followed by its result or by PROCESSING_TEXT
+def multi_link_reply(urls: list[str], replies: list[str | None]) -> str:
+    return "\n\n".join("%s\n%s" % (url, PROCESSING_TEXT if reply is None else reply)
+                       for url, reply in zip(urls, replies))
+
+
+# Resolves the URLs with gplinks_bypasser_handle_request, MULTI_LINK_CONCURRENCY at a time on the link resolver
+# on_progress(replies) is called after every resolved URL, replies holds None for the URLs which are not done yet
+def gplinks_bypass_urls(urls: list[str], on_progress: Callable[[list[str | None]], None]) -> list[str]:
+    replies: list[str | None] = [None] * len(urls)
+    indexes: dict[Future, int] = {}
+    next_index = 0
+    while next_index < len(urls) or indexes:
+        while next_index < len(urls) and len(indexes) < MULTI_LINK_CONCURRENCY:
+            indexes[link_resolver.submit(gplinks_bypasser_handle_request, urls[next_index])] = next_index
+            next_index += 1
+        done, _ = wait(indexes, return_when=FIRST_COMPLETED)
+        for future in done:
+            index = indexes.pop(future)
+            if future.exception() is not None:
+                logger.error("Bypass of %s failed: %s", urls[index], future.exception())
+            replies[index] = ERROR_TEXT if future.exception() is not None else future.result()
+        if indexes or next_index < len(urls):
+            on_progress(replies)
+    return replies
+
+
+# Runs on the bypass scheduler
+def run_bypass_job(job: QueuedJob) -> Future:
+    # Bypass the gplinks.co URLs and get the bypassed URLs
+    urls = job.text.split()
+    if len(urls) == 1:
+        replies = [gplinks_bypasser_handle_request(urls[0])]
+        reply = replies[0]
+    else:
+        # The reply shows the links which are done while the others are still being bypassed
+        # (The edits are coalesced by the send scheduler when they come faster than the chat's rate limit)
+        def show_progress(progress: list[str | None]):
+            if job.placeholder is not None:
+                send_scheduler.replace_text(job.placeholder, multi_link_reply(urls, progress),
+                                            disable_web_page_preview=True)
+
+        replies = gplinks_bypass_urls(urls, on_progress=show_progress)
+        reply = multi_link_reply(urls, replies)
+
+    # Replace the 'Processing...' message with the bypassed URLs
+    # (Editing the message in place saves deleting it and sending a new reply)
+    sent = reply_to_job(job, reply)
+
+    # Log the bypassed URLs for analytics purposes, one entry per URL
+    for url, bypassed_url in zip(urls, replies):
+        log_analytics_fields(logger, bypass_outcome(bypassed_url), job.chat_id, job.username, job.message_id, url,
+                             result=bypassed_url)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Link cache %s, scraper pool %s, bypass scheduler %s, rate limiter %s, job queue %s, "
+                     "send scheduler %s, circuit breaker %s", link_cache.stats(), scraper_pool.stats(),
+                     bypass_scheduler.stats(), chat_rate_limiter.stats(), bypass_job_consumer.stats(),
+                     send_scheduler.stats(), gplinks_breaker.stats())
+    return sent
+
+
+# Runs instead of run_bypass_job for a job whose worker died every time it ran it (e.g. a bypass crashing the worker)
+def give_up_bypass_job(job: QueuedJob) -> Future:
+    urls = job.text.split()
+    sent = reply_to_job(job, ERROR_TEXT if len(urls) == 1 else multi_link_reply(urls, [ERROR_TEXT] * len(urls)))
+    for url in urls:
+        log_analytics_fields(logger, bypass_outcome(ERROR_TEXT), job.chat_id, job.username, job.message_id, url,
+                             result=ERROR_TEXT, attempts=job.attempts)
+    return sent
+
+
+# Moves the queued bypasses of all the workers to the bypass scheduler of this worker
+bypass_job_consumer = JobQueueConsumer(bypass_job_queue, bypass_scheduler, run=run_bypass_job,
+                                       give_up=give_up_bypass_job, batch_size=BYPASS_JOB_BATCH_SIZE,
+                                       lease_seconds=BYPASS_JOB_LEASE_SECONDS,
+                                       poll_interval_seconds=BYPASS_JOB_POLL_INTERVAL_SECONDS,
+                                       max_attempts=BYPASS_JOB_MAX_ATTEMPTS)
+
+
+# Messages with a text or a caption which may contain links
+MESSAGE_CONTENT_TYPES = ['text', 'photo', 'video', 'document', 'animation', 'audio', 'voice']
+
+
+# Register the handlers, the developer mode and channel subscription gates are put in front of echo_all once here
+if bot is not None:
+    bot.register_message_handler(send_welcome, commands=['start', 'help'])
+    bot.register_message_handler(build_message_chain(bot, logger, echo_all), func=lambda msg: True,
+                                 content_types=MESSAGE_CONTENT_TYPES)
+
+
+# The GPLinks endpoints used while bypassing (GPLINKS_TRACK_URL, GPLINKS_GO_URL) are set in constants.py
+# Returns the URL to fetch the short URL from, which is the short URL itself unless GPLINKS_SHORT_URL_ORIGIN is set
+def gplinks_fetch_url(url: str) -> str:
+    if GPLINKS_SHORT_URL_ORIGIN is None:
+        return url
+    return GPLINKS_SHORT_URL_ORIGIN.rstrip("/") + urlsplit(url).path
+
+
+# deadline (a time.monotonic() value) ends the attempt, every request may only take the rest of the time until then
+# Raises ScraperPoolExhaustedError if no scraper session became free in time, GPLinks was not even asked then
+def gplinks_bypass(url: str, deadline: float):
+    url = gplinks_fetch_url(url)
+    try:
+        # Check out a session from the pool, it is recycled if anything below fails
+        with scraper_pool.session(timeout=remaining_seconds(deadline)) as client:
+            # Visitor ID provided by GPLinks that stores the session
+            vid = client.get(url, allow_redirects=False,
+                             timeout=remaining_seconds(deadline)).headers["Location"].split("=")[-1]
+
+            # Convince GPLink that visitor has already visited the 3rd ads page and clicked continue
+            for i in range(3):
+                client.post(url=GPLINKS_TRACK_URL,
+                            data={"request": "addVisitorImps", "vid": vid}, timeout=remaining_seconds(deadline))
+
+            client.post(url=GPLINKS_TRACK_URL,
+                        data={"request": "setVisitor", "vid": vid, "status": 3}, timeout=remaining_seconds(deadline))
+
+            # Request to get the final GPLink verification page
+            go_url = f"{url}/?vid={vid}"
+            response = client.get(go_url, allow_redirects=False, timeout=remaining_seconds(deadline))
+
+            # Find the final GPLink verification page link in the webpage
+            # (Only the go-link form is parsed, see go_link_extractor.py)
+            data = extract_go_link_form(response.content, encoding=response.encoding or "utf-8")
+
+            # GPLinks doesn't provide the actual link if the requests are too fast
+            # (Not worth waiting for if there would be no time left for the final request)
+            if remaining_seconds(deadline) <= GPLINKS_GO_DELAY_SECONDS:
+                raise DeadlineExceededError("No time left for the final request")
+            time.sleep(GPLINKS_GO_DELAY_SECONDS)
+
+            # Final request to get the actual bypassed link
+            bypassed_url = client.post(url=GPLINKS_GO_URL,
+                                       data=data,
+                                       headers={"x-requested-with": "XMLHttpRequest"},
+                                       timeout=remaining_seconds(deadline)
+                                       ).json()["url"]
+            return bypassed_url
+    except ScraperPoolExhaustedError:
+        raise
+    except Exception as ex:
+        logger.error(ex)
+        return None
 
-    # Bypass the gplinks.co URL and get the bypassed URL
-    bypassed_url = gplinks_bypasser_handle_request(message.text)
 
-    # Delete the 'Processing...' message
-    bot.delete_message(chat_id=message.chat.id, message_id=processing_msg.message_id)
+# Replies of gplinks_bypasser_handle_request other than the bypassed URL
+MALFORMED_URL_TEXT = "Malformed URL"
+INVALID_URL_TEXT = "Invalid URL\n" \
+                   "Please send your URL in https://gplinks.co/xxx format"
+ERROR_TEXT = "Error"
+UNAVAILABLE_TEXT = "⚠️ GPLinks is not responding right now, please try again in a few minutes"
 
-    # Reply to the sender's gplinks.co URL with the bypassed URL
-    bot.reply_to(message, bypassed_url)
+# Reply of echo_all while the bypass is running
+PROCESSING_TEXT = "Processing... Please Wait"
 
-    # Log the incoming message and bypassed URL for analytics purposes
-    logger.info("Received Message %s", str({'message': message.json, 'bypassed_url': bypassed_url}))
+# Replies of echo_all when the bypass is not started
+BUSY_TEXT = "⏳ I am busy right now, please try again in a minute"
+RATE_LIMITED_TEXT = "🐢 You are sending links too fast, please wait a minute before sending the next one"
 
 
-def gplinks_bypass(url: str):
-    try:
-        # Since only cloudscraper can bypass Cloudflare bot detection
-        client = cloudscraper.create_scraper(allow_brotli=False)
-
-        # Visitor ID provided by GPLinks that stores the session
-        vid = client.get(url, allow_redirects=False).headers["Location"].split("=")[-1]
-
-        # Convince GPLink that visitor has already visited the 3rd ads page and clicked continue
-        for i in range(3):
-            client.post(url="https://gplinks.in/track/data.php",
-                        data={"request": "addVisitorImps", "vid": vid})
-
-        client.post(url="https://gplinks.in/track/data.php",
-                    data={"request": "setVisitor", "vid": vid, "status": 3})
-
-        # Request to get the final GPLink verification page
-        go_url = f"{url}/?vid={vid}"
-        response = client.get(go_url, allow_redirects=False)
-        soup = BeautifulSoup(response.content, "html.parser")
-
-        data = {}
-
-        # Find the final GPLink verification page link in the webpage
-        go_link_form = soup.find_all(id="go-link")
-        for form_elem in go_link_form:
-            if form_elem is not None:
-                inputs = form_elem.find_all("input")
-                for input_elem in inputs:
-                    data[input_elem.get('name')] = input_elem.get('value')
-
-        # GPLinks doesn't provide the actual link if the requests are too fast
-        time.sleep(1)
-
-        # Final request to get the actual bypassed link
-        bypassed_url = client.post(url="https://gplinks.co/links/go",
-                                   data=data,
-                                   headers={"x-requested-with": "XMLHttpRequest"}
-                                   ).json()["url"]
-        return bypassed_url
-    except Exception as ex:
-        logger.error(ex)
-        return None
+# Outcome of a reply of gplinks_bypasser_handle_request for analytics
+def bypass_outcome(reply: str) -> str:
+    return {MALFORMED_URL_TEXT: "malformed_url", INVALID_URL_TEXT: "invalid_url", ERROR_TEXT: "error",
+            UNAVAILABLE_TEXT: "unavailable", BUSY_TEXT: "busy"}.get(reply, "bypassed")
 
 
-def gplinks_bypasser_handle_request(url: str):
+# Returns the reply for an URL which can't be bypassed or None if it is a gplinks.co URL
+def gplinks_url_error(url: str) -> str | None:
+    # Imported on first use to keep it out of the startup time
+    import validators
+
     # Malformed URL
     if not validators.url(url):
-        return "Malformed URL"
+        return MALFORMED_URL_TEXT
 
     # URL provided is not a gplinks.co URL
     if "gplinks.co/" not in url:
-        return "Invalid URL\n" \
-               "Please send your URL in https://gplinks.co/xxx format"
+        return INVALID_URL_TEXT
+    return None
 
-    bypass = ""
-    count = 1
 
-    # Loop at least 10 times because a lot of times the link is None
-    while bypass is None or bypass == "":
-        if count >= 10:
-            # Couldn't bypass the URL
-            return "Error"
+def gplinks_bypasser_handle_request(url: str):
+    error = gplinks_url_error(url)
+    if error is not None:
+        return error
 
-        # Try to bypass the URL
-        bypass = gplinks_bypass(url)
-        count += 1
+    # Resolve the URL or reuse the result of an earlier or currently running resolution of the same URL
+    # (Cached links are still answered while the circuit breaker is open)
+    try:
+        bypass = link_cache.get_or_resolve(normalize_short_url(url), gplinks_resolve)
+    except CircuitOpenError:
+        return UNAVAILABLE_TEXT
+    except ScraperPoolExhaustedError:
+        # All the sessions are busy with other bypasses
+        return BUSY_TEXT
+    if bypass is None:
+        # Couldn't bypass the URL
+        return ERROR_TEXT
     return bypass
+
+
+# Tries up to BYPASS_MAX_ATTEMPTS times because a lot of times the link is None, within BYPASS_DEADLINE_SECONDS
+# Raises CircuitOpenError without trying while GPLinks is considered down
+# Raises ScraperPoolExhaustedError if no scraper session became free, which tells nothing about GPLinks,
+# so the circuit breaker does not count it and it is not retried
+def gplinks_resolve(url: str) -> str | None:
+    probe = gplinks_breaker.allow()
+    deadline = time.monotonic() + BYPASS_DEADLINE_SECONDS
+    try:
+        for count in range(1, BYPASS_MAX_ATTEMPTS + 1):
+            # Try to bypass the URL within the rest of the budget
+            started_at = time.perf_counter()
+            bypass = gplinks_bypass(url, deadline=deadline)
+            observe_bypass_attempt(logger.name, bool(bypass), time.perf_counter() - started_at)
+            if bypass:
+                observe_bypass_attempts(logger.name, True, count)
+                gplinks_breaker.record_success()
+                return bypass
+
+            # Wait a bit before the next attempt, unless the budget would be spent by then
+            delay = backoff_seconds(count, BYPASS_BACKOFF_BASE_SECONDS, BYPASS_BACKOFF_MAX_SECONDS)
+            if count == BYPASS_MAX_ATTEMPTS or time.monotonic() + delay >= deadline:
+                break
+            time.sleep(delay)
+
+        # Couldn't bypass the URL
+        observe_bypass_attempts(logger.name, False, count)
+        gplinks_breaker.record_failure()
+        return None
+    except ScraperPoolExhaustedError:
+        gplinks_breaker.record_skipped(probe)
+        raise
+    except BaseException:
+        gplinks_breaker.record_failure()
+        raise
@@ -0,0 +1,232 @@
+import asyncio
+import time
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Message
+from telegram_bots.async_runtime import AsgiApp, AsgiRequest, AsgiResponse, dispatch_update_async, \
+    create_scraper_session
+from telegram_bots.bot_logging import log_analytics, log_analytics_fields
+from telegram_bots.webhook_registration import ensure_webhook_async
+from telegram_bots.update_decoding import decode_update
+from telegram_bots.metrics import observe_bypass_attempt, observe_bypass_attempts
+from telegram_bots.channel_membership import register_channel_membership_handler_async
+from telegram_bots.message_gates import build_message_chain_async
+from telegram_bots.go_link_extractor import extract_go_link_form
+from telegram_bots.link_cache import normalize_short_url
+from telegram_bots.link_extraction import extract_gplinks_urls
+from telegram_bots.retry_policy import CircuitOpenError, backoff_seconds, remaining_seconds
+from telegram_bots.gplinks_bypasser_telegram_bot import logger, WEB_ROUTE, WEBHOOK_URL, BOT_TOKEN, \
+    ERROR_TEXT, GPLINKS_TRACK_URL, GPLINKS_GO_URL, GPLINKS_GO_DELAY_SECONDS, welcome_text, \
+    gplinks_url_error, gplinks_fetch_url, bypass_outcome, link_cache, gplinks_breaker, UNAVAILABLE_TEXT, \
+    BYPASS_MAX_ATTEMPTS, BYPASS_DEADLINE_SECONDS, BYPASS_BACKOFF_BASE_SECONDS, BYPASS_BACKOFF_MAX_SECONDS, \
+    MULTI_LINK_MAX_LINKS, MULTI_LINK_CONCURRENCY, PROCESSING_TEXT, INVALID_URL_TEXT, MESSAGE_CONTENT_TYPES, \
+    multi_link_reply
+
+# Browser headers for the scraping requests
+# (Unlike cloudscraper, aiohttp cannot solve Cloudflare JavaScript challenges, it can only look like a browser)
+SCRAPER_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+                  "Chrome/114.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+# The AsyncTeleBot object of the pyTelegramBotAPI library
+# Same bot as in gplinks_bypasser_telegram_bot.py, used when the bots are served by the async runtime (see asgi.py)
+async_bot: AsyncTeleBot | None = None
+if BOT_TOKEN is not None:
+    async_bot = AsyncTeleBot(BOT_TOKEN)
+
+    # Keep the shared channel membership cache up to date when users join or leave the channel
+    register_channel_membership_handler_async(async_bot)
+
+
+def register_async_route(asgi_app: AsgiApp):
+    logger.debug("Adding Async Route %s", WEB_ROUTE)
+
+    # Add the URL route to the ASGI app and associate trigger coroutine on request
+    asgi_app.add_route(WEB_ROUTE, gp_link_bypass_process_webhook_trigger_async, methods=("POST",))
+
+
+async def register_async_webhook():
+    logger.debug("Registering Webhook at %s", WEBHOOK_URL)
+
+    # Only registers the webhook if Telegram doesn't already have it
+    await ensure_webhook_async(async_bot, WEBHOOK_URL, logger)
+
+
+async def gp_link_bypass_process_webhook_trigger_async(request: AsgiRequest) -> AsgiResponse:
+    if request.headers.get('content-type') == 'application/json':
+        # Parse the JSON POST data, the Telebot Update is built when the handlers run
+        try:
+            update = decode_update(request.body)
+        except ValueError:
+            return AsgiResponse(status=400)
+
+        # Schedule the handlers on the event loop and acknowledge the update right away
+        if not await dispatch_update_async(async_bot, WEB_ROUTE, update):
+            # Too many updates are pending, 503 makes Telegram redeliver the update later
+            logger.warning("Update queue is full, rejecting update %s", update.update_id)
+            return AsgiResponse(status=503)
+
+        # Message accepted, now return 204 No Content
+        return AsgiResponse(status=204)
+    else:
+        # Telegram did not trigger the Webhook, return 403 Forbidden
+        return AsgiResponse(status=403)
+
+
+# Handle /start and /help messages sent to the Telegram bot
+async def send_welcome_async(message: Message):
+    # Send the message as a reply to the sender's message
+    await async_bot.send_message(message.chat.id, text=welcome_text(message), reply_to_message_id=message.message_id,
+                                 parse_mode='Markdown', disable_web_page_preview=True)
+
+    # Log the incoming message for analytics purposes
+    log_analytics(logger, "start", message)
+
+
+# Handle any incoming message sent to the Telegram bot which got through the gates (see message_gates.py)
+async def echo_all_async(message: Message):
+    urls = extract_gplinks_urls(message, max_links=MULTI_LINK_MAX_LINKS)
+    if not urls:
+        error = gplinks_url_error(message.text or message.caption or "") or INVALID_URL_TEXT
+        await async_bot.reply_to(message, error)
+        log_analytics(logger, bypass_outcome(error), message, result=error)
+        return
+
+    # Inform the sender that bot is online and has received their message
+    processing_msg = await async_bot.reply_to(message, PROCESSING_TEXT)
+
+    # Bypass the gplinks.co URLs and get the bypassed URLs
+    if len(urls) == 1:
+        replies = [await gplinks_bypasser_handle_request_async(urls[0])]
+        reply = replies[0]
+    else:
+        replies = await gplinks_bypass_urls_async(urls, message.chat.id, processing_msg.message_id)
+        reply = multi_link_reply(urls, replies)
+
+    # Replace the 'Processing...' message with the bypassed URLs
+    await async_bot.edit_message_text(reply, chat_id=message.chat.id, message_id=processing_msg.message_id)
+
+    # Log the bypassed URLs for analytics purposes, one entry per URL
+    for url, bypassed_url in zip(urls, replies):
+        log_analytics_fields(logger, bypass_outcome(bypassed_url), message.chat.id, message.chat.username,
+                             message.message_id, url, result=bypassed_url)
+
+
+# Same as gplinks_bypass_urls of gplinks_bypasser_telegram_bot.py, the progress is edited into the reply right away
+# (One edit at a time, an edit which would only be overtaken by the next one is skipped)
+async def gplinks_bypass_urls_async(urls: list[str], chat_id: int, message_id: int) -> list[str]:
+    replies: list[str | None] = [None] * len(urls)
+    semaphore = asyncio.Semaphore(MULTI_LINK_CONCURRENCY)
+    editing = asyncio.Lock()
+
+    async def bypass(index: int):
+        async with semaphore:
+            replies[index] = await gplinks_bypasser_handle_request_async(urls[index])
+        if None in replies and not editing.locked():
+            async with editing:
+                try:
+                    await async_bot.edit_message_text(multi_link_reply(urls, replies), chat_id=chat_id,
+                                                      message_id=message_id, disable_web_page_preview=True)
+                except Exception as ex:
+                    logger.error(ex)
+
+    await asyncio.gather(*(bypass(index) for index in range(len(urls))))
+    return replies
+
+
+# Register the handlers, the gates are put in front of echo_all_async once here
+if async_bot is not None:
+    async_bot.register_message_handler(send_welcome_async, commands=['start', 'help'])
+    async_bot.register_message_handler(build_message_chain_async(async_bot, logger, echo_all_async),
+                                       func=lambda msg: True, content_types=MESSAGE_CONTENT_TYPES)
+
+
+# Same as gplinks_bypass of gplinks_bypasser_telegram_bot.py with aiohttp and asyncio.sleep
+async def gplinks_bypass_async(url: str) -> str | None:
+    url = gplinks_fetch_url(url)
+    try:
+        async with create_scraper_session(headers=SCRAPER_HEADERS) as client:
+            # Visitor ID provided by GPLinks that stores the session
+            async with client.get(url, allow_redirects=False) as response:
+                vid = response.headers["Location"].split("=")[-1]
+
+            # Convince GPLink that visitor has already visited the 3rd ads page and clicked continue
+            for i in range(3):
+                async with client.post(GPLINKS_TRACK_URL, data={"request": "addVisitorImps", "vid": vid}):
+                    pass
+
+            async with client.post(GPLINKS_TRACK_URL, data={"request": "setVisitor", "vid": vid, "status": 3}):
+                pass
+
+            # Request to get the final GPLink verification page
+            async with client.get(f"{url}/?vid={vid}", allow_redirects=False) as response:
+                content = await response.read()
+                encoding = response.charset or "utf-8"
+
+            # Find the final GPLink verification page link in the webpage
+            data = extract_go_link_form(content, encoding=encoding)
+
+            # GPLinks doesn't provide the actual link if the requests are too fast
+            # (Only this coroutine waits, the event loop keeps serving the other requests)
+            await asyncio.sleep(GPLINKS_GO_DELAY_SECONDS)
+
+            # Final request to get the actual bypassed link
+            async with client.post(GPLINKS_GO_URL, data=data,
+                                   headers={"x-requested-with": "XMLHttpRequest"}) as response:
+                return (await response.json(content_type=None))["url"]
+    except Exception as ex:
+        logger.error(ex)
+        return None
+
+
+async def gplinks_bypasser_handle_request_async(url: str) -> str:
+    error = gplinks_url_error(url)
+    if error is not None:
+        return error
+
+    # Resolve the URL or reuse the result of an earlier or currently running resolution of the same URL
+    try:
+        bypass = await link_cache.get_or_resolve_async(normalize_short_url(url), gplinks_resolve_async)
+    except CircuitOpenError:
+        return UNAVAILABLE_TEXT
+    if bypass is None:
+        # Couldn't bypass the URL
+        return ERROR_TEXT
+    return bypass
+
+
+# Same as gplinks_resolve with the same circuit breaker, an attempt is cancelled once the budget is spent
+# A cancelled resolution (e.g. on shutdown) tells nothing about GPLinks, so the circuit breaker does not count it
+async def gplinks_resolve_async(url: str) -> str | None:
+    probe = gplinks_breaker.allow()
+    deadline = time.monotonic() + BYPASS_DEADLINE_SECONDS
+    try:
+        for count in range(1, BYPASS_MAX_ATTEMPTS + 1):
+            started_at = time.perf_counter()
+            bypass = None
+            try:
+                bypass = await asyncio.wait_for(gplinks_bypass_async(url), remaining_seconds(deadline))
+            except asyncio.TimeoutError:
+                logger.error("Bypass attempt of %s ran out of time", url)
+            observe_bypass_attempt(logger.name, bool(bypass), time.perf_counter() - started_at)
+            if bypass:
+                observe_bypass_attempts(logger.name, True, count)
+                gplinks_breaker.record_success()
+                return bypass
+
+            delay = backoff_seconds(count, BYPASS_BACKOFF_BASE_SECONDS, BYPASS_BACKOFF_MAX_SECONDS)
+            if count == BYPASS_MAX_ATTEMPTS or time.monotonic() + delay >= deadline:
+                break
+            await asyncio.sleep(delay)
+
+        observe_bypass_attempts(logger.name, False, count)
+        gplinks_breaker.record_failure()
+        return None
+    except asyncio.CancelledError:
+        gplinks_breaker.record_skipped(probe)
+        raise
+    except BaseException:
+        gplinks_breaker.record_failure()
+        raise
@@ -0,0 +1,319 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from typing import Callable, TYPE_CHECKING
+from telegram_bots.fair_scheduler import FairScheduler
+
+if TYPE_CHECKING:
+    from telegram_bots.send_scheduler import OutboundCall
+
+logger = logging.getLogger(__name__)
+
+
+# A bypass waiting in or taken from the SQLiteJobQueue
+# placeholder_message_id is the "Processing..." reply which is edited with the result, None until it is sent
+class QueuedJob:
+    def __init__(self, job_id: int, chat_id: int, username: str | None, message_id: int,
+                 placeholder_message_id: int | None, text: str, attempts: int):
+        self.job_id = job_id
+        self.chat_id = chat_id
+        self.username = username
+        self.message_id = message_id
+        self.placeholder_message_id = placeholder_message_id
+        self.text = text
+
+        # Number of times the job was started, including this time (taking a job which is given back right away
+        # because the scheduler is full does not count)
+        self.attempts = attempts
+
+        # The placeholder reply while it is queued on the send scheduler, only known to the process which added the job
+        self.placeholder: "OutboundCall | None" = None
+
+
+# Durable queue of bypass jobs in a SQLite file shared by the worker processes
+# A worker takes jobs with a lease and deletes them when they are done
+# A job whose lease runs out, e.g. because the worker was killed by a restart, is taken again by the next worker
+# journal_mode is DELETE for a file on a network file system such as Azure's /home share, WAL (like the link cache)
+# only works on a local disk since it needs shared memory
+# The file is created by the first use, not by the constructor, so a bot which is not run creates nothing
+class SQLiteJobQueue:
+    def __init__(self, path: str, journal_mode: str = "DELETE"):
+        self.path = path
+        self.journal_mode = journal_mode
+        self._local = threading.local()
+        self._create_lock = threading.Lock()
+        self._created = False
+
+    # sqlite3 connections cannot be shared between threads, so every thread gets its own connection
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if not self._created:
+                self._create()
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            # NORMAL is only safe against power loss with WAL
+            connection.execute("PRAGMA synchronous=%s" % ("NORMAL" if self.journal_mode == "WAL" else "FULL"))
+            self._local.connection = connection
+        return connection
+
+    def _create(self):
+        with self._create_lock:
+            if self._created:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            try:
+                connection.execute("PRAGMA journal_mode=%s" % self.journal_mode)
+                connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                                   "job_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                   "chat_id INTEGER NOT NULL, "
+                                   "username TEXT, "
+                                   "message_id INTEGER NOT NULL, "
+                                   "placeholder_message_id INTEGER, "
+                                   "text TEXT NOT NULL, "
+                                   "created_at REAL NOT NULL, "
+                                   "attempts INTEGER NOT NULL DEFAULT 0, "
+                                   "lease_owner TEXT, "
+                                   "lease_expires_at REAL NOT NULL DEFAULT 0)")
+                connection.execute("CREATE INDEX IF NOT EXISTS jobs_lease_expires_at ON jobs (lease_expires_at)")
+            finally:
+                connection.close()
+            self._created = True
+
+    # Adds a job, returns its id or None if max_unfinished jobs are already waiting or running
+    # With an owner, the job is added with a lease of the owner (i.e. taken by the owner right away)
+    def enqueue(self, chat_id: int, username: str | None, message_id: int, placeholder_message_id: int | None,
+                text: str, max_unfinished: int, owner: str | None = None, lease_seconds: float = 0) -> int | None:
+        connection = self._connection()
+        # IMMEDIATE takes the write lock right away, so the count cannot change before the insert
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] >= max_unfinished:
+                connection.execute("ROLLBACK")
+                return None
+            now = time.time()
+            job_id = connection.execute("INSERT INTO jobs (chat_id, username, message_id, placeholder_message_id, "
+                                        "text, created_at, attempts, lease_owner, lease_expires_at) "
+                                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        (chat_id, username, message_id, placeholder_message_id, text, now,
+                                         0 if owner is None else 1, owner,
+                                         0 if owner is None else now + lease_seconds)).lastrowid
+            connection.execute("COMMIT")
+            return job_id
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    # Takes up to limit jobs without a valid lease, oldest first, in one transaction
+    def dequeue(self, owner: str, limit: int, lease_seconds: float) -> list[QueuedJob]:
+        connection = self._connection()
+        now = time.time()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = connection.execute("SELECT job_id, chat_id, username, message_id, placeholder_message_id, text, "
+                                      "attempts + 1 FROM jobs WHERE lease_expires_at <= ? ORDER BY job_id LIMIT ?",
+                                      (now, limit)).fetchall()
+            connection.executemany("UPDATE jobs SET lease_owner = ?, lease_expires_at = ?, attempts = attempts + 1 "
+                                   "WHERE job_id = ?", [(owner, now + lease_seconds, row[0]) for row in rows])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return [QueuedJob(*row) for row in rows]
+
+    # Records the placeholder once it is sent, so that a worker which takes the job over can edit it
+    def set_placeholder(self, job_id: int, placeholder_message_id: int):
+        self._connection().execute("UPDATE jobs SET placeholder_message_id = ? WHERE job_id = ?",
+                                   (placeholder_message_id, job_id))
+
+    # Extends the leases of the jobs which the owner is still working on
+    def renew(self, owner: str, job_ids: list[int], lease_seconds: float):
+        self._connection().executemany("UPDATE jobs SET lease_expires_at = ? WHERE job_id = ? AND lease_owner = ?",
+                                       [(time.time() + lease_seconds, job_id, owner) for job_id in job_ids])
+
+    # Gives the jobs back to the queue when they could not be started, taking them did not count as an attempt
+    def release(self, owner: str, job_ids: list[int]):
+        self._connection().executemany("UPDATE jobs SET lease_owner = NULL, lease_expires_at = 0, "
+                                       "attempts = attempts - 1 WHERE job_id = ? AND lease_owner = ?",
+                                       [(job_id, owner) for job_id in job_ids])
+
+    # Deletes the finished jobs, unless another worker took them over after their lease ran out
+    def complete(self, owner: str, job_ids: list[int]):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany("DELETE FROM jobs WHERE job_id = ? AND lease_owner = ?",
+                                   [(job_id, owner) for job_id in job_ids])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def unfinished(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+
+# Moves the jobs of a SQLiteJobQueue to a FairScheduler in this worker process
+# A background thread takes as many jobs as the scheduler has room for in one batch, renews the leases of the jobs
+# which are waiting or running here, and deletes the finished jobs in batches
+# run(job) does the work, a job taken more than max_attempts times (i.e. its worker died every time) is passed
+# to give_up(job) instead, as is a job whose run(job) raised, so that the job is answered before it is deleted
+# Both may return a Future (e.g. of the reply waiting in the send scheduler), the job is only finished once it is done
+class JobQueueConsumer:
+    def __init__(self, queue: SQLiteJobQueue, scheduler: FairScheduler, run: Callable[[QueuedJob], Future | None],
+                 give_up: Callable[[QueuedJob], Future | None], batch_size: int, lease_seconds: float,
+                 poll_interval_seconds: float, max_attempts: int):
+        self.queue = queue
+        self.scheduler = scheduler
+        self.run = run
+        self.give_up = give_up
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self.max_attempts = max_attempts
+
+        # Identifies the leases of this process
+        self.owner = "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: threading.Thread | None = None
+
+        # Jobs taken by this process which are not finished yet, and finished jobs which are not deleted yet
+        self._held: set[int] = set()
+        self._finished: list[int] = []
+
+        # Counters for monitoring
+        self.batches = 0
+        self.taken = 0
+        self.recovered = 0
+        self.completed = 0
+        self.given_up = 0
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "taken": self.taken, "recovered": self.recovered,
+                "completed": self.completed, "given_up": self.given_up, "held": len(self._held)}
+
+    # Starts the consumer thread, which also picks up the jobs left over by the previous run of the app
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._consume, name="job-queue-consumer", daemon=True)
+                self._thread.start()
+
+    # Adds a job leased by this process, returns None if max_unfinished jobs are already waiting or running
+    # Run it here with schedule(job), other workers only take it over if this process dies
+    def add(self, chat_id: int, username: str | None, message_id: int, text: str,
+            max_unfinished: int) -> QueuedJob | None:
+        job_id = self.queue.enqueue(chat_id, username, message_id, None, text, max_unfinished=max_unfinished,
+                                    owner=self.owner, lease_seconds=self.lease_seconds)
+        if job_id is None:
+            return None
+        with self._lock:
+            self._held.add(job_id)
+        self.taken += 1
+        return QueuedJob(job_id, chat_id, username, message_id, None, text, attempts=1)
+
+    # Runs a job added by add() on the scheduler of this process
+    # If the scheduler is full, the job is given back to the queue for the next worker with room
+    # (Only once its placeholder is sent, the callbacks of the placeholder registered before, e.g. the one saving
+    # its message_id, have run by then, so the worker taking the job over edits the placeholder instead of replying)
+    def schedule(self, job: QueuedJob):
+        if self.scheduler.submit(job.chat_id, self._run, job):
+            return
+        if job.placeholder is None:
+            self._release(job)
+        else:
+            job.placeholder.future.add_done_callback(lambda _: self._release(job))
+
+    def _release(self, job: QueuedJob):
+        with self._lock:
+            self._held.discard(job.job_id)
+        self.queue.release(self.owner, [job.job_id])
+        self._wakeup.set()
+
+    def _consume(self):
+        renewed_at = time.monotonic()
+        while True:
+            self._wakeup.clear()
+            try:
+                self._delete_finished()
+                if time.monotonic() - renewed_at >= self.lease_seconds / 3:
+                    with self._lock:
+                        held = list(self._held)
+                    if held:
+                        self.queue.renew(self.owner, held, self.lease_seconds)
+                    renewed_at = time.monotonic()
+                jobs = self._take()
+            except Exception:
+                logger.exception("Job queue consumer failed")
+                jobs = []
+            if not jobs:
+                self._wakeup.wait(self.poll_interval_seconds)
+
+    def _take(self) -> list[QueuedJob]:
+        room = min(self.batch_size, self.scheduler.max_pending - self.scheduler.pending)
+        if room <= 0:
+            return []
+        jobs = self.queue.dequeue(self.owner, room, self.lease_seconds)
+        if not jobs:
+            return jobs
+
+        self.batches += 1
+        self.taken += len(jobs)
+        rejected = []
+        for job in jobs:
+            with self._lock:
+                self._held.add(job.job_id)
+            if not self.scheduler.submit(job.chat_id, self._run, job):
+                with self._lock:
+                    self._held.discard(job.job_id)
+                rejected.append(job.job_id)
+            elif job.attempts > 1:
+                # Started before by a worker which did not finish it
+                self.recovered += 1
+        if rejected:
+            self.queue.release(self.owner, rejected)
+        return jobs
+
+    def _run(self, job: QueuedJob):
+        pending = None
+        try:
+            if job.attempts > self.max_attempts:
+                self.given_up += 1
+                pending = self.give_up(job)
+            else:
+                try:
+                    pending = self.run(job)
+                except Exception:
+                    logger.exception("Job %s failed, giving up on it", job.job_id)
+                    self.given_up += 1
+                    pending = self.give_up(job)
+        finally:
+            if pending is None:
+                self._finish(job)
+            else:
+                pending.add_done_callback(lambda _: self._finish(job))
+
+    def _finish(self, job: QueuedJob):
+        with self._lock:
+            self._held.discard(job.job_id)
+            self._finished.append(job.job_id)
+        self._wakeup.set()
+
+    def _delete_finished(self):
+        with self._lock:
+            finished, self._finished = self._finished, []
+        if finished:
+            try:
+                self.queue.complete(self.owner, finished)
+            except Exception:
+                with self._lock:
+                    self._finished.extend(finished)
+                raise
+            self.completed += len(finished)
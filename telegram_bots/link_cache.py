@@ -0,0 +1,248 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Awaitable, Callable
+from urllib.parse import urlsplit
+
+
+# Normalizes a short URL so that the same link sent in different forms shares one cache entry
+# https://www.GPLinks.co/abc/?utm=x and http://gplinks.co/abc both become https://gplinks.co/abc
+# (The path is kept as is since short link codes are case-sensitive)
+def normalize_short_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[len("www."):]
+    return "https://%s%s" % (host, parts.path.rstrip("/"))
+
+
+# SQLite storage for the resolved links so that all gunicorn workers share hits and hits survive restarts
+# WAL mode lets the workers read while another worker is writing
+# (Do not place it on a network file system such as Azure's /home share, WAL needs shared memory)
+class SQLiteLinkStore:
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS resolved_links ("
+                           "short_url TEXT PRIMARY KEY, "
+                           "resolved_url TEXT NOT NULL, "
+                           "expires_at REAL NOT NULL, "
+                           "accessed_at REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS resolved_links_accessed_at ON resolved_links (accessed_at)")
+
+    # sqlite3 connections cannot be shared between threads, so every thread gets its own connection
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    # Returns the resolved URL and when it expires, or None
+    def get(self, short_url: str, now: float) -> tuple[str, float] | None:
+        connection = self._connection()
+        row = connection.execute("SELECT resolved_url, expires_at FROM resolved_links "
+                                 "WHERE short_url = ? AND expires_at > ?", (short_url, now)).fetchone()
+        if row is None:
+            return None
+        connection.execute("UPDATE resolved_links SET accessed_at = ? WHERE short_url = ?", (now, short_url))
+        return row[0], row[1]
+
+    def put(self, short_url: str, resolved_url: str, expires_at: float, now: float):
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO resolved_links VALUES (?, ?, ?, ?)",
+                           (short_url, resolved_url, expires_at, now))
+
+        # Evict expired and least recently used entries every now and then instead of on every write
+        self._writes += 1
+        if self._writes % 100 == 0:
+            connection.execute("DELETE FROM resolved_links WHERE expires_at <= ?", (now,))
+            connection.execute("DELETE FROM resolved_links WHERE short_url IN ("
+                               "SELECT short_url FROM resolved_links ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                               (self.max_entries,))
+
+
+# Cache of resolved short links with TTL and LRU eviction
+# Concurrent requests for the same link join the resolution which is already running (single-flight)
+# Only successful resolutions are cached, a failed resolution is retried by the next request
+class ResolvedLinkCache:
+    def __init__(self, ttl_seconds: float, max_entries: int, store: SQLiteLinkStore | None = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.store = store
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._in_flight: dict[str, Future] = {}
+
+        # Counters for monitoring
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "joined": self.joined, "size": len(self._entries)}
+
+    def get(self, short_url: str) -> str | None:
+        resolved_url = self._recall(short_url)
+        if resolved_url is None and self.store is not None:
+            resolved_url = self._load(short_url)
+        return resolved_url
+
+    # Same as get for the async runtime, the SQLite store is read on a thread so that the event loop does not wait
+    # (The entries in memory in front of the store are still looked up right away)
+    async def get_async(self, short_url: str) -> str | None:
+        resolved_url = self._recall(short_url)
+        if resolved_url is None and self.store is not None:
+            resolved_url = await asyncio.to_thread(self._load, short_url)
+        return resolved_url
+
+    def put(self, short_url: str, resolved_url: str):
+        now = time.time()
+        self._remember(short_url, resolved_url, now + self.ttl_seconds)
+        if self.store is not None:
+            self.store.put(short_url, resolved_url, now + self.ttl_seconds, now)
+
+    async def put_async(self, short_url: str, resolved_url: str):
+        if self.store is None:
+            self.put(short_url, resolved_url)
+        else:
+            await asyncio.to_thread(self.put, short_url, resolved_url)
+
+    # The entry in memory, if it has not expired
+    def _recall(self, short_url: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(short_url)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(short_url)
+                    return entry[1]
+                del self._entries[short_url]
+        return None
+
+    # The entry in the store, which is remembered in memory as well until it expires in the store
+    def _load(self, short_url: str) -> str | None:
+        row = self.store.get(short_url, time.time())
+        if row is None:
+            return None
+        resolved_url, expires_at = row
+        self._remember(short_url, resolved_url, expires_at)
+        return resolved_url
+
+    def _remember(self, short_url: str, resolved_url: str, expires_at: float):
+        with self._lock:
+            self._entries[short_url] = (expires_at, resolved_url)
+            self._entries.move_to_end(short_url)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # Returns the future of the resolution of short_url which is in flight and False,
+    # or registers a new future and returns it with True if this caller has to resolve short_url itself
+    def _join_or_lead(self, short_url: str) -> tuple[Future, bool]:
+        with self._lock:
+            future = self._in_flight.get(short_url)
+            if future is not None:
+                self.joined += 1
+                return future, False
+            future = Future()
+            self._in_flight[short_url] = future
+            return future, True
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _finish(self, short_url: str, future: Future, resolved_url: str | None):
+        if resolved_url is not None:
+            self.put(short_url, resolved_url)
+        future.set_result(resolved_url)
+
+    def _forget(self, short_url: str):
+        with self._lock:
+            del self._in_flight[short_url]
+
+    # Returns the cached resolution of short_url or resolves it with resolve(short_url)
+    # resolve should return None when the link could not be resolved
+    def get_or_resolve(self, short_url: str, resolve: Callable[[str], str | None]) -> str | None:
+        resolved_url = self.get(short_url)
+        if resolved_url is not None:
+            self._count(hit=True)
+            return resolved_url
+
+        # Another thread is already resolving this link, wait for its result
+        future, leader = self._join_or_lead(short_url)
+        if not leader:
+            return future.result()
+
+        try:
+            # The previous resolution may have finished between the lookup above and taking the lead
+            resolved_url = self.get(short_url)
+            if resolved_url is not None:
+                self._count(hit=True)
+                future.set_result(resolved_url)
+                return resolved_url
+
+            self._count(hit=False)
+            resolved_url = resolve(short_url)
+            self._finish(short_url, future, resolved_url)
+            return resolved_url
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        finally:
+            self._forget(short_url)
+
+    # Same as get_or_resolve for the async runtime, resolve is a coroutine function
+    # (Threads and coroutines resolving the same link join each other's resolution)
+    async def get_or_resolve_async(self, short_url: str,
+                                   resolve: Callable[[str], Awaitable[str | None]]) -> str | None:
+        resolved_url = await self.get_async(short_url)
+        if resolved_url is not None:
+            self._count(hit=True)
+            return resolved_url
+
+        future, leader = self._join_or_lead(short_url)
+        if not leader:
+            return await asyncio.wrap_future(future)
+
+        try:
+            resolved_url = await self.get_async(short_url)
+            if resolved_url is not None:
+                self._count(hit=True)
+                future.set_result(resolved_url)
+                return resolved_url
+
+            self._count(hit=False)
+            resolved_url = await resolve(short_url)
+            if resolved_url is not None:
+                await self.put_async(short_url, resolved_url)
+            future.set_result(resolved_url)
+            return resolved_url
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        finally:
+            self._forget(short_url)
+
+
+# Creates the cache configured by the LINK_CACHE_* constants
+def create_link_cache(backend: str, ttl_seconds: float, max_entries: int, storage_path: str) -> ResolvedLinkCache:
+    store = None
+    if backend == "sqlite":
+        store = SQLiteLinkStore(os.path.join(storage_path, "resolved_links.sqlite3"), max_entries)
+    return ResolvedLinkCache(ttl_seconds=ttl_seconds, max_entries=max_entries, store=store)
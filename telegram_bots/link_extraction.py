@@ -0,0 +1,48 @@
+import re
+from telebot.types import Message
+from telegram_bots.link_cache import normalize_short_url
+
+# A gplinks.co short URL in plain text, the scheme and www. are optional
+# It must not continue another host name, evilgplinks.co/abc or sub.gplinks.co/abc are not gplinks.co links
+GPLINKS_URL_PATTERN = re.compile(r"(?<![\w.-])(?:https?://)?(?:www\.)?gplinks\.co/[A-Za-z0-9_-]+", re.IGNORECASE)
+
+
+# Telegram counts entity offsets and lengths in UTF-16 code units, which differ from str indexes for emoji
+def utf16_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def utf16_slice(text: str, offset: int, length: int) -> str:
+    return text.encode("utf-16-le")[offset * 2:(offset + length) * 2].decode("utf-16-le", errors="ignore")
+
+
+# Returns the gplinks.co short URLs of a message in the order they appear, normalized and without duplicates
+# The URLs are taken from the text or the caption (e.g. of a forwarded photo post) and from its url and text_link
+# entities, the latter carry the URLs hidden behind link texts
+# At most max_links URLs are returned
+def extract_gplinks_urls(message: Message, max_links: int) -> list[str]:
+    if message.text is not None:
+        text, entities = message.text, message.entities
+    else:
+        text, entities = message.caption or "", message.caption_entities
+
+    # (position in UTF-16 code units, URL) of every candidate, plain text matches cover messages without entities
+    candidates = [(utf16_length(text[:match.start()]), match.group(0)) for match in GPLINKS_URL_PATTERN.finditer(text)]
+    for entity in entities or ():
+        if entity.type == "text_link":
+            candidates.append((entity.offset, entity.url))
+        elif entity.type == "url":
+            candidates.append((entity.offset, utf16_slice(text, entity.offset, entity.length)))
+
+    urls = {}
+    for _, candidate in sorted(candidates, key=lambda position_and_url: position_and_url[0]):
+        match = GPLINKS_URL_PATTERN.search(candidate or "")
+        if match is None:
+            continue
+        url = match.group(0)
+        if "://" not in url:
+            url = "https://" + url
+        urls.setdefault(normalize_short_url(url), None)
+        if len(urls) >= max_links:
+            break
+    return list(urls)
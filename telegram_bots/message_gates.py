@@ -0,0 +1,140 @@
+import logging
+import time
+from typing import Awaitable, Callable, TYPE_CHECKING
+from telebot import TeleBot
+from telebot.types import Message
+from constants import DEVELOPER_MODE, DEVELOPER_TELEGRAM_USERNAME, DEVELOPER_TELEGRAM_LINK, \
+    DEVELOPER_TELEGRAM_CHANNEL_ID, DEVELOPER_TELEGRAM_CHANNEL_LINK, DEVELOPER_TELEGRAM_CHANNEL_LINK_ESCAPED
+from telegram_bots.bot_logging import log_analytics
+from telegram_bots.metrics import observe_stage
+from telegram_bots.send_scheduler import send_scheduler
+from telegram_bots.channel_membership import user_is_subscribed_to_telegram_channel, \
+    user_is_subscribed_to_telegram_channel_async
+
+# AsyncTeleBot needs aiohttp, which is only installed for the async runtime
+if TYPE_CHECKING:
+    from telebot.async_telebot import AsyncTeleBot
+
+# Reply to the users other than the developer (owner) while this server is marked as Development Server
+DEVELOPER_MODE_TEXT = "⚙️ Currently I am in Developer Mode\n" \
+                      f"🫡 I will only respond to [@{DEVELOPER_TELEGRAM_USERNAME}]({DEVELOPER_TELEGRAM_LINK})"
+
+# Reply to the users who aren't subscribed to the Developer's Telegram Channel
+SUBSCRIBE_TEXT = f"**Join [this channel]({DEVELOPER_TELEGRAM_CHANNEL_LINK}) to use this bot**\n\n" \
+                 f"{DEVELOPER_TELEGRAM_CHANNEL_LINK_ESCAPED}"
+
+# A gate answers the messages which must not reach the handler of the bot
+# It returns True if it answered the message, then the rest of the chain is skipped
+MessageGate = Callable[[Message], bool]
+MessageHandler = Callable[[Message], None]
+AsyncMessageGate = Callable[[Message], Awaitable[bool]]
+AsyncMessageHandler = Callable[[Message], Awaitable[None]]
+
+
+# If this server is marked as Development Server then only the developer (owner) gets through
+# Returns None if the server isn't in developer mode, so that the chain does not contain the gate at all
+def developer_mode_gate(bot: TeleBot, logger: logging.Logger) -> MessageGate | None:
+    if not DEVELOPER_MODE:
+        return None
+
+    def gate(message: Message) -> bool:
+        if message.chat.username == DEVELOPER_TELEGRAM_USERNAME:
+            return False
+
+        # Inform that bot only replies to developer (owner) as a reply to the sender's message
+        send_scheduler.reply_to(bot, message.chat.id, message.message_id, DEVELOPER_MODE_TEXT,
+                                disable_web_page_preview=True)
+
+        # Log request made by sender other than developer for analytics purposes
+        log_analytics(logger, "developer_mode", message)
+        return True
+    return gate
+
+
+# If user is not subscribed to the Developer's Telegram Channel, ask them to subscribe for the bot to work for them
+# Returns None if no channel is defined in constants.py
+# (The membership is cached and shared by all the bots, see channel_membership.py)
+def subscription_gate(bot: TeleBot, logger: logging.Logger) -> MessageGate | None:
+    if DEVELOPER_TELEGRAM_CHANNEL_ID is None:
+        return None
+
+    def gate(message: Message) -> bool:
+        if user_is_subscribed_to_telegram_channel(bot, user_id=message.chat.id):
+            return False
+
+        send_scheduler.reply_to(bot, message.chat.id, message.message_id, SUBSCRIBE_TEXT,
+                                disable_web_page_preview=True, parse_mode='Markdown')
+        log_analytics(logger, "unsubscribed", message)
+        return True
+    return gate
+
+
+# Puts the gates in front of the handler of the bot
+# Built once when the bot is created, so a message only passes through the gates which are enabled on this server
+# The time spent in every gate is recorded in the metrics under the name of the gate
+def build_message_chain(bot: TeleBot, logger: logging.Logger, handler: MessageHandler) -> MessageHandler:
+    gates = [(stage, gate) for stage, gate in (("developer_mode_gate", developer_mode_gate(bot, logger)),
+                                               ("subscription_gate", subscription_gate(bot, logger)))
+             if gate is not None]
+    if not gates:
+        return handler
+
+    def chain(message: Message):
+        for stage, gate in gates:
+            started_at = time.perf_counter()
+            answered = gate(message)
+            observe_stage(logger.name, stage, time.perf_counter() - started_at)
+            if answered:
+                return
+        handler(message)
+    return chain
+
+
+# Same as developer_mode_gate for the AsyncTeleBot of the async runtime
+def developer_mode_gate_async(bot: "AsyncTeleBot", logger: logging.Logger) -> AsyncMessageGate | None:
+    if not DEVELOPER_MODE:
+        return None
+
+    async def gate(message: Message) -> bool:
+        if message.chat.username == DEVELOPER_TELEGRAM_USERNAME:
+            return False
+        await bot.send_message(message.chat.id, text=DEVELOPER_MODE_TEXT, reply_to_message_id=message.message_id,
+                               disable_web_page_preview=True)
+        log_analytics(logger, "developer_mode", message)
+        return True
+    return gate
+
+
+# Same as subscription_gate for the AsyncTeleBot of the async runtime
+def subscription_gate_async(bot: "AsyncTeleBot", logger: logging.Logger) -> AsyncMessageGate | None:
+    if DEVELOPER_TELEGRAM_CHANNEL_ID is None:
+        return None
+
+    async def gate(message: Message) -> bool:
+        if await user_is_subscribed_to_telegram_channel_async(bot, user_id=message.chat.id):
+            return False
+        await bot.send_message(message.chat.id, text=SUBSCRIBE_TEXT, reply_to_message_id=message.message_id,
+                               disable_web_page_preview=True, parse_mode='Markdown')
+        log_analytics(logger, "unsubscribed", message)
+        return True
+    return gate
+
+
+# Same as build_message_chain for the AsyncTeleBot of the async runtime
+def build_message_chain_async(bot: "AsyncTeleBot", logger: logging.Logger,
+                              handler: AsyncMessageHandler) -> AsyncMessageHandler:
+    gates = [(stage, gate) for stage, gate in (("developer_mode_gate", developer_mode_gate_async(bot, logger)),
+                                               ("subscription_gate", subscription_gate_async(bot, logger)))
+             if gate is not None]
+    if not gates:
+        return handler
+
+    async def chain(message: Message):
+        for stage, gate in gates:
+            started_at = time.perf_counter()
+            answered = await gate(message)
+            observe_stage(logger.name, stage, time.perf_counter() - started_at)
+            if answered:
+                return
+        await handler(message)
+    return chain
@@ -0,0 +1,159 @@
+import functools
+import glob
+import os
+from constants import METRICS_PATH, create_directories
+
+# prometheus_client decides at import time whether the values are kept in memory or in files shared by the workers,
+# so the directory has to be set before it is imported (gunicorn.conf.py sets it in the gunicorn master already)
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", create_directories(METRICS_PATH))
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, \
+    multiprocess
+
+# Histogram buckets in seconds
+# Stages inside the worker take microseconds to milliseconds, requests to other services milliseconds to seconds
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+# Jobs may wait for a worker from milliseconds to minutes when many bypasses are queued
+QUEUE_WAIT_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# The bot label is the name of the bot's logger, which is also the name of its log directory (e.g. echo_telegram_bot)
+STAGE_SECONDS = Histogram("telegram_bot_stage_seconds", "Time spent in a stage of handling an update",
+                          ["bot", "stage"], buckets=STAGE_BUCKETS)
+UPDATES = Counter("telegram_bot_webhook_updates", "Webhook updates by result (accepted, rejected, malformed)",
+                  ["bot", "result"])
+BOT_API_REQUEST_SECONDS = Histogram("telegram_bot_api_request_seconds", "Duration of the outbound Bot API requests",
+                                    ["bot", "method", "status"], buckets=REQUEST_BUCKETS)
+BYPASS_ATTEMPT_SECONDS = Histogram("gplinks_bypass_attempt_seconds", "Duration of a single gplinks_bypass attempt",
+                                   ["bot", "outcome"], buckets=REQUEST_BUCKETS)
+BYPASS_ATTEMPTS = Histogram("gplinks_bypass_attempts", "gplinks_bypass attempts needed to resolve a short URL",
+                            ["bot", "outcome"], buckets=tuple(range(1, 11)))
+SEND_QUEUE_DEPTH = Gauge("telegram_bot_send_queue_depth", "Bot API calls waiting in the send scheduler",
+                         multiprocess_mode="livesum")
+TOO_MANY_REQUESTS = Counter("telegram_bot_api_too_many_requests", "Bot API calls answered with 429 Too Many Requests",
+                            ["bot"])
+
+# The scheduler and limiter labels are the names of the FairScheduler and ChatRateLimiter (see fair_scheduler.py)
+SCHEDULER_PENDING = Gauge("fair_scheduler_pending", "Jobs waiting for a worker of the fair scheduler", ["scheduler"],
+                          multiprocess_mode="livesum")
+SCHEDULER_WAIT_SECONDS = Histogram("fair_scheduler_wait_seconds", "Time a job waited for a worker of the scheduler",
+                                   ["scheduler"], buckets=QUEUE_WAIT_BUCKETS)
+SCHEDULER_REJECTIONS = Counter("fair_scheduler_rejections", "Jobs rejected because the fair scheduler was full",
+                               ["scheduler"])
+CHAT_RATE_LIMITED = Counter("chat_rate_limited", "Requests refused because the chat exceeded its rate limit",
+                            ["limiter"])
+
+# Every worker has its own circuit breaker, the state is the worst one of the live workers
+# (0 closed, 1 half-open, 2 open, see retry_policy.py)
+CIRCUIT_BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+CIRCUIT_BREAKER_STATE = Gauge("upstream_circuit_breaker_state", "State of the circuit breaker of an upstream service",
+                              ["upstream"], multiprocess_mode="livemax")
+CIRCUIT_BREAKER_REJECTIONS = Counter("upstream_circuit_breaker_rejections",
+                                     "Calls failed fast because the circuit breaker was open", ["upstream"])
+
+# Bot API tokens of the bots, the outbound requests only carry the token
+_bot_names: dict[str, str] = {}
+
+
+# Called when a bot is added to the webhook dispatcher or the polling runner
+def name_bot_token(token: str, bot: str):
+    _bot_names[token] = bot
+
+
+# The labelled children are cached, labels() takes a lock and builds the label tuple on every call
+@functools.lru_cache(maxsize=None)
+def _stage(bot: str, stage: str):
+    return STAGE_SECONDS.labels(bot, stage)
+
+
+@functools.lru_cache(maxsize=None)
+def _updates(bot: str, result: str):
+    return UPDATES.labels(bot, result)
+
+
+@functools.lru_cache(maxsize=None)
+def _bot_api_request(bot: str, method: str, status: str):
+    return BOT_API_REQUEST_SECONDS.labels(bot, method, status)
+
+
+def observe_stage(bot: str, stage: str, seconds: float):
+    _stage(bot, stage).observe(seconds)
+
+
+def count_update(bot: str, result: str):
+    _updates(bot, result).inc()
+
+
+# url is a Bot API URL, .../bot<token>/<method>, status the HTTP status or "error" if no response was received
+def observe_bot_api_request(url: str, status: str, seconds: float):
+    _, token, method = url.split("?", 1)[0].rsplit("/", 2)
+    _bot_api_request(_bot_names.get(token[len("bot"):], "unknown"), method, status).observe(seconds)
+
+
+def set_send_queue_depth(depth: int):
+    SEND_QUEUE_DEPTH.set(depth)
+
+
+@functools.lru_cache(maxsize=None)
+def _scheduler_pending(scheduler: str):
+    return SCHEDULER_PENDING.labels(scheduler)
+
+
+@functools.lru_cache(maxsize=None)
+def _scheduler_wait(scheduler: str):
+    return SCHEDULER_WAIT_SECONDS.labels(scheduler)
+
+
+def set_scheduler_pending(scheduler: str, pending: int):
+    _scheduler_pending(scheduler).set(pending)
+
+
+def observe_scheduler_wait(scheduler: str, seconds: float):
+    _scheduler_wait(scheduler).observe(seconds)
+
+
+def count_scheduler_rejection(scheduler: str):
+    SCHEDULER_REJECTIONS.labels(scheduler).inc()
+
+
+def count_chat_rate_limited(limiter: str):
+    CHAT_RATE_LIMITED.labels(limiter).inc()
+
+
+def count_too_many_requests(token: str):
+    TOO_MANY_REQUESTS.labels(_bot_names.get(token, "unknown")).inc()
+
+
+def set_circuit_breaker_state(upstream: str, state: str):
+    CIRCUIT_BREAKER_STATE.labels(upstream).set(CIRCUIT_BREAKER_STATES[state])
+
+
+def count_circuit_breaker_rejection(upstream: str):
+    CIRCUIT_BREAKER_REJECTIONS.labels(upstream).inc()
+
+
+def observe_bypass_attempt(bot: str, succeeded: bool, seconds: float):
+    BYPASS_ATTEMPT_SECONDS.labels(bot, "success" if succeeded else "failure").observe(seconds)
+
+
+def observe_bypass_attempts(bot: str, succeeded: bool, attempts: int):
+    BYPASS_ATTEMPTS.labels(bot, "success" if succeeded else "failure").observe(attempts)
+
+
+# The metrics of all the worker processes in the Prometheus text format
+def generate_metrics() -> tuple[bytes, str]:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+# Removes the values of earlier runs, called by gunicorn.conf.py before the workers are started
+def clear_metrics():
+    for path in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+        os.remove(path)
+
+
+# Called by gunicorn.conf.py when a worker exits
+# Counters and histograms of the worker stay in the sums, only its live gauges are dropped
+def worker_exited(pid: int):
+    multiprocess.mark_process_dead(pid)
@@ -0,0 +1,123 @@
+import logging
+import threading
+from concurrent.futures import wait
+from telebot import TeleBot, util
+from constants import POLLING_BATCH_SIZE, POLLING_CONCURRENCY, POLLING_TIMEOUT_SECONDS
+from telegram_bots.update_executor import KeyedUpdateExecutor, update_chat_key
+from telegram_bots.webhook_registration import forget_webhook_registration
+from telegram_bots.metrics import name_bot_token
+
+# Longest wait between two getUpdates calls after errors
+MAX_RETRY_DELAY_SECONDS = 30
+
+
+# A bot run by the PollingRunner
+class PolledBot:
+    def __init__(self, bot: TeleBot, name: str, logger: logging.Logger):
+        self.bot = bot
+        self.name = name
+        self.logger = logger
+
+        # update_id of the next update to fetch, all the updates before it are handled
+        self.offset: int | None = None
+
+        # Counters for monitoring
+        self.batches = 0
+        self.updates = 0
+
+
+# Runs the bots with getUpdates long polling instead of webhooks, e.g. on a machine without a public HTTPS endpoint
+# Every bot has a thread which fetches the updates in batches of up to batch_size
+# The updates of a batch are handled concurrently on a shared KeyedUpdateExecutor (in order per chat),
+# the offset is only moved past the batch once all of its handlers have finished,
+# so an update that was fetched but not handled yet is fetched again after a restart
+class PollingRunner:
+    def __init__(self, batch_size: int = POLLING_BATCH_SIZE, concurrency: int = POLLING_CONCURRENCY,
+                 timeout_seconds: int = POLLING_TIMEOUT_SECONDS):
+        self.batch_size = batch_size
+        self.timeout_seconds = timeout_seconds
+        self.bots: list[PolledBot] = []
+
+        # Every bot has at most one batch in the executor at a time
+        self.executor = KeyedUpdateExecutor(max_workers=concurrency, max_queue_depth=batch_size,
+                                            thread_name_prefix="polling-worker")
+        self._stopped = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    # Called by TelegramBot.register_polling of every bot
+    def add_bot(self, name: str, bot: TeleBot, logger: logging.Logger):
+        self.bots.append(PolledBot(bot, name, logger))
+        name_bot_token(bot.token, logger.name)
+
+    # Starts polling every bot, returns immediately
+    def start(self):
+        # A bot with a webhook cannot use getUpdates
+        # The webhooks have to be registered again when the bots are served by app.py next time
+        forget_webhook_registration()
+        self.executor.max_queue_depth = self.batch_size * max(len(self.bots), 1)
+
+        for polled in self.bots:
+            polled.bot.remove_webhook()
+            thread = threading.Thread(target=self._poll, args=(polled,), name="polling-%s" % polled.name)
+            thread.start()
+            self._threads.append(thread)
+
+    # Stops fetching new batches, the batches being handled are finished and committed
+    def stop(self):
+        self._stopped.set()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _poll(self, polled: PolledBot):
+        retry_delay = 1
+        while not self._stopped.is_set():
+            try:
+                updates = polled.bot.get_updates(offset=polled.offset, limit=self.batch_size,
+                                                 timeout=self.timeout_seconds, allowed_updates=util.update_types,
+                                                 long_polling_timeout=self.timeout_seconds)
+                retry_delay = 1
+            except Exception as ex:
+                polled.logger.error("getUpdates failed, retrying in %d s: %s", retry_delay, ex)
+                self._stopped.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY_SECONDS)
+                continue
+            if not updates:
+                continue
+
+            self._handle_batch(polled, updates)
+
+        # getUpdates confirms the updates before the offset, commit the last batch before exiting
+        # (pyTelegramBotAPI replaces a long_polling_timeout of 0 with its 20 s default, 1 s is the shortest wait;
+        # an update returned by this call is not confirmed, so Telegram delivers it again to the next run)
+        if polled.offset is not None:
+            try:
+                polled.bot.get_updates(offset=polled.offset, limit=1, timeout=5, long_polling_timeout=1)
+            except Exception as ex:
+                polled.logger.error("Could not commit the polling offset %s: %s", polled.offset, ex)
+
+    def _handle_batch(self, polled: PolledBot, updates: list):
+        futures = []
+        for update in updates:
+            # Handlers of the same chat run in order, the handlers of different chats concurrently
+            future = self.executor.submit((polled.name, update_chat_key(update)), polled.bot.process_new_updates,
+                                          [update])
+            if future is None:
+                # Cannot happen since the queue holds a whole batch of every bot, handle it right here then
+                polled.bot.process_new_updates([update])
+            else:
+                futures.append(future)
+
+        # Failed handlers are logged by the executor, their updates are committed like the others
+        # (A failing update would otherwise be fetched again forever)
+        wait(futures)
+
+        polled.offset = updates[-1].update_id + 1
+        polled.batches += 1
+        polled.updates += len(updates)
+        polled.logger.debug("Handled a batch of %d updates, next offset %d", len(updates), polled.offset)
+
+    def stats(self) -> dict:
+        return {polled.name: {"batches": polled.batches, "updates": polled.updates, "offset": polled.offset}
+                for polled in self.bots}
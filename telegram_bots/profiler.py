@@ -0,0 +1,226 @@
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from constants import PROFILES_PATH, PROFILER_SAMPLE_INTERVAL_SECONDS, PROFILER_MAX_SECONDS, \
+    PROFILER_TRACEMALLOC_FRAMES, PROFILER_TOP_ALLOCATIONS, create_directories
+
+logger = logging.getLogger(__name__)
+
+
+# Raised by WorkerProfiler.start when a profile is already running in this worker
+class ProfilerBusyError(RuntimeError):
+    pass
+
+
+# What section() returns while no requests are sampled, entering and leaving it does nothing
+class _NoSection:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_SECTION = _NoSection()
+
+
+# A sampled piece of work, the stack sampler records the thread while it is inside
+class _Section:
+    def __init__(self, profiler: "WorkerProfiler"):
+        self.profiler = profiler
+
+    def __enter__(self):
+        self.profiler._traced_threads.add(threading.get_ident())
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler._traced_threads.discard(threading.get_ident())
+        return False
+
+
+# Profiles the worker process it runs in, turned on at runtime (see the /admin/profile route in app.py)
+# - The stack sampler is a thread which records the stacks of the other threads every sample_interval_seconds,
+#   wall-clock time, so waiting in sockets, locks and time.sleep shows up as well as running Python code
+#   It writes PROFILES_PATH/profile-<pid>-<time>.collapsed, one "frame;frame;... count" line per stack,
+#   which flamegraph.pl, speedscope or inferno turn into a flame graph
+# - tracemalloc traces the allocations of the whole process while the profile runs, the top allocations
+#   (growth since the start) are written to PROFILES_PATH/profile-<pid>-<time>-allocations.txt
+# With a fraction below 1, only the threads inside a section() are sampled, and only that fraction of the sections
+# (the handling of an update or a bypass job) is picked
+# When no profile runs, section() returns NO_SECTION after checking one attribute and nothing else is done
+class WorkerProfiler:
+    def __init__(self, path: str, sample_interval_seconds: float, max_seconds: float, tracemalloc_frames: int,
+                 top_allocations: int):
+        self.path = path
+        self.sample_interval_seconds = sample_interval_seconds
+        self.max_seconds = max_seconds
+        self.tracemalloc_frames = tracemalloc_frames
+        self.top_allocations = top_allocations
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+        # Settings of the running profile, section_fraction is only set while sections are sampled
+        self.section_fraction: float | None = None
+        self._traced_threads: set[int] = set()
+        self._stacks: Counter[str] = Counter()
+        self._labels: dict = {}
+        self._baseline: tracemalloc.Snapshot | None = None
+        self._started_tracemalloc = False
+        self._running: dict | None = None
+
+        # Files written by the last profile of this worker
+        self.last_files: list[str] = []
+
+    @property
+    def running(self) -> bool:
+        return self._running is not None
+
+    def status(self) -> dict:
+        return {"pid": os.getpid(), "running": self._running, "last_files": self.last_files}
+
+    # Starts a profile which stops by itself after seconds (at most max_seconds), returns the status
+    def start(self, seconds: float, stacks: bool = True, allocations: bool = False, fraction: float = 1) -> dict:
+        if not stacks and not allocations:
+            raise ValueError("Nothing to profile, enable stacks and/or allocations")
+        if not 0 < fraction <= 1:
+            raise ValueError("fraction must be in (0, 1]")
+        seconds = min(max(seconds, 1), self.max_seconds)
+
+        with self._lock:
+            if self._running is not None:
+                raise ProfilerBusyError("A profile is already running in worker %d" % os.getpid())
+            started_at = datetime.now()
+            self._running = {"started_at": started_at.isoformat(timespec="seconds"), "seconds": seconds,
+                             "stacks": stacks, "allocations": allocations, "fraction": fraction}
+            name = "profile-%d-%s" % (os.getpid(), started_at.strftime("%Y%m%d-%H%M%S"))
+
+            self._stacks = Counter()
+            if allocations:
+                self._started_tracemalloc = not tracemalloc.is_tracing()
+                if self._started_tracemalloc:
+                    tracemalloc.start(self.tracemalloc_frames)
+                self._baseline = tracemalloc.take_snapshot()
+            if stacks and fraction < 1:
+                self.section_fraction = fraction
+
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._profile, args=(name, seconds, stacks, allocations),
+                                            name="profiler", daemon=True)
+            self._thread.start()
+        logger.warning("Profiling worker %d for %s s: %s", os.getpid(), seconds, self._running)
+        return self.status()
+
+    # Stops the running profile early, returns the status once the files are written
+    def stop(self) -> dict:
+        thread = self._thread
+        self._stop.set()
+        if thread is not None:
+            thread.join()
+        return self.status()
+
+    # Called around a piece of work which may be sampled, e.g. with profiler.section(): handle(update)
+    def section(self):
+        fraction = self.section_fraction
+        if fraction is None or random.random() >= fraction:
+            return NO_SECTION
+        return _Section(self)
+
+    def _profile(self, name: str, seconds: float, stacks: bool, allocations: bool):
+        files = []
+        try:
+            deadline = time.monotonic() + seconds
+            if stacks:
+                own_ident = threading.get_ident()
+                while not self._stop.wait(self.sample_interval_seconds) and time.monotonic() < deadline:
+                    self._sample(own_ident)
+                files.append(self._write_stacks(name))
+            else:
+                self._stop.wait(seconds)
+            if allocations:
+                files.append(self._write_allocations(name))
+        except Exception:
+            logger.exception("Profile %s failed", name)
+        finally:
+            with self._lock:
+                self.section_fraction = None
+                self._traced_threads.clear()
+                self._baseline = None
+                if self._started_tracemalloc:
+                    tracemalloc.stop()
+                    self._started_tracemalloc = False
+                self._stacks = Counter()
+                self._labels = {}
+                self._running = None
+                self._thread = None
+                self.last_files = files
+            logger.warning("Profile of worker %d written to %s", os.getpid(), files)
+
+    def _sample(self, own_ident: int):
+        traced = self._traced_threads if self.section_fraction is not None else None
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident or (traced is not None and ident not in traced):
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(self._label(frame.f_code, frame.f_lineno or 0))
+                frame = frame.f_back
+            frames.append(thread_names.get(ident, "thread-%d" % ident))
+            frames.reverse()
+            self._stacks[";".join(frames)] += 1
+
+    # "function (file:line)", the file relative to the repository or site-packages
+    def _label(self, code, line: int) -> str:
+        key = (code, line)
+        label = self._labels.get(key)
+        if label is None:
+            filename = code.co_filename
+            for prefix in sys.path:
+                if prefix and filename.startswith(prefix + os.sep):
+                    filename = filename[len(prefix) + 1:]
+                    break
+            label = self._labels[key] = "%s (%s:%d)" % (code.co_name, filename, line)
+        return label
+
+    def _write_stacks(self, name: str) -> str:
+        path = os.path.join(create_directories(self.path), name + ".collapsed")
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in self._stacks.most_common():
+                file.write("%s %d\n" % (stack, count))
+        return path
+
+    def _write_allocations(self, name: str) -> str:
+        # The allocations of tracemalloc, of the profiler itself and of the imports are not interesting
+        filters = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__),
+                   tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                   tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"))
+        snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+        baseline = self._baseline.filter_traces(filters)
+        current, peak = tracemalloc.get_traced_memory()
+
+        path = os.path.join(create_directories(self.path), name + "-allocations.txt")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write("Worker %d, traced memory %.1f KiB, peak %.1f KiB\n\n" % (os.getpid(), current / 1024,
+                                                                                 peak / 1024))
+            file.write("Top %d lines by growth since the start of the profile\n" % self.top_allocations)
+            for statistic in snapshot.compare_to(baseline, "lineno")[:self.top_allocations]:
+                file.write("%s\n" % statistic)
+            file.write("\nTop %d allocated blocks by traceback\n" % min(self.top_allocations, 10))
+            for statistic in snapshot.statistics("traceback")[:min(self.top_allocations, 10)]:
+                file.write("\n%s\n" % statistic)
+                file.write("\n".join(statistic.traceback.format(most_recent_first=True)) + "\n")
+        return path
+
+
+# The profiler of this worker process
+profiler = WorkerProfiler(path=PROFILES_PATH, sample_interval_seconds=PROFILER_SAMPLE_INTERVAL_SECONDS,
+                          max_seconds=PROFILER_MAX_SECONDS, tracemalloc_frames=PROFILER_TRACEMALLOC_FRAMES,
+                          top_allocations=PROFILER_TOP_ALLOCATIONS)
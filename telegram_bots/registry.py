@@ -0,0 +1,13 @@
+from typing import Type
+from telegram_bots import TelegramBot
+from telegram_bots.echo_bot import EchoTelegramBot
+from telegram_bots.gplinks_bypasser_telegram_bot import GpLinksBypasserTelegramBot
+
+# Add the Telegram Bots here
+# The list is shared by the Flask app (app.py), the async runtime (asgi.py) and the other entry points
+# If you are in developer mode, then only the first bot will run
+# Only one bot is intended to be tested on developer mode
+TELEGRAM_BOTS: list[Type[TelegramBot]] = [
+    GpLinksBypasserTelegramBot,
+    EchoTelegramBot
+]
@@ -0,0 +1,119 @@
+import logging
+import random
+import threading
+import time
+from telegram_bots.metrics import count_circuit_breaker_rejection, set_circuit_breaker_state
+
+logger = logging.getLogger(__name__)
+
+
+# Raised instead of calling the upstream service while its circuit breaker is open
+class CircuitOpenError(Exception):
+    pass
+
+
+# Raised once the time budget of a request is spent
+class DeadlineExceededError(TimeoutError):
+    pass
+
+
+# Seconds left until the deadline (a time.monotonic() value), raises DeadlineExceededError if there are none
+def remaining_seconds(deadline: float) -> float:
+    seconds = deadline - time.monotonic()
+    if seconds <= 0:
+        raise DeadlineExceededError("Deadline exceeded")
+    return seconds
+
+
+# Seconds to wait before the next attempt, exponential backoff with full jitter
+# attempt is the number of the failed attempts so far (1 after the first one)
+# The random wait keeps the retries of many requests failing at the same time from arriving together
+def backoff_seconds(attempt: int, base_seconds: float, max_seconds: float) -> float:
+    return random.uniform(0, min(max_seconds, base_seconds * 2 ** (attempt - 1)))
+
+
+# Circuit breaker of an upstream service shared by all the requests of this worker process
+# closed:    calls go through, failure_threshold failures in a row open the breaker
+# open:      calls fail fast with CircuitOpenError, after reset_seconds the breaker becomes half-open
+# half-open: one probe call at a time goes through, its success closes the breaker, its failure opens it again
+# A call is allowed with allow() and its result is reported with record_success() or record_failure(),
+# or with record_skipped(probe) if the call could not tell whether the service works (e.g. it never reached it)
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+        # Counters for monitoring
+        self.opened = 0
+        self.rejected = 0
+        self.probes = 0
+
+        set_circuit_breaker_state(name, self._state)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"state": self._current_state(time.monotonic()), "failures": self._failures,
+                    "opened": self.opened, "rejected": self.rejected, "probes": self.probes}
+
+    def _current_state(self, now: float) -> str:
+        if self._state == self.OPEN and now - self._opened_at >= self.reset_seconds:
+            self._set_state(self.HALF_OPEN)
+        return self._state
+
+    def _set_state(self, state: str):
+        if state != self._state:
+            logger.warning("Circuit breaker %s is %s", self.name, state)
+            self._state = state
+            set_circuit_breaker_state(self.name, state)
+
+    # Raises CircuitOpenError if the call has to fail fast, returns True if the call is the half-open probe
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == self.CLOSED:
+                return False
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                self.probes += 1
+                return True
+            self.rejected += 1
+        count_circuit_breaker_rejection(self.name)
+        raise CircuitOpenError("%s is unavailable, circuit breaker is %s" % (self.name, state))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self._set_state(self.CLOSED)
+
+    # Neither a success nor a failure, a probe lets the next call probe instead
+    def record_skipped(self, probe: bool):
+        if probe:
+            with self._lock:
+                self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.opened += 1
+                self._probing = False
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
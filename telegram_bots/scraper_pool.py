@@ -0,0 +1,133 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+from requests import Session
+
+
+# Raised when no session becomes free in time, i.e. the pool is too busy (not a failure of the scraped site)
+class ScraperPoolExhaustedError(TimeoutError):
+    pass
+
+
+# A session of the pool together with the bookkeeping needed for its health checks
+class PooledSession:
+    def __init__(self, session: Session):
+        self.session = session
+        self.created_at = time.monotonic()
+        self.uses = 0
+        self.failed = False
+
+
+# Bounded, thread-safe pool of long-lived HTTP sessions
+# A session is checked out for one resolution and returned afterwards, so its keep-alive connections
+# (and the DNS lookups and TLS handshakes behind them) are reused by the next resolution
+# Sessions are recycled after max_uses checkouts, after max_age_seconds or as soon as a resolution fails with them
+class ScraperSessionPool:
+    def __init__(self, create_session: Callable[[], Session], max_size: int, max_uses: int,
+                 max_age_seconds: float, checkout_timeout_seconds: float):
+        self.create_session = create_session
+        self.max_size = max_size
+        self.max_uses = max_uses
+        self.max_age_seconds = max_age_seconds
+        self.checkout_timeout_seconds = checkout_timeout_seconds
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+        # Idle sessions, the most recently used one is reused first since its connections are most likely still open
+        self._idle: list[PooledSession] = []
+
+        # Counters for monitoring
+        self.in_use = 0
+        self.created = 0
+        self.recycled = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def stats(self) -> dict:
+        return {"max_size": self.max_size, "in_use": self.in_use, "idle": len(self._idle),
+                "created": self.created, "recycled": self.recycled, "checkouts": self.checkouts,
+                "timeouts": self.timeouts, "wait_seconds_total": round(self.wait_seconds_total, 3),
+                "wait_seconds_max": round(self.wait_seconds_max, 3)}
+
+    # Checks out a session for the duration of the with block
+    # The session is recycled if an exception is raised inside the with block
+    # timeout shortens the wait for a free session below checkout_timeout_seconds, e.g. to the rest of a deadline
+    @contextmanager
+    def session(self, timeout: float | None = None) -> Iterator[Session]:
+        pooled = self._checkout(self.checkout_timeout_seconds if timeout is None
+                                else min(timeout, self.checkout_timeout_seconds))
+        try:
+            yield pooled.session
+        except BaseException:
+            pooled.failed = True
+            raise
+        finally:
+            self._checkin(pooled)
+
+    def _checkout(self, timeout: float) -> PooledSession:
+        wait_started_at = time.monotonic()
+        if not self._slots.acquire(timeout=max(timeout, 0)):
+            with self._lock:
+                self.timeouts += 1
+            raise ScraperPoolExhaustedError("No scraper session available after %.1f seconds" % timeout)
+        waited = time.monotonic() - wait_started_at
+
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+            # Take the most recently used healthy session, close the ones that are due for recycling
+            pooled = None
+            while self._idle:
+                candidate = self._idle.pop()
+                if self._is_healthy(candidate):
+                    pooled = candidate
+                    break
+                self._discard(candidate)
+
+        if pooled is None:
+            try:
+                pooled = PooledSession(self.create_session())
+            except BaseException:
+                with self._lock:
+                    self.in_use -= 1
+                self._slots.release()
+                raise
+            with self._lock:
+                self.created += 1
+
+        pooled.uses += 1
+        return pooled
+
+    def _checkin(self, pooled: PooledSession):
+        # Forget the visitor state of this resolution so that it never leaks into the resolution of another user
+        # (Cloudflare clearance cookies are kept since they only prove that the client passed the challenge)
+        for cookie in list(pooled.session.cookies):
+            if not cookie.name.startswith(("cf_", "__cf")):
+                pooled.session.cookies.clear(cookie.domain, cookie.path, cookie.name)
+
+        with self._lock:
+            self.in_use -= 1
+            if self._is_healthy(pooled):
+                self._idle.append(pooled)
+            else:
+                self._discard(pooled)
+        self._slots.release()
+
+    def _is_healthy(self, pooled: PooledSession) -> bool:
+        return not pooled.failed and pooled.uses < self.max_uses and \
+            time.monotonic() - pooled.created_at < self.max_age_seconds
+
+    # Must be called while holding self._lock
+    def _discard(self, pooled: PooledSession):
+        self.recycled += 1
+        try:
+            pooled.session.close()
+        except Exception:
+            pass
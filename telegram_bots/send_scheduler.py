@@ -0,0 +1,300 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Hashable
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+from constants import SEND_WORKERS, SEND_QUEUE_MAX_DEPTH, SEND_GLOBAL_PER_SECOND, SEND_CHAT_PER_SECOND, \
+    SEND_CHAT_BURST, SEND_MAX_RETRIES
+from telegram_bots.metrics import count_too_many_requests, set_send_queue_depth
+
+logger = logging.getLogger(__name__)
+
+
+# Token bucket which also tells how long to wait for the next token
+class TokenBucket:
+    def __init__(self, per_second: float, burst: float, now: float):
+        self.per_second = per_second
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.per_second)
+        self.updated_at = now
+
+    # Seconds until a token is available, 0 if there is one now
+    def delay(self, now: float) -> float:
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.per_second
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+# A Bot API call waiting in the SendScheduler, e.g. bot.send_message(chat_id=..., text=...)
+# The future completes with the result of the call (e.g. the sent Message) or with its exception
+# A call whose method is None was superseded by a later one, it is completed with None without calling the Bot API
+class OutboundCall:
+    def __init__(self, bot: TeleBot, chat_id: int | str, method: str | None, kwargs: dict):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+
+        # Set when a worker takes the call, after that it can no longer be changed
+        self.started = False
+
+        # Edits of the message sent by this call, the message_id is only known once this call is done
+        self.edits: list[OutboundCall] = []
+
+        # The call which sent the text instead because this call failed, later edits go to its message
+        self.replacement: OutboundCall | None = None
+
+
+# Sends the Bot API messages of all the bots on a small pool of threads, so that the handlers never wait for Telegram
+# Telegram allows a bot about 30 messages per second and about one message per second in a chat
+# (see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this),
+# the calls are held back by a token bucket per bot and one per chat to stay within these limits
+# The calls of a chat are made one after another in the order they were submitted, the chats take turns
+# A call answered with 429 Too Many Requests is made again after the retry_after given by Telegram
+class SendScheduler:
+    def __init__(self, workers: int, max_queue_depth: int, global_per_second: float, chat_per_second: float,
+                 chat_burst: int, max_retries: int):
+        self.workers = workers
+        self.max_queue_depth = max_queue_depth
+        self.global_per_second = global_per_second
+        self.chat_per_second = chat_per_second
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+
+        self._condition = threading.Condition()
+
+        # Chats with waiting calls in round-robin order, and the chats of which a call is being made
+        self._queues: OrderedDict[Hashable, deque[OutboundCall]] = OrderedDict()
+        self._in_flight: set[Hashable] = set()
+        self._depth = 0
+
+        self._bot_buckets: dict[str, TokenBucket] = {}
+        self._chat_buckets: dict[Hashable, TokenBucket] = {}
+
+        # Chats which Telegram asked to wait with retry_after, until time.monotonic()
+        self._blocked_until: dict[Hashable, float] = {}
+
+        # Started on first use so that the threads are started inside the gunicorn worker and not before the fork
+        self._threads: list[threading.Thread] = []
+
+        # Counters for monitoring
+        self.submitted = 0
+        self.sent = 0
+        self.failed = 0
+        self.inline = 0
+        self.coalesced = 0
+        self.too_many_requests = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    def stats(self) -> dict:
+        return {"depth": self._depth, "max_depth": self.max_depth, "submitted": self.submitted, "sent": self.sent,
+                "failed": self.failed, "inline": self.inline, "coalesced": self.coalesced,
+                "too_many_requests": self.too_many_requests}
+
+    # Queues bot.<method>(chat_id=chat_id, **kwargs), e.g. submit(bot, chat_id, "send_message", text="Hi")
+    # If the queue is full, the call is made right away in the calling thread instead (which slows the caller down)
+    def submit(self, bot: TeleBot, chat_id: int | str, method: str, **kwargs) -> OutboundCall:
+        call = OutboundCall(bot, chat_id, method, kwargs)
+        with self._condition:
+            if self._depth < self.max_queue_depth:
+                self._enqueue(call)
+                return call
+            self.inline += 1
+            call.started = True
+
+        # Throttled calls are made again after retry_after until they succeed or run out of retries,
+        # _make completes the future in both cases
+        retry_after = self._make(call)
+        while retry_after is not None:
+            time.sleep(retry_after)
+            retry_after = self._make(call)
+        with self._condition:
+            if call.edits:
+                self._resolve_edits(call)
+        return call
+
+    # Replies to a message, same as bot.reply_to
+    def reply_to(self, bot: TeleBot, chat_id: int | str, message_id: int, text: str, **kwargs) -> OutboundCall:
+        return self.submit(bot, chat_id, "send_message", text=text, reply_to_message_id=message_id, **kwargs)
+
+    # Replaces the text of the message sent by placeholder (e.g. "Processing...") with text, can be called repeatedly
+    # If the placeholder or the last edit is still waiting, it is sent with the new text instead, which saves a call
+    # Otherwise the placeholder is edited once it is sent, or text is sent as a new message if sending it failed
+    def replace_text(self, placeholder: OutboundCall, text: str, **kwargs) -> OutboundCall:
+        with self._condition:
+            while placeholder.replacement is not None:
+                placeholder = placeholder.replacement
+            latest = placeholder.edits[-1] if placeholder.edits else placeholder
+            if not latest.started:
+                latest.kwargs.update(kwargs, text=text)
+                self.coalesced += 1
+                return latest
+            edit = OutboundCall(placeholder.bot, placeholder.chat_id, "edit_message_text", dict(kwargs, text=text))
+            placeholder.edits.append(edit)
+            if placeholder.future.done():
+                self._resolve_edits(placeholder)
+            self._enqueue(edit)
+            return edit
+
+    def _enqueue(self, call: OutboundCall):
+        key = (call.bot.token, call.chat_id)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        queue.append(call)
+        self._depth += 1
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        set_send_queue_depth(self._depth)
+        if not self._threads:
+            self._start_workers()
+        self._condition.notify()
+
+    def _start_workers(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name="send-worker-%d" % index, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # Takes the first call that can be made now, the chat goes to the end of the round
+    # Returns the call or the number of seconds until one of the calls can be made
+    def _next_call(self, now: float) -> OutboundCall | float:
+        wait = 1.0
+        for key, queue in self._queues.items():
+            if key in self._in_flight:
+                continue
+            token = key[0]
+            delay = self._blocked_until.get(key, 0) - now
+            bot_bucket = self._bot_buckets.get(token)
+            if bot_bucket is None:
+                bot_bucket = self._bot_buckets[token] = TokenBucket(self.global_per_second, self.global_per_second,
+                                                                     now)
+            chat_bucket = self._chat_buckets.get(key)
+            if chat_bucket is None:
+                chat_bucket = self._chat_buckets[key] = TokenBucket(self.chat_per_second, self.chat_burst, now)
+            delay = max(delay, bot_bucket.delay(now), chat_bucket.delay(now))
+            if delay > 0:
+                wait = min(wait, delay)
+                continue
+
+            bot_bucket.take()
+            chat_bucket.take()
+            call = queue.popleft()
+            del self._queues[key]
+            if queue:
+                self._queues[key] = queue
+            self._in_flight.add(key)
+            call.started = True
+            return call
+        return wait
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while True:
+                    next_call = self._next_call(time.monotonic())
+                    if isinstance(next_call, OutboundCall):
+                        break
+                    self._condition.wait(next_call if self._queues else None)
+            call = next_call
+
+            retry_after = self._make(call)
+
+            with self._condition:
+                key = (call.bot.token, call.chat_id)
+                self._in_flight.discard(key)
+                if retry_after is not None and call.attempts <= self.max_retries:
+                    # Made again before the other calls of the chat, which would only get a 429 as well
+                    self._blocked_until[key] = time.monotonic() + retry_after
+                    call.started = False
+                    self._queues.setdefault(key, deque()).appendleft(call)
+                else:
+                    self._depth -= 1
+                    set_send_queue_depth(self._depth)
+                    if call.edits:
+                        self._resolve_edits(call)
+                self._forget_idle_chats()
+                self._condition.notify_all()
+
+    # Makes the call, returns retry_after if Telegram answered 429 Too Many Requests
+    def _make(self, call: OutboundCall) -> float | None:
+        if call.method is None:
+            call.future.set_result(None)
+            return None
+        call.attempts += 1
+        try:
+            result = getattr(call.bot, call.method)(chat_id=call.chat_id, **call.kwargs)
+        except ApiTelegramException as ex:
+            if ex.error_code == 429:
+                self.too_many_requests += 1
+                count_too_many_requests(call.bot.token)
+                retry_after = ex.result_json.get("parameters", {}).get("retry_after", 1)
+                if call.attempts <= self.max_retries:
+                    logger.warning("%s to %s was throttled, retrying in %s s", call.method, call.chat_id, retry_after)
+                    return retry_after
+            self._fail(call, ex)
+            return None
+        except Exception as ex:
+            self._fail(call, ex)
+            return None
+        self.sent += 1
+        call.future.set_result(result)
+        return None
+
+    def _fail(self, call: OutboundCall, ex: Exception):
+        self.failed += 1
+        logger.error("%s to %s failed: %s", call.method, call.chat_id, ex)
+        call.future.set_exception(ex)
+
+    # The message to edit is sent now, fill in its message_id
+    # If sending it failed, the latest text is sent as a new message instead and the earlier edits are dropped
+    def _resolve_edits(self, call: OutboundCall):
+        edits = [edit for edit in call.edits if edit.method == "edit_message_text" and "message_id" not in edit.kwargs]
+        if not edits:
+            return
+        if call.future.exception() is None:
+            for edit in edits:
+                edit.kwargs["message_id"] = call.future.result().message_id
+            return
+        for edit in edits[:-1]:
+            edit.method = None
+        replacement = edits[-1]
+        replacement.method = "send_message"
+        if "reply_to_message_id" in call.kwargs:
+            replacement.kwargs["reply_to_message_id"] = call.kwargs["reply_to_message_id"]
+        call.replacement = replacement
+
+    # Drops the buckets of the chats which have nothing to send and would have a full bucket again anyway
+    def _forget_idle_chats(self):
+        if len(self._chat_buckets) <= 10000:
+            return
+        now = time.monotonic()
+        for key in [key for key, bucket in self._chat_buckets.items()
+                    if key not in self._queues and key not in self._in_flight and bucket.full(now)]:
+            del self._chat_buckets[key]
+            self._blocked_until.pop(key, None)
+
+
+# The scheduler shared by all the bots of this process
+send_scheduler = SendScheduler(workers=SEND_WORKERS, max_queue_depth=SEND_QUEUE_MAX_DEPTH,
+                               global_per_second=SEND_GLOBAL_PER_SECOND, chat_per_second=SEND_CHAT_PER_SECOND,
+                               chat_burst=SEND_CHAT_BURST, max_retries=SEND_MAX_RETRIES)
@@ -0,0 +1,80 @@
+import json
+from typing import Hashable
+from telebot.types import Update
+
+# orjson parses the request body bytes several times faster than json, it is optional
+# json.loads accepts bytes as well, so both parse the body without decoding it to a str first
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    orjson = None
+    loads = json.loads
+
+# Update fields which hold an object with a chat, e.g. a Message
+CHAT_FIELDS = ("message", "edited_message", "channel_post", "edited_channel_post",
+               "chat_member", "my_chat_member", "chat_join_request")
+
+# Update fields which hold an object of a user but no chat
+USER_FIELDS = ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query", "poll_answer")
+
+
+# An update from a webhook request, parsed to a dict but not yet to a telebot Update
+# update_id and the chat are all the request thread needs (for update_dedup and the update executor),
+# building the Update with all of its nested objects is left to the worker thread which runs the handlers,
+# and is skipped altogether for redelivered updates and updates rejected by a full queue
+class DecodedUpdate:
+    __slots__ = ("data", "update_id", "_update")
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.update_id: int = data["update_id"]
+        self._update: Update | None = None
+
+    # The telebot Update, built on first use
+    @property
+    def update(self) -> Update:
+        if self._update is None:
+            # de_json takes the dict as it is, it is not used anywhere else
+            self._update = Update.de_json(self.data)
+        return self._update
+
+    # Same keys as update_executor.update_chat_key, read from the dict
+    @property
+    def chat_key(self) -> Hashable:
+        data = self.data
+        for name in CHAT_FIELDS:
+            item = data.get(name)
+            if item is not None:
+                return item["chat"]["id"]
+
+        callback_query = data.get("callback_query")
+        if callback_query is not None:
+            message = callback_query.get("message")
+            if message is not None:
+                return message["chat"]["id"]
+            return callback_query["from"]["id"]
+
+        for name in USER_FIELDS:
+            item = data.get(name)
+            if item is not None:
+                user = item.get("from") or item.get("user")
+                if user is not None:
+                    return user["id"]
+
+        return ("update", self.update_id)
+
+
+# Parses the JSON body of a webhook request, raises ValueError if it is not a JSON object with an update_id
+def decode_update(body: bytes) -> DecodedUpdate:
+    data = loads(body)
+    if not isinstance(data, dict) or not isinstance(data.get("update_id"), int):
+        raise ValueError("Not a Telegram update")
+    return DecodedUpdate(data)
+
+
+# Returns the telebot Update of an update from either the webhooks (DecodedUpdate) or getUpdates (Update)
+def materialize_update(update: DecodedUpdate | Update) -> Update:
+    if isinstance(update, DecodedUpdate):
+        return update.update
+    return update
@@ -0,0 +1,137 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import portalocker
+from constants import UPDATE_DEDUP_CAPACITY, UPDATE_DEDUP_PATH, create_directories
+
+logger = logging.getLogger(__name__)
+
+
+# Remembers the update_ids of the last updates of a bot in a memory mapped file shared by all the worker processes
+# The file holds a table of capacity slots, update_id N is stored in slot N % capacity
+# update_ids of a bot are consecutive, so the table works as a ring of the last capacity update_ids
+# and both the lookup and the insert are a single slot access
+class SharedUpdateIdRing:
+    # Magic, capacity and the number of suppressed duplicates of all the processes
+    HEADER = struct.Struct("<8sQQ")
+    SUPPRESSED_OFFSET = 16
+    MAGIC = b"UPDIDS01"
+
+    # Slots store update_id + 1, so that the zero filled file does not contain update_id 0
+    SLOT = struct.Struct("<Q")
+
+    def __init__(self, path: str, capacity: int):
+        self.path = path
+        self.capacity = capacity
+
+        # The file lock only keeps other processes out, the threads of this process take this lock first
+        self._lock = threading.Lock()
+        self._file = None
+        self._map: mmap.mmap | None = None
+
+        # The file is opened again in a forked child, a lock on the inherited file would not exclude the parent
+        self._pid: int | None = None
+
+        # Counters for monitoring (this process only)
+        self.checked = 0
+        self.suppressed = 0
+
+    def _mapping(self) -> mmap.mmap:
+        if self._pid == os.getpid():
+            return self._map
+
+        # Drop the mapping inherited from the parent process (it stays open in the parent)
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+
+        size = self.HEADER.size + self.capacity * self.SLOT.size
+        file = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), "r+b")
+        portalocker.lock(file, portalocker.LOCK_EX)
+        try:
+            header = file.read(self.HEADER.size)
+            if len(header) < self.HEADER.size or self.HEADER.unpack(header)[:2] != (self.MAGIC, self.capacity):
+                # New file, or a file written with another capacity, start with an empty table
+                file.truncate(0)
+                file.truncate(size)
+                file.seek(0)
+                file.write(self.HEADER.pack(self.MAGIC, self.capacity, 0))
+                file.flush()
+            self._map = mmap.mmap(file.fileno(), size)
+        finally:
+            portalocker.unlock(file)
+        self._file = file
+        self._pid = os.getpid()
+        return self._map
+
+    # Records the update_id, returns False if it was already recorded (i.e. the update is a redelivery)
+    def first_delivery(self, update_id: int) -> bool:
+        offset = self.HEADER.size + (update_id % self.capacity) * self.SLOT.size
+        with self._lock:
+            mapping = self._mapping()
+            portalocker.lock(self._file, portalocker.LOCK_EX)
+            try:
+                self.checked += 1
+                if self.SLOT.unpack_from(mapping, offset)[0] == update_id + 1:
+                    self.suppressed += 1
+                    suppressed = self.SLOT.unpack_from(mapping, self.SUPPRESSED_OFFSET)[0]
+                    self.SLOT.pack_into(mapping, self.SUPPRESSED_OFFSET, suppressed + 1)
+                    return False
+                self.SLOT.pack_into(mapping, offset, update_id + 1)
+                return True
+            finally:
+                portalocker.unlock(self._file)
+
+    # Removes the update_id again, used when the update was not accepted and Telegram has to redeliver it
+    def forget(self, update_id: int):
+        offset = self.HEADER.size + (update_id % self.capacity) * self.SLOT.size
+        with self._lock:
+            mapping = self._mapping()
+            portalocker.lock(self._file, portalocker.LOCK_EX)
+            try:
+                if self.SLOT.unpack_from(mapping, offset)[0] == update_id + 1:
+                    self.SLOT.pack_into(mapping, offset, 0)
+            finally:
+                portalocker.unlock(self._file)
+
+    def stats(self) -> dict:
+        with self._lock:
+            suppressed_total = self.SLOT.unpack_from(self._mapping(), self.SUPPRESSED_OFFSET)[0]
+        return {"checked": self.checked, "suppressed": self.suppressed, "suppressed_all_workers": suppressed_total}
+
+
+# One ring per bot, created on the first update of the bot
+_rings: dict[str, SharedUpdateIdRing] = {}
+_rings_lock = threading.Lock()
+
+
+def update_id_ring(bot_name: str) -> SharedUpdateIdRing:
+    ring = _rings.get(bot_name)
+    if ring is None:
+        with _rings_lock:
+            ring = _rings.get(bot_name)
+            if ring is None:
+                # bot_name is the web route of the bot, e.g. /echo-bot
+                file_name = "%s.ids" % bot_name.strip("/").replace("/", "_")
+                ring = SharedUpdateIdRing(os.path.join(create_directories(UPDATE_DEDUP_PATH), file_name),
+                                          capacity=UPDATE_DEDUP_CAPACITY)
+                _rings[bot_name] = ring
+    return ring
+
+
+# Returns False if the update of the bot was already delivered before and must not be handled again
+def first_delivery(bot_name: str, update_id: int) -> bool:
+    if UPDATE_DEDUP_CAPACITY <= 0:
+        return True
+    if update_id_ring(bot_name).first_delivery(update_id):
+        return True
+    logger.info("Suppressed redelivered update %s of %s", update_id, bot_name)
+    return False
+
+
+# Lets a later delivery of the update through again
+def forget_delivery(bot_name: str, update_id: int):
+    if UPDATE_DEDUP_CAPACITY > 0:
+        update_id_ring(bot_name).forget(update_id)
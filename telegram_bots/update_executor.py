@@ -0,0 +1,150 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Hashable
+from telebot import TeleBot
+from telebot.types import Update
+from constants import WEBHOOK_DISPATCH_MODE, UPDATE_WORKER_POOL_SIZE, UPDATE_QUEUE_MAX_DEPTH
+from telegram_bots.update_dedup import first_delivery, forget_delivery
+from telegram_bots.update_decoding import DecodedUpdate, materialize_update
+from telegram_bots.profiler import profiler
+
+logger = logging.getLogger(__name__)
+
+
+# Bounded executor which runs tasks on a thread pool while keeping tasks with the same key in order
+# Tasks with different keys (i.e. different chats) run concurrently,
+# tasks with the same key run one after another in the order they were submitted
+class KeyedUpdateExecutor:
+    def __init__(self, max_workers: int, max_queue_depth: int, thread_name_prefix: str = "update-worker"):
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self.thread_name_prefix = thread_name_prefix
+
+        self._lock = threading.Lock()
+
+        # Tasks waiting for the currently running task of the same key to finish
+        self._pending: dict[Hashable, deque[tuple[Callable[[], None], Future]]] = {}
+
+        # Number of submitted tasks that are either queued or running
+        self._depth = 0
+
+        # Created on first use so that the threads are started inside the gunicorn worker and not before the fork
+        self._executor: ThreadPoolExecutor | None = None
+
+        # Counters for monitoring
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def depth(self) -> int:
+        return self._depth
+
+    # Submits fn(*args) to run after all earlier tasks of the same key
+    # Returns a Future which completes when the task has run, or None if the queue is full
+    def submit(self, key: Hashable, fn: Callable, *args) -> Future | None:
+        future = Future()
+        task = (lambda: fn(*args), future)
+        with self._lock:
+            if self._depth >= self.max_queue_depth:
+                self.rejected += 1
+                return None
+            self._depth += 1
+            self.submitted += 1
+
+            if key in self._pending:
+                # A task of the same key is already running, this one runs when it is finished
+                self._pending[key].append(task)
+                return future
+
+            self._pending[key] = deque()
+            executor = self._get_executor()
+        executor.submit(self._run, key, task)
+        return future
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix=self.thread_name_prefix)
+        return self._executor
+
+    def _run(self, key: Hashable, task: tuple[Callable[[], None], Future]):
+        fn, future = task
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn())
+            except Exception as ex:
+                self.failed += 1
+                logger.exception("Update handler failed")
+                future.set_exception(ex)
+
+        with self._lock:
+            self._depth -= 1
+            pending = self._pending[key]
+            if not pending:
+                del self._pending[key]
+                return
+            next_task = pending.popleft()
+
+        # Resubmit instead of looping here so that one busy chat cannot hold a worker thread forever
+        self._get_executor().submit(self._run, key, next_task)
+
+
+# Returns the chat (or user) to which the update belongs, updates of the same chat are processed in order
+# Updates which do not belong to any chat (e.g. polls) are keyed on their update_id and are not ordered
+def update_chat_key(update: DecodedUpdate | Update) -> Hashable:
+    if isinstance(update, DecodedUpdate):
+        # Read from the parsed JSON, the Update is not built yet
+        return update.chat_key
+
+    for name in ("message", "edited_message", "channel_post", "edited_channel_post",
+                 "chat_member", "my_chat_member", "chat_join_request"):
+        item = getattr(update, name, None)
+        if item is not None:
+            return item.chat.id
+
+    callback_query = getattr(update, "callback_query", None)
+    if callback_query is not None:
+        if callback_query.message is not None:
+            return callback_query.message.chat.id
+        return callback_query.from_user.id
+
+    for name in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query", "poll_answer"):
+        item = getattr(update, name, None)
+        if item is not None:
+            user = getattr(item, "from_user", None) or getattr(item, "user", None)
+            if user is not None:
+                return user.id
+
+    return ("update", update.update_id)
+
+
+# Runs the handlers of the bot for the update, building the Update from the webhook's JSON first if needed
+def process_update(bot: TeleBot, update: DecodedUpdate | Update):
+    with profiler.section():
+        bot.process_new_updates([materialize_update(update)])
+
+
+# The executor shared by all the bots of this process
+update_executor = KeyedUpdateExecutor(max_workers=UPDATE_WORKER_POOL_SIZE, max_queue_depth=UPDATE_QUEUE_MAX_DEPTH)
+
+
+# Hands the update over to the bot's handlers according to WEBHOOK_DISPATCH_MODE
+# bot_name keeps the chats of different bots apart
+# Updates which Telegram delivers again are acknowledged without running the handlers again (see update_dedup.py)
+# Returns False if the update could not be queued because the queue is full
+def dispatch_update(bot: TeleBot, bot_name: str, update: DecodedUpdate | Update) -> bool:
+    if not first_delivery(bot_name, update.update_id):
+        return True
+
+    if WEBHOOK_DISPATCH_MODE == "inline":
+        process_update(bot, update)
+        return True
+
+    if update_executor.submit((bot_name, update_chat_key(update)), process_update, bot, update) is None:
+        # Telegram redelivers the rejected update, that delivery has to get through
+        forget_delivery(bot_name, update.update_id)
+        return False
+    return True
@@ -0,0 +1,63 @@
+import logging
+import time
+from flask import Flask, request, abort, Response
+from telebot import TeleBot
+from telegram_bots.update_decoding import decode_update
+from telegram_bots.update_executor import dispatch_update
+from telegram_bots.metrics import count_update, name_bot_token, observe_stage
+
+
+# A bot served by the WebhookDispatcher
+class DispatchedBot:
+    def __init__(self, bot: TeleBot, route: str, logger: logging.Logger):
+        self.bot = bot
+        self.route = route
+        self.logger = logger
+
+
+# Receives the webhook requests of all the bots through one Flask route
+# Telegram sends the updates of a bot to /<path token of the bot>, the token selects the bot with a dict lookup
+class WebhookDispatcher:
+    def __init__(self):
+        self.bots: dict[str, DispatchedBot] = {}
+
+    # Called by TelegramBot.register_route of every bot
+    def add_bot(self, path_token: str, bot: TeleBot, logger: logging.Logger):
+        self.bots[path_token] = DispatchedBot(bot, "/%s" % path_token, logger)
+        name_bot_token(bot.token, logger.name)
+
+    # Adds the single webhook route to the Flask app once all the bots have been added
+    # (The any converter only matches the path tokens of the bots, every other path stays a 404)
+    def register_route(self, flask_app: Flask):
+        if not self.bots:
+            return
+        path_tokens = ", ".join('"%s"' % path_token for path_token in self.bots)
+        flask_app.add_url_rule("/<any(%s):path_token>" % path_tokens, endpoint="telegram_webhook",
+                               methods=['POST'], view_func=self.process_webhook_trigger)
+
+    def process_webhook_trigger(self, path_token: str):
+        if request.headers.get('Content-Type') != 'application/json':
+            # Telegram did not trigger the Webhook, abort with 403 Forbidden
+            abort(403)
+        dispatched = self.bots[path_token]
+
+        # Parse the JSON POST data straight from the body bytes, the Telebot Update is built when the handlers run
+        bot_name = dispatched.logger.name
+        started_at = time.perf_counter()
+        try:
+            update = decode_update(request.get_data(cache=False))
+        except ValueError:
+            count_update(bot_name, "malformed")
+            abort(400)
+        observe_stage(bot_name, "decode", time.perf_counter() - started_at)
+
+        # Queue the new message for the update executor (or handle it right away in inline dispatch mode)
+        if not dispatch_update(dispatched.bot, dispatched.route, update):
+            # Too many updates are pending, 503 makes Telegram redeliver the update later
+            dispatched.logger.warning("Update queue is full, rejecting update %s", update.update_id)
+            count_update(bot_name, "rejected")
+            return Response(status=503)
+
+        # Message accepted, now return 204 No Content
+        count_update(bot_name, "accepted")
+        return Response(status=204)
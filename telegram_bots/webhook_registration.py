@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Iterator, Type, TYPE_CHECKING
+import portalocker
+from telebot import TeleBot, util
+from telebot.types import WebhookInfo
+from constants import STORAGE_PATH, WEBHOOK_URL_BASE, DEPLOYMENT_ID, WEBHOOK_REGISTRATION_LOCK_TIMEOUT_SECONDS, \
+    create_directories
+
+if TYPE_CHECKING:
+    from telebot.async_telebot import AsyncTeleBot
+    from telegram_bots import TelegramBot
+
+# Marker written after the webhooks of a deployment have been registered, shared by all the worker processes
+WEBHOOK_REGISTRATION_MARKER = "webhook_registration.json"
+
+
+# Returns True if Telegram already sends the updates of the bot to url
+def webhook_matches(info: WebhookInfo, url: str) -> bool:
+    return info.url == url and sorted(info.allowed_updates or []) == sorted(util.update_types)
+
+
+# Registers the webhook of the bot unless Telegram already has exactly this webhook
+# (setWebhook replaces the existing webhook, there is no need to remove it first)
+# Returns True if the webhook was changed
+def ensure_webhook(bot: TeleBot, url: str, logger: logging.Logger) -> bool:
+    started = time.perf_counter()
+    if webhook_matches(bot.get_webhook_info(), url):
+        logger.info("Webhook already registered at %s (checked in %.0f ms)", url,
+                    (time.perf_counter() - started) * 1000)
+        return False
+
+    # (chat_member updates are not sent by default, they are needed to keep the channel membership cache fresh)
+    bot.set_webhook(url=url, allowed_updates=util.update_types)
+    logger.info("Registered Webhook at %s in %.0f ms", url, (time.perf_counter() - started) * 1000)
+    return True
+
+
+# Same as ensure_webhook for the bots of the async runtime
+async def ensure_webhook_async(async_bot: "AsyncTeleBot", url: str, logger: logging.Logger) -> bool:
+    started = time.perf_counter()
+    if webhook_matches(await async_bot.get_webhook_info(), url):
+        logger.info("Webhook already registered at %s (checked in %.0f ms)", url,
+                    (time.perf_counter() - started) * 1000)
+        return False
+
+    await async_bot.set_webhook(url=url, allowed_updates=util.update_types)
+    logger.info("Registered Webhook at %s in %.0f ms", url, (time.perf_counter() - started) * 1000)
+    return True
+
+
+# Identifies what the webhooks were registered for
+# A new deployment changes the source files of the bots, new settings change the webhook URLs or the bot tokens
+def deployment_fingerprint(telegram_bots: list[Type["TelegramBot"]]) -> str:
+    sources = []
+    for telegram_bot in telegram_bots:
+        source = os.stat(sys.modules[telegram_bot.__module__].__file__)
+        sources.append([telegram_bot.__module__, telegram_bot.__qualname__, source.st_mtime_ns, source.st_size])
+
+    # Only a hash of the bot tokens is kept, the marker file must not leak them
+    tokens = sorted(value for key, value in os.environ.items() if key.endswith("_TOKEN"))
+    fingerprint = json.dumps([DEPLOYMENT_ID, WEBHOOK_URL_BASE, sorted(util.update_types), sources, tokens])
+    return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+
+# Lets only the first worker process of a deployment register the webhooks
+# Yields True if the webhooks still have to be registered, the other workers wait on the lock and then get False
+# The marker is only written if the block finished without an exception, so a failed registration is retried
+@contextmanager
+def webhook_registration(telegram_bots: list[Type["TelegramBot"]]) -> Iterator[bool]:
+    marker_path = os.path.join(create_directories(STORAGE_PATH), WEBHOOK_REGISTRATION_MARKER)
+    fingerprint = deployment_fingerprint(telegram_bots)
+
+    with portalocker.Lock(marker_path + ".lock", timeout=WEBHOOK_REGISTRATION_LOCK_TIMEOUT_SECONDS):
+        try:
+            with open(marker_path, encoding="utf-8") as marker_file:
+                registered = json.load(marker_file).get("fingerprint") == fingerprint
+        except (OSError, ValueError):
+            registered = False
+        if registered:
+            yield False
+            return
+
+        yield True
+        with open(marker_path, "w", encoding="utf-8") as marker_file:
+            json.dump({"fingerprint": fingerprint, "registered_at": time.time()}, marker_file)
+
+
+# Makes the next start of the webhook server register the webhooks again, e.g. after they were removed for polling
+def forget_webhook_registration():
+    marker_path = os.path.join(create_directories(STORAGE_PATH), WEBHOOK_REGISTRATION_MARKER)
+    with portalocker.Lock(marker_path + ".lock", timeout=WEBHOOK_REGISTRATION_LOCK_TIMEOUT_SECONDS):
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+
+
+# Registers the webhooks of all the bots at the same time, each one is a round trip to the Telegram Bot API
+def register_webhooks_in_parallel(telegram_bots: list[Type["TelegramBot"]]):
+    with ThreadPoolExecutor(max_workers=max(len(telegram_bots), 1), thread_name_prefix="webhook") as executor:
+        # Consuming the results raises the first exception of the registrations
+        list(executor.map(lambda telegram_bot: telegram_bot.register_webhook(), telegram_bots))